@@ -0,0 +1,422 @@
+"""
+Loopback swarm benchmark: builds a synthetic torrent, serves it from local seeders behind an in-process
+tracker and runs the real client against them.
+
+    py benchmark.py                      every scenario
+    py benchmark.py latency chokes       only these
+    py benchmark.py --size 256 --seeders 8 baseline
+
+Every run is appended to the results file together with the current git commit, the previous result of
+the same scenario is printed next to the new one so regressions stand out.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+from bencode import bencode
+from rate_limiter import TokenBucket
+
+CLIENT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'torr-client.py')
+DEFAULT_RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results.jsonl')
+SEEDER_BASE_PORT = 17000
+# seconds a seeder keeps a peer choked when it chokes it on purpose
+CHOKE_DURATION = 1.0
+CLIENT_TIMEOUT = 600
+# seconds between two reads of the peak memory of the client
+RSS_POLL_INTERVAL = 0.1
+
+DEFAULT_PARAMS = {
+    'size': 64 * 2 ** 20,
+    'piece_size': 2 ** 18,
+    'files': 1,
+    'seeders': 4,
+    'tracker': 'http',
+    # seconds between a request and its block, requests are still served in parallel
+    'latency': 0.0,
+    # bytes per second of every seeder, 0 for no limit
+    'seeder_rate': 0,
+    # seconds between two chokes a seeder sends, 0 for never
+    'choke_interval': 0.0,
+    # chance of a block of the first seeder being sent with garbage in it, the other seeders stay honest
+    'corrupt_rate': 0.0,
+    # worker processes of the client, 0 runs every connection on one event loop
+    'workers': 0,
+}
+
+SCENARIOS = {
+    'baseline': {},
+    'many-files': {'files': 40},
+    'small-pieces': {'piece_size': 2 ** 15},
+    'large-pieces': {'piece_size': 2 ** 22},
+    'latency': {'latency': 0.05},
+    'bandwidth': {'seeder_rate': 4 * 2 ** 20},
+    'chokes': {'choke_interval': 2.0},
+    'corrupt': {'corrupt_rate': 0.005},
+    'udp-tracker': {'tracker': 'udp'},
+    'workers': {'workers': 2, 'seeders': 8},
+}
+
+
+class SyntheticTorrent:
+    """
+    Random but reproducible content split into params['files'] files, kept in memory for the seeders
+    """
+
+    def __init__(self, params, seed=1):
+        self.piece_size = params['piece_size']
+        self.data = random.Random(seed).randbytes(params['size'])
+        self.amount_of_pieces = (len(self.data) + self.piece_size - 1) // self.piece_size
+        piece_hashes = b''.join(
+            hashlib.sha1(self.data[i: i + self.piece_size]).digest() for i in range(0, len(self.data), self.piece_size)
+        )
+        if params['files'] == 1:
+            self.files = [('bench.bin', len(self.data))]
+            self.info = {'name': 'bench.bin', 'piece length': self.piece_size, 'pieces': piece_hashes,
+                         'length': len(self.data)}
+        else:
+            file_length = len(self.data) // params['files']
+            lengths = [file_length] * (params['files'] - 1) + [len(self.data) - file_length * (params['files'] - 1)]
+            self.files = [(f'bench/file{i:04}.bin', length) for i, length in enumerate(lengths)]
+            self.info = {
+                'name': 'bench',
+                'piece length': self.piece_size,
+                'pieces': piece_hashes,
+                'files': [{'length': length, 'path': [f'file{i:04}.bin']} for i, length in enumerate(lengths)]
+            }
+        self.info_hash = hashlib.sha1(bencode(self.info)).digest()
+
+    def write_torrent_file(self, path, announce_url):
+        with open(path, 'wb') as torrent_file:
+            torrent_file.write(bencode({'announce': announce_url, 'info': self.info}))
+
+    def matches_download(self, folder):
+        absolute_offset = 0
+        for path, length in self.files:
+            with open(os.path.join(folder, path), 'rb') as downloaded_file:
+                if downloaded_file.read() != self.data[absolute_offset: absolute_offset + length]:
+                    return False
+            absolute_offset += length
+        return True
+
+
+class LocalSeeder:
+    """
+    A seeder that has every piece and can be made slow, bandwidth limited, choky or unreliable
+    """
+
+    def __init__(self, torrent, host, port, params, corrupt_rate=0.0):
+        self.torrent = torrent
+        self.host = host
+        self.port = port
+        self.params = params
+        self._corrupt_rate = corrupt_rate
+        self._bucket = TokenBucket(params['seeder_rate'] or None)
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve_peer, host=self.host, port=self.port)
+
+    def stop(self):
+        self._server.close()
+
+    async def _serve_peer(self, reader, writer):
+        requests = asyncio.Queue()
+        sender_task = asyncio.ensure_future(self._send_blocks(requests, writer))
+        choke_task = None
+        try:
+            handshake = await reader.readexactly(68)
+            if handshake[28:48] != self.torrent.info_hash:
+                return
+            writer.write(b'\x13BitTorrent protocol' + bytes(8) + self.torrent.info_hash + b'-BENCH-' + os.urandom(13))
+            bitfield = bytearray(b'\xff' * ((self.torrent.amount_of_pieces + 7) // 8))
+            spare_bits = len(bitfield) * 8 - self.torrent.amount_of_pieces
+            if spare_bits:
+                bitfield[-1] = (0xff << spare_bits) & 0xff
+            writer.write(struct.pack('>Ib', 1 + len(bitfield), 5) + bitfield)
+            writer.write(struct.pack('>Ib', 1, 1))
+            choked = [False]
+            if self.params['choke_interval']:
+                choke_task = asyncio.ensure_future(self._choke_now_and_then(writer, requests, choked))
+            while True:
+                length = struct.unpack('>I', await reader.readexactly(4))[0]
+                if length == 0:
+                    continue
+                message = await reader.readexactly(length)
+                if message[0] == 6 and not choked[0]:
+                    request = struct.unpack_from('>III', message, 1)
+                    await requests.put((time.monotonic() + self.params['latency'], request))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            sender_task.cancel()
+            if choke_task is not None:
+                choke_task.cancel()
+            writer.close()
+
+    async def _send_blocks(self, requests, writer):
+        while True:
+            due, (piece_index, byte_offset, length) = await requests.get()
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._bucket.consume(length)
+            start = piece_index * self.torrent.piece_size + byte_offset
+            block = self.torrent.data[start: start + length]
+            if self._corrupt_rate and random.random() < self._corrupt_rate:
+                block = os.urandom(len(block))
+            writer.write(struct.pack('>IbII', 9 + len(block), 7, piece_index, byte_offset) + block)
+            await writer.drain()
+
+    async def _choke_now_and_then(self, writer, requests, choked):
+        while True:
+            await asyncio.sleep(self.params['choke_interval'])
+            choked[0] = True
+            # a choke drops every request that was not answered yet
+            while not requests.empty():
+                requests.get_nowait()
+            writer.write(struct.pack('>Ib', 1, 0))
+            await asyncio.sleep(CHOKE_DURATION)
+            choked[0] = False
+            writer.write(struct.pack('>Ib', 1, 1))
+
+
+def compact_peers(addresses):
+    return b''.join(socket.inet_aton(host) + struct.pack('>H', port) for host, port in addresses)
+
+
+class HttpTrackerStandIn:
+    def __init__(self, seeder_addresses):
+        self.peers = compact_peers(seeder_addresses)
+        self._server = None
+        self.port = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_request, host='127.0.0.1', port=0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def announce_url(self):
+        return f'http://127.0.0.1:{self.port}/announce'
+
+    def stop(self):
+        self._server.close()
+
+    async def _handle_request(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+        except ConnectionError:
+            writer.close()
+            return
+        query = urllib.parse.urlparse(request_line.split()[1].decode()).query
+        if 'event=stopped' in query:
+            body = bencode({'interval': 1800, 'peers': b''})
+        else:
+            body = bencode({'interval': 1800, 'peers': self.peers})
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+        await writer.drain()
+        writer.close()
+
+
+class UdpTrackerStandIn(asyncio.DatagramProtocol):
+    def __init__(self, seeder_addresses):
+        self.peers = compact_peers(seeder_addresses)
+        self._transport = None
+        self.port = None
+
+    async def start(self):
+        self._transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: self, local_addr=('127.0.0.1', 0)
+        )
+        self.port = self._transport.get_extra_info('sockname')[1]
+
+    def announce_url(self):
+        return f'udp://127.0.0.1:{self.port}/announce'
+
+    def stop(self):
+        self._transport.close()
+
+    def datagram_received(self, data, addr):
+        if len(data) < 16:
+            return
+        action, transaction_id = struct.unpack_from('>I4s', data, 8)
+        if action == 0:
+            self._transport.sendto(struct.pack('>I4sQ', 0, transaction_id, random.getrandbits(64)), addr)
+        elif action == 1 and len(data) >= 98:
+            self._transport.sendto(struct.pack('>I4sIII', 1, transaction_id, 1800, 0, 1) + self.peers, addr)
+
+
+def read_peak_rss(pid):
+    """
+    :return: VmHWM of the process in bytes, 0 where /proc is not available
+    """
+    try:
+        with open(f'/proc/{pid}/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def run_client(torrent_path, work_dir, workers, verbose):
+    """
+    runs the client until it exits, wait4 gives the cpu time of exactly this child
+    :return: tuple: (exit status, wall seconds, cpu seconds, peak rss in bytes)
+    """
+    output = None if verbose else subprocess.DEVNULL
+    started = time.monotonic()
+    command = [sys.executable, CLIENT_SCRIPT, torrent_path]
+    if workers:
+        command += ['--workers', str(workers)]
+    client = subprocess.Popen(command, cwd=work_dir, stdout=output, stderr=output)
+    # ru_maxrss survives exec on linux and would report the benchmark itself, so the peak is sampled instead
+    peak_rss = 0
+    while True:
+        pid, status, usage = os.wait4(client.pid, os.WNOHANG)
+        if pid:
+            break
+        peak_rss = max(peak_rss, read_peak_rss(client.pid))
+        time.sleep(RSS_POLL_INTERVAL)
+    client.returncode = os.waitstatus_to_exitcode(status)
+    if peak_rss == 0:
+        # ru_maxrss is in KiB on linux and in bytes on macOS
+        peak_rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return client.returncode, time.monotonic() - started, usage.ru_utime + usage.ru_stime, peak_rss
+
+
+async def run_scenario(name, params, verbose=False):
+    torrent = SyntheticTorrent(params)
+    seeders = [
+        LocalSeeder(torrent, '127.0.0.1', SEEDER_BASE_PORT + index, params)
+        for index in range(1, params['seeders'])
+    ]
+    # the client bans peers by ip, the corrupting seeder gets a loopback address of its own
+    seeders.insert(0, LocalSeeder(
+        torrent,
+        '127.0.0.2' if params['corrupt_rate'] else '127.0.0.1',
+        SEEDER_BASE_PORT,
+        params,
+        corrupt_rate=params['corrupt_rate']
+    ))
+    seeder_addresses = [(seeder.host, seeder.port) for seeder in seeders]
+    tracker = UdpTrackerStandIn(seeder_addresses) if params['tracker'] == 'udp' else HttpTrackerStandIn(seeder_addresses)
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        for seeder in seeders:
+            await seeder.start()
+        await tracker.start()
+        torrent_path = os.path.join(work_dir, 'bench.torrent')
+        torrent.write_torrent_file(torrent_path, tracker.announce_url())
+        exit_status, seconds, cpu_seconds, peak_rss = await asyncio.wait_for(
+            asyncio.to_thread(run_client, torrent_path, work_dir, params['workers'], verbose),
+            timeout=CLIENT_TIMEOUT
+        )
+        megabytes = params['size'] / 2 ** 20
+        return {
+            'scenario': name,
+            'params': params,
+            'ok': exit_status == 0 and torrent.matches_download(work_dir),
+            'seconds': round(seconds, 3),
+            'mb_per_s': round(megabytes / seconds, 2),
+            'cpu_seconds_per_mb': round(cpu_seconds / megabytes, 4),
+            'peak_rss_mib': round(peak_rss / 2 ** 20, 1),
+        }
+    finally:
+        tracker.stop()
+        for seeder in seeders:
+            seeder.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(CLIENT_SCRIPT), capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+
+def previous_result(results, result):
+    for old_result in reversed(results):
+        if old_result['scenario'] == result['scenario'] and old_result['params'] == result['params']:
+            return old_result
+    return None
+
+
+def print_result(result, previous):
+    line = (f'{result["scenario"]:<14} {"ok" if result["ok"] else "FAILED":<7}{result["mb_per_s"]:>9.2f} MB/s'
+            f'{result["seconds"]:>9.2f} s{result["cpu_seconds_per_mb"]:>9.4f} cpu-s/MB{result["peak_rss_mib"]:>9.1f} MiB rss')
+    if previous is not None:
+        change = (result['mb_per_s'] - previous['mb_per_s']) / previous['mb_per_s'] * 100
+        line += f'   {change:+.1f}% vs {previous.get("commit") or "?"}'
+    print(line)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='loopback swarm benchmark')
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f'any of {", ".join(SCENARIOS)} (default: all)')
+    parser.add_argument('--size', type=int, help='MiB of content, overrides the scenario')
+    parser.add_argument('--piece-size', type=int, help='KiB per piece, overrides the scenario')
+    parser.add_argument('--files', type=int, help='files in the torrent, overrides the scenario')
+    parser.add_argument('--seeders', type=int, help='local seeders, overrides the scenario')
+    parser.add_argument('--results', default=DEFAULT_RESULTS_FILE, help='results file (default: %(default)s)')
+    parser.add_argument('--no-save', action='store_true', help='do not append the results')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the client')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario {name}')
+    return args
+
+
+def scenario_params(name, args):
+    params = dict(DEFAULT_PARAMS, **SCENARIOS[name])
+    if args.size:
+        params['size'] = args.size * 2 ** 20
+    if args.piece_size:
+        params['piece_size'] = args.piece_size * 2 ** 10
+    if args.files:
+        params['files'] = args.files
+    if args.seeders:
+        params['seeders'] = args.seeders
+    return params
+
+
+async def main(args):
+    results = load_results(args.results)
+    commit = current_commit()
+    for name in args.scenarios or SCENARIOS:
+        result = await run_scenario(name, scenario_params(name, args), args.verbose)
+        result['commit'] = commit
+        result['time'] = time.time()
+        print_result(result, previous_result(results, result))
+        results.append(result)
+        if not args.no_save:
+            with open(args.results, 'a') as results_file:
+                results_file.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
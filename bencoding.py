@@ -0,0 +1,117 @@
+class BencodeError(Exception):
+    pass
+
+
+class Decoder:
+    """
+    Decodes bencoded data in one pass over the buffer: integers and string lengths are parsed straight
+    from it by position and only the strings themselves are copied. Byte strings (and dict keys) stay bytes.
+    The byte span of chosen top level values is recorded, so a dict like info can be hashed exactly as
+    it was encoded even when the encoding is not canonical.
+    """
+
+    def __init__(self, data, span_keys=()):
+        """
+        :param span_keys: keys of the top level dict whose (start, end) offsets are kept in spans
+        """
+        self._data = data
+        self._span_keys = set(span_keys)
+        self.spans = {}
+        # first byte of a value -> method decoding it, every method takes the offset of the value
+        # and returns (value, offset after it)
+        self._decoders = {ord('i'): self._decode_int, ord('l'): self._decode_list, ord('d'): self._decode_dict}
+        for digit in b'0123456789':
+            self._decoders[digit] = self._decode_string
+
+    def decode(self):
+        try:
+            value, end = self._decode_top_level()
+        except (IndexError, KeyError, ValueError, RecursionError):
+            raise BencodeError('malformed bencoded data') from None
+        if end != len(self._data):
+            raise BencodeError(f'trailing data at offset {end}')
+        return value
+
+    def _decode_top_level(self):
+        data = self._data
+        if data[:1] != b'd' or not self._span_keys:
+            return self._decoders[data[0]](0)
+        # the top level dict is walked here so the spans of its values can be recorded
+        values = {}
+        position = 1
+        while data[position] != 0x65:  # e
+            key, position = self._decode_string(position)
+            start = position
+            values[key], position = self._decoders[data[position]](position)
+            if key in self._span_keys:
+                self.spans[key] = (start, position)
+        return values, position + 1
+
+    def _decode_int(self, position):
+        end = self._data.index(b'e', position)
+        return int(self._data[position + 1: end]), end + 1
+
+    def _decode_string(self, position):
+        colon = self._data.index(b':', position)
+        length = int(self._data[position: colon])
+        end = colon + 1 + length
+        if length < 0 or end > len(self._data):
+            raise ValueError('string runs past the end')
+        return self._data[colon + 1: end], end
+
+    def _decode_list(self, position):
+        data = self._data
+        decoders = self._decoders
+        values = []
+        position += 1
+        while data[position] != 0x65:  # e
+            value, position = decoders[data[position]](position)
+            values.append(value)
+        return values, position + 1
+
+    def _decode_dict(self, position):
+        data = self._data
+        decoders = self._decoders
+        values = {}
+        position += 1
+        while data[position] != 0x65:  # e
+            key, position = self._decode_string(position)
+            values[key], position = decoders[data[position]](position)
+        return values, position + 1
+
+
+def decode(data):
+    return Decoder(data).decode()
+
+
+def encode(value):
+    """
+    :param value: int, bytes, str (encoded as utf-8), list or dict, dict keys are sorted as bencoding requires
+    :return: bytes
+    """
+    chunks = []
+    _encode_value(value, chunks)
+    return b''.join(chunks)
+
+
+def _encode_value(value, chunks):
+    if isinstance(value, int) and not isinstance(value, bool):
+        chunks.append(b'i%de' % value)
+    elif isinstance(value, (bytes, bytearray, memoryview, str)):
+        value = value.encode() if isinstance(value, str) else bytes(value)
+        chunks.append(b'%d:' % len(value))
+        chunks.append(value)
+    elif isinstance(value, (list, tuple)):
+        chunks.append(b'l')
+        for item in value:
+            _encode_value(item, chunks)
+        chunks.append(b'e')
+    elif isinstance(value, dict):
+        chunks.append(b'd')
+        items = [(key.encode() if isinstance(key, str) else bytes(key), item) for key, item in value.items()]
+        for key, item in sorted(items, key=lambda key_and_item: key_and_item[0]):
+            _encode_value(key, chunks)
+            _encode_value(item, chunks)
+        chunks.append(b'e')
+    else:
+        raise BencodeError(f'cannot bencode a {type(value).__name__}')
@@ -0,0 +1,56 @@
+DEFAULT_MEMORY_BUDGET = 256 * 2 ** 20
+
+
+class BufferPool:
+    """
+    Hands out piece buffers and recycles them once a piece is on disk. Every buffer counts against the
+    memory budget from the moment a piece starts downloading until it was written, so pieces being
+    downloaded, hashed and waiting in the write queue are all covered.
+    """
+
+    def __init__(self, buffer_size, memory_budget=DEFAULT_MEMORY_BUDGET):
+        """
+        :param buffer_size: the piece length, the only size that is recycled
+        """
+        self.buffer_size = buffer_size
+        self.memory_budget = memory_budget
+        self.in_use_bytes = 0
+        self._free_buffers = []
+        # id of buffer -> pin count, a pinned buffer is still read by another thread and is never recycled
+        self._pins = {}
+
+    def can_allocate(self, size):
+        return self.in_use_bytes + size <= self.memory_budget
+
+    def acquire(self, size):
+        """
+        always succeeds, callers that can wait check can_allocate first
+        """
+        self.in_use_bytes += size
+        if size == self.buffer_size and self._free_buffers:
+            return self._free_buffers.pop()
+        return bytearray(size)
+
+    def release(self, buffer):
+        self.in_use_bytes -= len(buffer)
+        # idle buffers are memory too, only as many are kept as the budget leaves room for
+        free_bytes = len(self._free_buffers) * self.buffer_size
+        if id(buffer) in self._pins:
+            return
+        if len(buffer) == self.buffer_size and self.in_use_bytes + free_bytes + self.buffer_size <= self.memory_budget:
+            self._free_buffers.append(buffer)
+
+    def pin(self, buffers):
+        """
+        the buffers are read outside the event loop (the resume file), one that is released meanwhile
+        is dropped instead of handed to another piece. the caller keeps the buffers alive until unpin
+        """
+        for buffer in buffers:
+            self._pins[id(buffer)] = self._pins.get(id(buffer), 0) + 1
+
+    def unpin(self, buffers):
+        for buffer in buffers:
+            if self._pins[id(buffer)] == 1:
+                del self._pins[id(buffer)]
+            else:
+                self._pins[id(buffer)] -= 1
@@ -0,0 +1,61 @@
+import asyncio
+import random
+
+UPLOAD_SLOTS = 4
+# seconds between two choking decisions
+CHOKE_INTERVAL = 10
+# the optimistic unchoke moves to another peer every this many rounds
+OPTIMISTIC_UNCHOKE_ROUNDS = 3
+
+
+class Choker:
+    """
+    Tit-for-tat: every round the interested peers that gave us the most data since the last round
+    (or took the most while seeding) keep an upload slot. One more slot goes to a random peer
+    and rotates every few rounds so new peers get a chance to prove themselves.
+    """
+
+    def __init__(self, torrent_session, upload_slots=UPLOAD_SLOTS):
+        self._torrent_session = torrent_session
+        self.upload_slots = upload_slots
+        self._round = 0
+        self._optimistic_peer = None
+        # peer -> (downloaded bytes, uploaded bytes) at the previous round
+        self._last_transfer = {}
+
+    async def run(self):
+        while True:
+            self.rechoke()
+            await asyncio.sleep(CHOKE_INTERVAL)
+
+    def on_peer_interested(self, peer):
+        # a free upload slot is handed out right away instead of at the next round
+        unchoked = sum(1 for active_peer in self._torrent_session.connection_manager.active_peers() if not active_peer.am_choking)
+        if unchoked < self.upload_slots:
+            peer.set_choking(False)
+
+    def rechoke(self):
+        peers = self._torrent_session.connection_manager.active_peers()
+        seeding = self._torrent_session.complete()
+        round_transfer = {}
+        for peer in peers:
+            last_downloaded, last_uploaded = self._last_transfer.get(peer, (0, 0))
+            if seeding:
+                round_transfer[peer] = peer.uploaded_bytes - last_uploaded
+            else:
+                round_transfer[peer] = peer.downloaded_bytes - last_downloaded
+        self._last_transfer = {peer: (peer.downloaded_bytes, peer.uploaded_bytes) for peer in peers}
+
+        interested = [peer for peer in peers if peer.peer_interested]
+        interested.sort(key=lambda peer: round_transfer[peer], reverse=True)
+        unchoked = set(interested[: self.upload_slots - 1])
+
+        self._round += 1
+        if self._optimistic_peer not in peers or self._round % OPTIMISTIC_UNCHOKE_ROUNDS == 0:
+            candidates = [peer for peer in interested if peer not in unchoked]
+            self._optimistic_peer = random.choice(candidates) if candidates else None
+        if self._optimistic_peer is not None:
+            unchoked.add(self._optimistic_peer)
+
+        for peer in peers:
+            peer.set_choking(peer not in unchoked)
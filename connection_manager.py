@@ -0,0 +1,176 @@
+import asyncio
+import time
+from collections import deque
+from peer import Peer
+
+TARGET_CONNECTIONS = 50
+MAX_PENDING_CONNECTS = 10
+# connections peers open to us may go this far over the target
+MAX_INBOUND_EXTRA = 10
+# seconds between two checks of the connection pool when nothing wakes the manager up
+REFILL_INTERVAL = 1
+# a peer that did not exchange a block with us (either way) for this long is dropped when other candidates are waiting
+IDLE_PEER_TIMEOUT = 60
+MAX_CONNECT_FAILURES = 3
+# seconds a peer waits before being tried again, multiplied by its failures
+RETRY_BACKOFF = 30
+
+
+class PeerCandidate:
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.failures = 0
+        self.next_attempt = 0.0
+
+    @property
+    def address(self):
+        return self.ip, self.port
+
+
+class ConnectionManager:
+    """
+    Keeps target_connections peers connected for the whole session. Peers from every source go into
+    a candidate pool, dead and idle connections are replaced from it and at most max_pending_connects
+    TCP connects run at the same time. Every connection also counts against the max_connections of the
+    process (see GlobalLimits), none is opened or accepted once those are used up.
+    Banned ips are dropped and never connected again during the session.
+    """
+
+    def __init__(self, torrent_session, target_connections=TARGET_CONNECTIONS, connect_slots=None):
+        """
+        :param connect_slots: semaphore limiting concurrent TCP connects, may be shared between torrents
+        """
+        self._torrent_session = torrent_session
+        self._limits = torrent_session.limits
+        self.target_connections = target_connections
+        self.connect_slots = connect_slots or asyncio.Semaphore(MAX_PENDING_CONNECTS)
+        # address -> PeerCandidate, every peer ever heard of
+        self._known_peers = {}
+        self._candidates = deque()
+        # address -> (Peer, task)
+        self._active_peers = {}
+        # ips of peers that sent bad data
+        self._banned_ips = set()
+        self._wakeup = asyncio.Event()
+        self._run_task = None
+
+    def add_peers(self, peers):
+        """
+        :param peers: list of {ip: str, port: int} from any peer source
+        """
+        for peer in peers:
+            address = (peer['ip'], peer['port'])
+            if address in self._known_peers or peer['ip'] in self._banned_ips:
+                continue
+            candidate = PeerCandidate(peer['ip'], peer['port'])
+            self._known_peers[address] = candidate
+            self._candidates.append(candidate)
+        self._wakeup.set()
+
+    def active_peers(self):
+        return [peer for peer, _ in self._active_peers.values()]
+
+    def ban(self, ip):
+        """
+        disconnects every peer with this ip and keeps it out for the rest of the session
+        """
+        if ip in self._banned_ips:
+            return
+        self._banned_ips.add(ip)
+        self._candidates = deque(candidate for candidate in self._candidates if candidate.ip != ip)
+        for peer, _ in list(self._active_peers.values()):
+            if peer.ip == ip:
+                peer.close()
+
+    def is_banned(self, ip):
+        return ip in self._banned_ips
+
+    def banned_count(self):
+        return len(self._banned_ips)
+
+    def start(self):
+        self._run_task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._run_task is not None:
+            self._run_task.cancel()
+            self._run_task = None
+        peer_tasks = []
+        for peer, peer_task in self._active_peers.values():
+            peer.close()
+            peer_tasks.append(peer_task)
+        await asyncio.gather(*peer_tasks, return_exceptions=True)
+
+    async def accept(self, ip, port, reader, writer, handshake):
+        """
+        runs a connection a peer opened to us until it ends
+        """
+        address = (ip, port)
+        if address in self._active_peers or ip in self._banned_ips \
+                or len(self._active_peers) >= self.target_connections + MAX_INBOUND_EXTRA \
+                or not self._limits.acquire_connections():
+            writer.close()
+            return
+        peer = Peer(ip, port, self._torrent_session)
+        self._active_peers[address] = (peer, asyncio.current_task())
+        try:
+            await peer.accept(reader, writer, handshake)
+        finally:
+            del self._active_peers[address]
+            self._limits.release_connections()
+            self._wakeup.set()
+
+    async def _run(self):
+        while not self._torrent_session.finished():
+            self._drop_idle_peers()
+            self._refill()
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=REFILL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def _refill(self):
+        now = time.monotonic()
+        not_ready = []
+        while self._candidates and len(self._active_peers) < self.target_connections:
+            candidate = self._candidates.popleft()
+            if candidate.next_attempt > now:
+                not_ready.append(candidate)
+                continue
+            if not self._limits.acquire_connections():
+                # every connection of the process is in use, the candidate waits for one to close
+                not_ready.append(candidate)
+                break
+            self._connect(candidate)
+        # candidates still backing off keep their place at the front of the pool
+        self._candidates.extendleft(reversed(not_ready))
+
+    def _connect(self, candidate):
+        peer = Peer(candidate.ip, candidate.port, self._torrent_session)
+        peer_task = asyncio.ensure_future(peer.download())
+        self._active_peers[candidate.address] = (peer, peer_task)
+        peer_task.add_done_callback(lambda _: self._on_peer_done(candidate, peer))
+
+    def _on_peer_done(self, candidate, peer):
+        del self._active_peers[candidate.address]
+        self._limits.release_connections()
+        # a leecher we only uploaded to was a working connection too
+        if peer.downloaded_bytes > 0 or peer.uploaded_bytes > 0:
+            candidate.failures = 0
+        else:
+            candidate.failures += 1
+        if candidate.failures < MAX_CONNECT_FAILURES and candidate.ip not in self._banned_ips:
+            # a peer that was sending data is only out of work for now and comes back right away
+            candidate.next_attempt = time.monotonic() + RETRY_BACKOFF * candidate.failures
+            self._candidates.append(candidate)
+        self._wakeup.set()
+
+    def _drop_idle_peers(self):
+        if not self._candidates:
+            return
+        now = time.monotonic()
+        for peer, _ in list(self._active_peers.values()):
+            if now - peer.last_block_time > IDLE_PEER_TIMEOUT:
+                peer.close()
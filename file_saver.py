@@ -1,105 +1,196 @@
 import asyncio
-import aiofiles
+import mmap
 import os
-import shutil
+import threading
+import time
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from metrics import Metrics
 
 
 class FileSaver:
-    def __init__(self, files_info, amount_of_pieces, parts_folder_name):
+    def __init__(self, files_info, piece_length, amount_of_pieces, sparse=True, on_piece_written=None, metrics=None,
+                 skipped_files=()):
+        """
+        :param sparse: when False the files are fully allocated up front (fallocate) instead of
+            just being extended to their final length
+        :param on_piece_written: called on the event loop with the piece once its data is on disk
+        :param skipped_files: indices of files that are not downloaded, such a file is only created
+            once a piece shared with a wanted file has to be written into it
+        """
         self._write_queue = asyncio.Queue()
+        metrics = metrics or Metrics()
+        self._write_latency = metrics.histogram('disk_write_seconds', 'time to write one piece to its files')
+        self._queue_wait = metrics.histogram('disk_queue_wait_seconds', 'time a piece waits in the write queue')
+        self._on_piece_written = on_piece_written
+        self._piece_length = piece_length
         self._amount_of_pieces = amount_of_pieces
         self._written_count = 0
-        self._create_folders(files_info)
-        self.files = self.files_generator([File(file['length'], file['path']) for file in files_info])
-        self.current_file = next(self.files)
-        self.parts_folder_name = parts_folder_name
-
-    async def put_piece(self, piece): 
-        await self._write_queue.put(piece)
-
-    def files_generator(self, files: list):
-        for file in files:
-            yield file
+        # pieces whose data is on disk, msb first like the wire bitfield
+        self.written_bitfield = bytearray((amount_of_pieces + 7) // 8)
+        self._files_info = files_info
+        self._sparse = sparse
+        self._create_folders([file for file_index, file in enumerate(files_info) if file_index not in skipped_files])
+        self._open_lock = threading.Lock()
+        # None for a file that was not opened yet
+        self.files = [
+            None if file_index in skipped_files else File(file['length'], file['path'], sparse)
+            for file_index, file in enumerate(files_info)
+        ]
+        # absolute offset of the first byte of every file inside the torrent, sorted by construction
+        self._file_offsets = []
+        absolute_offset = 0
+        for file_info in files_info:
+            self._file_offsets.append(absolute_offset)
+            absolute_offset += file_info['length']
+        # a single thread keeps the writes off the event loop and in order
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def put_piece(self, piece):
+        await self._write_queue.put((piece, time.monotonic()))
+
+    def queue_depth(self):
+        return self._write_queue.qsize()
 
     async def start(self):
-        # self.assemble_parts()
-        # return
+        loop = asyncio.get_running_loop()
         while True:
-            complete_piece = await self._write_queue.get()
+            complete_piece, queued_at = await self._write_queue.get()
             if complete_piece is None:
                 break
-            async with aiofiles.open(f'{self.parts_folder_name}/.{complete_piece.index}', mode='wb') as piece_file:
-                await piece_file.write(complete_piece.dump())
-                print(f'wrote piece {complete_piece.index} to disk')
-                self._written_count += 1
-
-    def assemble_file(self):
-        self.assemble_parts()
-        shutil.rmtree(self.parts_folder_name)
-
-    def assemble_parts(self):
+            write_started = time.monotonic()
+            self._queue_wait.observe(write_started - queued_at)
+            await loop.run_in_executor(self._executor, self._write_piece, complete_piece.index, complete_piece.dump())
+            self._write_latency.observe(time.monotonic() - write_started)
+            print(f'wrote piece {complete_piece.index} to disk')
+            self._written_count += 1
+            if self._on_piece_written is not None:
+                self._on_piece_written(complete_piece)
+
+    def _write_piece(self, piece_index, data):
+        data = memoryview(data)
+        data_offset = 0
+        for file, file_offset, length in self.file_spans(piece_index * self._piece_length, len(data)):
+            file.write_at(file_offset, data[data_offset: data_offset + length])
+            data_offset += length
+        # the piece is only marked once the data is in place so a resume file never claims a missing piece
+        self.written_bitfield[piece_index // 8] |= 0x80 >> (piece_index % 8)
+
+    def file_spans(self, absolute_offset, length):
         """
         A piece can belong to more than one file so a piece may need to be broken up and distributed to
-        the right file
-        :return:
+        the right files
+        :return: generator of (file, offset inside the file, length) covering the byte range
+        """
+        file_index = bisect_right(self._file_offsets, absolute_offset) - 1
+        while length > 0 and file_index < len(self.files):
+            file_offset = absolute_offset - self._file_offsets[file_index]
+            span_length = min(length, self._files_info[file_index]['length'] - file_offset)
+            if span_length > 0:
+                yield self.open_file(file_index), file_offset, span_length
+                absolute_offset += span_length
+                length -= span_length
+            file_index += 1
+
+    def read_block(self, piece_index, byte_offset, length):
         """
-        print(10*'-', ' assembling file(s) ', 10*'-')
-        for piece_index in range(self._amount_of_pieces):
-            with open(f'{self.parts_folder_name}/.{piece_index}', 'rb') as piece_file:
-                buffer = piece_file.read()
-                while len(buffer) > 0:
-                    bytes_left = self.current_file.bytes_left()
-                    if bytes_left == 0:
-                        try:
-                            self.current_file.open_file.close()
-                            self.current_file = next(self.files)
-                        except StopIteration:
-                            break
-
-                    if len(buffer) > bytes_left:
-                        self.current_file.put_data(buffer[:bytes_left])
-                        buffer = buffer[bytes_left:]
-                    else:
-                        self.current_file.put_data(buffer)
-                        buffer = []
-
-        self.current_file.open_file.close()
+        :return: list of memoryviews into the memory mapped files covering the block, no data is copied
+        """
+        return [
+            file.mapped_view()[file_offset: file_offset + span_length]
+            for file, file_offset, span_length in self.file_spans(piece_index * self._piece_length + byte_offset, length)
+        ]
+
+    def open_file(self, file_index):
+        """
+        :return: the File, opened (and created) on first use for files that were skipped
+        """
+        file = self.files[file_index]
+        if file is None:
+            # the writer thread and the event loop may both get here for the same file
+            with self._open_lock:
+                file = self.files[file_index]
+                if file is None:
+                    file_info = self._files_info[file_index]
+                    self._create_folders([file_info])
+                    file = File(file_info['length'], file_info['path'], self._sparse)
+                    self.files[file_index] = file
+        return file
+
+    def sync(self):
+        for file in self.files:
+            if file is not None:
+                os.fsync(file.open_file.fileno())
+
+    def finish(self):
+        # may run twice when a finished session is torn down, closed files are forgotten
+        self._executor.shutdown()
+        for file_index, file in enumerate(self.files):
+            if file is not None:
+                file.close()
+                self.files[file_index] = None
 
     def _create_folders(self, files_info):
-        file_paths = [file['path'] for file in files_info]
-        if len(file_paths) == 1:
-            return
-        for file_path in file_paths:
-            dirs = os.path.dirname(file_path).split('/')
-            path = ''
-            for directory in dirs:
-                path += directory
-                if not os.path.exists(path):
-                    os.mkdir(path)
-                path += '/'
+        for file_info in files_info:
+            directory = os.path.dirname(file_info['path'])
+            if directory:
+                os.makedirs(directory, exist_ok=True)
 
 
 class File:
-    def __init__(self, length, path):
+    def __init__(self, length, path, sparse=True):
         """
+        opens (creating if needed) and preallocates the file without touching existing data
         :param length:
         :param path: proper folder included
         """
         self.length = length
         self.path = path
-        self.current_offset = 0
-        self.open_file = open(path, mode='wb')
-
-    def bytes_left(self):
-        return self.length - self.current_offset
-
-    def put_data(self, buffer):
+        mode = 'r+b' if os.path.exists(path) else 'w+b'
+        self.open_file = open(path, mode=mode)
+        self._preallocate(sparse)
+        self._map = None
+        self._map_view = None
+
+    def _preallocate(self, sparse):
+        fd = self.open_file.fileno()
+        if os.fstat(fd).st_size >= self.length:
+            return
+        if not sparse and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, self.length)
+                return
+            except OSError:
+                pass
+        os.ftruncate(fd, self.length)
+
+    def write_at(self, offset, buffer):
         """
         assumes buffer is valid length
-        :param buffer:
-        :return:
         """
-        self.open_file.write(buffer)
-        self.current_offset += len(buffer)
-
-
+        if hasattr(os, 'pwrite'):
+            fd = self.open_file.fileno()
+            while len(buffer) > 0:
+                written = os.pwrite(fd, buffer, offset)
+                buffer = buffer[written:]
+                offset += written
+        else:
+            self.open_file.seek(offset)
+            self.open_file.write(buffer)
+
+    def mapped_view(self):
+        # mapped on first use, only files something is uploaded from pay for the mapping
+        if self._map_view is None:
+            self._map = mmap.mmap(self.open_file.fileno(), self.length, access=mmap.ACCESS_READ)
+            self._map_view = memoryview(self._map)
+        return self._map_view
+
+    def close(self):
+        if self._map is not None:
+            try:
+                self._map_view.release()
+                self._map.close()
+            except BufferError:
+                # a transport still holds a view of a block being sent, the mapping goes with it
+                pass
+        self.open_file.close()
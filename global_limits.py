@@ -0,0 +1,94 @@
+import asyncio
+from rate_limiter import TokenBucket
+
+DEFAULT_MAX_CONNECTIONS = 200
+DEFAULT_MAX_PENDING_CONNECTS = 20
+DEFAULT_DISK_QUEUE_DEPTH = 64
+
+
+class GlobalLimits:
+    """
+    Resources shared by every torrent running in one process. A single torrent gets its own instance
+    so the same code paths are used either way.
+    """
+
+    def __init__(
+            self,
+            max_connections=DEFAULT_MAX_CONNECTIONS,
+            download_rate=None,
+            upload_rate=None,
+            disk_queue_depth=DEFAULT_DISK_QUEUE_DEPTH,
+            max_pending_connects=DEFAULT_MAX_PENDING_CONNECTS,
+            torrent_download_rate=None,
+            torrent_upload_rate=None,
+            peer_download_rate=None,
+            peer_upload_rate=None
+    ):
+        """
+        :param download_rate: bytes per second for all torrents together, None for no limit
+        :param upload_rate: bytes per second for all torrents together, None for no limit
+        :param torrent_download_rate: bytes per second for each torrent, None for no limit
+        :param peer_download_rate: bytes per second for each peer connection, None for no limit
+        :param max_connections: peer connections of all torrents together, incoming, outgoing and the ones
+            reserved for worker processes
+        :param disk_queue_depth: verified pieces waiting to be written, for all torrents together
+        """
+        self.max_connections = max_connections
+        self.open_connections = 0
+        self.download_rate = download_rate
+        self.upload_rate = upload_rate
+        self.download_bucket = TokenBucket(download_rate)
+        self.upload_bucket = TokenBucket(upload_rate)
+        # worker processes of every torrent, they and this process get an equal share of the global rates
+        self.worker_processes = 0
+        # called whenever worker_processes changes, to pass the new shares on to running workers
+        self.worker_listeners = []
+        self.disk_slots = asyncio.Semaphore(disk_queue_depth)
+        self.connect_slots = asyncio.Semaphore(max_pending_connects)
+        self.torrent_download_rate = torrent_download_rate
+        self.torrent_upload_rate = torrent_upload_rate
+        self.peer_download_rate = peer_download_rate
+        self.peer_upload_rate = peer_upload_rate
+
+    def acquire_connections(self, count=1):
+        """
+        :return: how many of count connections still fit under max_connections, those are counted as open
+            until release_connections
+        """
+        granted = max(0, min(count, self.max_connections - self.open_connections))
+        self.open_connections += granted
+        return granted
+
+    def release_connections(self, count=1):
+        self.open_connections -= count
+
+    def add_worker_processes(self, count):
+        """
+        the global buckets of this process are cut to its share, each worker gets the same rates
+        (download_bucket.rate and upload_bucket.rate) for its own buckets
+        :param count: negative for workers that stopped
+        """
+        self.worker_processes += count
+        shares = self.worker_processes + 1
+        self.download_bucket.set_rate(self.download_rate / shares if self.download_rate else None)
+        self.upload_bucket.set_rate(self.upload_rate / shares if self.upload_rate else None)
+        for listener in list(self.worker_listeners):
+            listener()
+
+    def torrent_buckets(self):
+        """
+        :return: tuple: (download bucket, upload bucket) for a new torrent, nested under the global ones
+        """
+        return (
+            TokenBucket(self.torrent_download_rate, parent=self.download_bucket),
+            TokenBucket(self.torrent_upload_rate, parent=self.upload_bucket)
+        )
+
+    def peer_buckets(self, torrent_download_bucket, torrent_upload_bucket):
+        """
+        :return: tuple: (download bucket, upload bucket) for a new peer connection, nested under its torrent's
+        """
+        return (
+            TokenBucket(self.peer_download_rate, parent=torrent_download_bucket),
+            TokenBucket(self.peer_upload_rate, parent=torrent_upload_bucket)
+        )
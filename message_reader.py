@@ -0,0 +1,60 @@
+import asyncio
+import struct
+import time
+
+HANDSHAKE_LENGTH = 68
+# frames longer than this are never sent by well behaved peers (a 16 KiB block plus header
+# or a bitfield of a huge torrent), anything bigger is treated as a protocol error
+MAX_MESSAGE_LENGTH = 2 ** 21
+
+
+class MessageReader:
+    """
+    Reads length prefixed peer wire messages with readexactly, every frame is read in one call
+    and handed out as a memoryview so slicing the payload does not copy it.
+    Idle connections are closed by a single watchdog task per connection instead of a timeout per read.
+    """
+
+    def __init__(self, reader, writer, idle_timeout=10):
+        self._reader = reader
+        self._writer = writer
+        self.idle_timeout = idle_timeout
+        self.last_activity = time.monotonic()
+        self._watchdog_task = None
+
+    def start_watchdog(self):
+        self._watchdog_task = asyncio.ensure_future(self._watchdog())
+
+    def stop_watchdog(self):
+        if self._watchdog_task is not None:
+            self._watchdog_task.cancel()
+            self._watchdog_task = None
+
+    async def _watchdog(self):
+        while True:
+            idle_time = time.monotonic() - self.last_activity
+            if idle_time >= self.idle_timeout:
+                # closing the transport feeds eof to the reader which ends the pending readexactly
+                self._writer.close()
+                return
+            await asyncio.sleep(self.idle_timeout - idle_time)
+
+    async def read_handshake(self):
+        handshake = await self._reader.readexactly(HANDSHAKE_LENGTH)
+        self.last_activity = time.monotonic()
+        return handshake
+
+    async def read_message(self):
+        """
+        :return: memoryview over the message (id byte followed by the payload),
+            an empty memoryview for keep-alive messages
+        :raises asyncio.IncompleteReadError: when the connection is closed
+        :raises ValueError: when the peer announces an oversized frame
+        """
+        length_prefix = await self._reader.readexactly(4)
+        length = struct.unpack('>I', length_prefix)[0]
+        if length > MAX_MESSAGE_LENGTH:
+            raise ValueError(f'message of {length} bytes is too long')
+        message = await self._reader.readexactly(length) if length else b''
+        self.last_activity = time.monotonic()
+        return memoryview(message)
@@ -0,0 +1,54 @@
+import json
+import os
+import struct
+from hashlib import sha1
+
+CACHE_MAGIC = b'TMC1'
+# magic, mtime of the torrent file in ns, size of the torrent file, length of the json part
+_HEADER = struct.Struct('>4sQQI')
+
+
+def cache_file_path(cache_dir, torrent_path):
+    return os.path.join(cache_dir, sha1(os.path.abspath(torrent_path).encode()).hexdigest() + '.meta')
+
+
+def load_metadata(cache_dir, torrent_path):
+    """
+    layout: header, json with everything but the piece hashes, the concatenated piece hashes
+    :return: tuple: (metadata dict, concatenated piece hashes) or None if there is no entry for this
+        exact version (mtime and size) of the torrent file
+    """
+    try:
+        torrent_stat = os.stat(torrent_path)
+        with open(cache_file_path(cache_dir, torrent_path), 'rb') as cache_file:
+            data = cache_file.read()
+    except OSError:
+        return None
+    if len(data) < _HEADER.size:
+        return None
+    magic, mtime, size, json_length = _HEADER.unpack_from(data)
+    if magic != CACHE_MAGIC or mtime != torrent_stat.st_mtime_ns or size != torrent_stat.st_size:
+        return None
+    try:
+        metadata = json.loads(data[_HEADER.size: _HEADER.size + json_length])
+    except ValueError:
+        return None
+    return metadata, data[_HEADER.size + json_length:]
+
+
+def store_metadata(cache_dir, torrent_path, torrent_stat, metadata, piece_hashes):
+    """
+    :param torrent_stat: os.stat of the torrent file taken before it was read
+    """
+    encoded_metadata = json.dumps(metadata).encode()
+    header = _HEADER.pack(CACHE_MAGIC, torrent_stat.st_mtime_ns, torrent_stat.st_size, len(encoded_metadata))
+    path = cache_file_path(cache_dir, torrent_path)
+    temp_path = path + '.tmp'
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(temp_path, 'wb') as cache_file:
+            cache_file.write(header + encoded_metadata + piece_hashes)
+        os.replace(temp_path, path)
+    except OSError:
+        # the cache only saves time, a torrent that cannot be cached still loads
+        pass
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import time
+from bisect import bisect_left
+
+# upper bounds in seconds, fine enough for a hash or a write and wide enough for a slow peer
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# seconds between two samples of the event loop lag
+LOOP_LAG_INTERVAL = 0.5
+METRICS_HOST = '127.0.0.1'
+
+
+class Counter:
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # one count per bucket plus the +Inf one, not cumulative until exported
+        self._counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self._counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """
+        :return: list of (upper bound, observations <= upper bound), the last bound is +Inf
+        """
+        counts = []
+        total = 0
+        for upper_bound, count in zip(self.buckets + (float('inf'),), self._counts):
+            total += count
+            counts.append((upper_bound, total))
+        return counts
+
+
+class Metrics:
+    """
+    Counters and histograms shared by every torrent in the process, plus collectors that are asked
+    for the current state (sessions, peers, queues) whenever a snapshot is taken. Updating a metric is
+    a few additions so it is done inline on the hot paths.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        # callables returning the state of one torrent as a dict, see TorrentSession.stats
+        self._collectors = []
+        self.event_loop_lag = 0.0
+
+    def counter(self, name, description):
+        if name not in self._counters:
+            self._counters[name] = Counter(name, description)
+        return self._counters[name]
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        if name not in self._histograms:
+            self._histograms[name] = Histogram(name, description, buckets)
+        return self._histograms[name]
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def remove_collector(self, collector):
+        if collector in self._collectors:
+            self._collectors.remove(collector)
+
+    def snapshot(self):
+        """
+        :return: dict that can be dumped as JSON
+        """
+        return {
+            'time': time.time(),
+            'event_loop_lag': self.event_loop_lag,
+            'counters': {name: counter.value for name, counter in self._counters.items()},
+            'histograms': {
+                name: {
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'buckets': [[_bound_label(upper_bound), count] for upper_bound, count in histogram.cumulative_counts()]
+                }
+                for name, histogram in self._histograms.items()
+            },
+            'torrents': [collector() for collector in self._collectors]
+        }
+
+    def prometheus_text(self):
+        """
+        :return: the metrics in the Prometheus text exposition format, torrent and peer state become
+            gauges labelled with the info hash and the peer address
+        """
+        lines = [
+            '# TYPE event_loop_lag_last_seconds gauge',
+            f'event_loop_lag_last_seconds {self.event_loop_lag}'
+        ]
+        for counter in self._counters.values():
+            lines.append(f'# HELP {counter.name} {counter.description}')
+            lines.append(f'# TYPE {counter.name} counter')
+            lines.append(f'{counter.name} {counter.value}')
+        for histogram in self._histograms.values():
+            lines.append(f'# HELP {histogram.name} {histogram.description}')
+            lines.append(f'# TYPE {histogram.name} histogram')
+            for upper_bound, count in histogram.cumulative_counts():
+                lines.append(f'{histogram.name}_bucket{{le="{_bound_label(upper_bound)}"}} {count}')
+            lines.append(f'{histogram.name}_sum {histogram.sum}')
+            lines.append(f'{histogram.name}_count {histogram.count}')
+        gauges = {}
+        for torrent in (collector() for collector in self._collectors):
+            torrent_labels = f'info_hash="{torrent["info_hash"]}"'
+            _collect_gauges(gauges, 'torrent_', torrent, torrent_labels)
+            for peer in torrent.get('peers', ()):
+                _collect_gauges(gauges, 'peer_', peer, f'{torrent_labels},peer="{peer["address"]}"')
+        for name, samples in gauges.items():
+            lines.append(f'# TYPE {name} gauge')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+    async def monitor_event_loop(self):
+        """
+        samples how late the loop wakes up a sleeping task, anything blocking the loop
+        (parsing, bitfield work, a sync call) shows up here
+        """
+        lag_histogram = self.histogram('event_loop_lag_seconds', 'how late a timer fired on the event loop')
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.event_loop_lag = max(0.0, time.monotonic() - started - LOOP_LAG_INTERVAL)
+            lag_histogram.observe(self.event_loop_lag)
+
+
+def _bound_label(upper_bound):
+    return '+Inf' if upper_bound == float('inf') else str(upper_bound)
+
+
+def _collect_gauges(gauges, prefix, state, labels):
+    for key, value in state.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        gauges.setdefault(prefix + key, []).append(f'{prefix}{key}{{{labels}}} {value}')
+
+
+class MetricsServer:
+    """
+    Serves the metrics over plain HTTP on localhost: /metrics in the Prometheus text format and
+    /metrics.json as a JSON snapshot.
+    """
+
+    def __init__(self, metrics, port, host=METRICS_HOST):
+        self.metrics = metrics
+        self.port = port
+        self.host = host
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_request, host=self.host, port=self.port)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    async def _handle_request(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # the headers are not needed but are read so the client does not see a reset
+            while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+                pass
+        except (asyncio.TimeoutError, ConnectionError):
+            writer.close()
+            return
+        parts = request_line.decode('latin-1').split()
+        path = parts[1] if len(parts) >= 2 else ''
+        if path == '/metrics':
+            status, content_type, body = '200 OK', 'text/plain; version=0.0.4', self.metrics.prometheus_text()
+        elif path == '/metrics.json':
+            status, content_type, body = '200 OK', 'application/json', json.dumps(self.metrics.snapshot())
+        else:
+            status, content_type, body = '404 Not Found', 'text/plain', 'not found\n'
+        body = body.encode()
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n'
+            f'Connection: close\r\n\r\n'.encode() + body
+        )
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
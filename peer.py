@@ -1,10 +1,70 @@
 import asyncio
+import ipaddress
+import math
+from collections import deque
+from hashlib import sha1
 import socket
 import struct
+import time
 import bitstring
+from piece import BLOCK_SIZE
+from message_reader import MessageReader
+from bencoding import encode, decode, BencodeError
+from pex import parse_pex_message, PEX_INTERVAL, PEX_FLAG_REACHABLE, PEX_FLAG_SEED
 
-import logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# bounds for the amount of block requests kept in flight per peer
+MIN_PIPELINE_DEPTH = 2
+MAX_PIPELINE_DEPTH = 256
+# how often the download rate is sampled, in seconds
+RATE_WINDOW = 1.0
+# a connection with nothing to request from a peer that never became interested is closed after this many seconds
+INTEREST_GRACE_PERIOD = 5
+# requests from a peer queued for upload before new ones are rejected
+MAX_UPLOAD_QUEUE = 250
+# reserved handshake bytes: the extension protocol bit (BEP 10) in the sixth, the Fast Extension bit (BEP 6) in the last
+HANDSHAKE_RESERVED = bytes([0, 0, 0, 0, 0, 0x10, 0, 0x04])
+EXTENSION_PROTOCOL_BIT = 0x10
+FAST_EXTENSION_BIT = 0x04
+# pieces a peer may request from us while we choke it
+ALLOWED_FAST_COUNT = 10
+# Fast Extension message ids
+SUGGEST_PIECE = 0x0d
+HAVE_ALL = 0x0e
+HAVE_NONE = 0x0f
+REJECT_REQUEST = 0x10
+ALLOWED_FAST = 0x11
+# extension protocol message id, the first payload byte says which extension (0 is the extension handshake)
+EXTENDED = 20
+EXTENDED_HANDSHAKE = 0
+# the ids other peers use for extension messages they send us
+LOCAL_EXTENSION_IDS = {'ut_pex': 1}
+CLIENT_VERSION = 'torr-client'
+
+
+def allowed_fast_set(ip, info_hash, amount_of_pieces, count=ALLOWED_FAST_COUNT):
+    """
+    the canonical allowed fast set of BEP 6, derived from the /24 of the peer's address so a peer
+    cannot get more pieces by reconnecting. empty for ipv6 addresses
+    :return: list of piece indices
+    """
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return []
+    if address.version != 4:
+        return []
+    count = min(count, amount_of_pieces)
+    digest = (int(address) & 0xffffff00).to_bytes(4, 'big') + info_hash
+    allowed = []
+    while len(allowed) < count:
+        digest = sha1(digest).digest()
+        for offset in range(0, 20, 4):
+            if len(allowed) == count:
+                break
+            piece_index = int.from_bytes(digest[offset: offset + 4], 'big') % amount_of_pieces
+            if piece_index not in allowed:
+                allowed.append(piece_index)
+    return allowed
 
 
 class Peer:
@@ -12,152 +72,621 @@ class Peer:
         self.torrent_session = torrent_session
         self.ip = ip
         self.port = port
-        self.outbound_requests = 0
+        # (piece-index, byte-offset) -> (length, time the request was sent)
+        self.outbound_requests = {}
+        self.pipeline_depth = MIN_PIPELINE_DEPTH
         self.choked = True
-        self.bitfield = bitstring.BitArray(
-            bin='0' * torrent_session.amount_of_pieces
+        self.bitfield = bitstring.BitArray(torrent_session.amount_of_pieces)
+        # pieces this peer is requesting blocks for, piece-index -> Piece
+        self.active_pieces = {}
+        self.rtt = None
+        self.download_rate = 0.0
+        self._rate_window_start = time.monotonic()
+        self._rate_window_bytes = 0
+        self.downloaded_bytes = 0
+        self.last_block_time = time.monotonic()
+        self._writer = None
+        self._connected_at = time.monotonic()
+        # upload side: we start out choking the peer until the choker picks it
+        self.am_choking = True
+        self.peer_interested = False
+        self.upload_rate = 0.0
+        self.uploaded_bytes = 0
+        self._upload_window_start = time.monotonic()
+        self._upload_window_bytes = 0
+        # (piece-index, byte-offset, length) requested by the peer
+        self._upload_queue = deque()
+        self._upload_wakeup = asyncio.Event()
+        self._resume_scheduled = False
+        # BEP 6, on once both handshakes had the bit
+        self.fast_extension = False
+        # pieces the peer lets us request while it chokes us
+        self._allowed_fast = set()
+        # pieces we serve the peer while we choke it
+        self._allowed_fast_for_peer = set()
+        # the peer sent have all, it is counted as a seed by the picker instead of piece by piece
+        self._counted_as_seed = False
+        # the port the peer accepts connections on, for a peer that connected to us only known
+        # once its extension handshake tells it
+        self.inbound = False
+        self._listen_port = port
+        # handshakes exchanged and the connection still open, only such peers are passed on to others
+        self.connected = False
+        # BEP 10, on once both handshakes had the bit
+        self.extension_protocol = False
+        # extension name -> id the peer wants in messages of that extension
+        self.extension_ids = {}
+        # addresses the peer was told about in ut_pex messages and when the last one went out
+        self.pex_sent = set()
+        self.pex_sent_at = float('-inf')
+        # a peer may send one ut_pex message per PEX_INTERVAL, earlier ones are dropped
+        self.pex_received_at = float('-inf')
+        self.download_bucket, self.upload_bucket = torrent_session.limits.peer_buckets(
+            torrent_session.download_bucket,
+            torrent_session.upload_bucket
         )
-        self.current_piece = None
-        self.last_request_size = -1
-        self.last_byte_offset_request = -1
 
     async def download(self):
-        max_retries = 5
-        for i in range(max_retries):
-            if self.torrent_session.complete():
-                break
+        """
+        one connection attempt, reconnecting is left to the connection manager
+        """
+        if self.torrent_session.finished():
+            return
+        try:
+            await self._download()
+        except Exception:
+            pass
+
+        self._handle_piece_put_back()
+        self._drop_availability()
 
-            try:
-                await self._download()
+    async def accept(self, reader, writer, handshake):
+        """
+        runs a connection the peer opened to us, its handshake was already read and checked
+        """
+        self.inbound = True
+        self._listen_port = None
+        try:
+            await self._run_connection(reader, writer, received_handshake=handshake)
+        except Exception:
+            pass
 
-            except Exception:
-                pass
+        self._handle_piece_put_back()
+        self._drop_availability()
 
-            self._handle_piece_put_back()
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
 
     async def _download(self):
-        reader, writer = await asyncio.wait_for(
-            asyncio.open_connection(self.ip, self.port),
-            timeout=10
-        )
+        async with self.torrent_session.connection_manager.connect_slots:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.ip, self.port),
+                timeout=10
+            )
+        await self._run_connection(reader, writer)
+
+    async def _run_connection(self, reader, writer, received_handshake=None):
+        """
+        :param received_handshake: the handshake of a peer that connected to us, None for outgoing connections
+        """
+        self._writer = writer
+        self._connected_at = time.monotonic()
+        self.last_block_time = time.monotonic()
+        message_reader = MessageReader(reader, writer, idle_timeout=10)
+        message_reader.start_watchdog()
+        upload_task = asyncio.ensure_future(self._serve_requests(writer))
+        try:
+            await self._exchange_messages(message_reader, writer, received_handshake)
+        finally:
+            self.connected = False
+            upload_task.cancel()
+            message_reader.stop_watchdog()
+            writer.close()
+            self._handle_piece_put_back()
+
+    async def _exchange_messages(self, message_reader, writer, received_handshake):
         handshake = self.torrent_session.handshake()
         writer.write(handshake)
         await writer.drain()
 
-        received_handshake = await asyncio.wait_for(
-            reader.read(68),
-            timeout=10
-        )
-        if not self.valid_handshake(received_handshake):
-            return
+        if received_handshake is None:
+            received_handshake = await message_reader.read_handshake()
+            if not self.valid_handshake(received_handshake):
+                return
+        self.connected = True
+        self.fast_extension = bool(received_handshake[27] & FAST_EXTENSION_BIT)
+        self.extension_protocol = bool(received_handshake[25] & EXTENSION_PROTOCOL_BIT)
+        if self.extension_protocol:
+            self._send_extended_handshake()
+        await self.send_bitfield(writer)
+        if self.fast_extension:
+            self._send_allowed_fast()
         await self.send_interested(writer)
         while True:
-            buff = await asyncio.wait_for(
-                reader.read(4),
-                timeout=10
-            )
-            if self.torrent_session.complete():
-                break
-            if not buff or len(buff) != 4:
+            message = await message_reader.read_message()
+            if self.torrent_session.finished():
                 break
-            length = struct.unpack('>I', buff)[0]
-            message = b''
-            while len(message) < length:
-                message += await asyncio.wait_for(
-                    reader.read(length - len(message)),
-                    timeout=10
-                )
-            if self.torrent_session.complete():
-                break
-            if length == 0:
+            if len(message) == 0:
                 continue
-            msg_id = struct.unpack('>b', message[:1])[0]
+            msg_id = message[0]
             if msg_id == 0:
                 self.choked = True
-                self._handle_piece_put_back()
-                continue
+                # with the fast extension the peer rejects what it will not send, the rest still arrives
+                if not self.fast_extension:
+                    self._handle_piece_put_back()
+                    continue
             elif msg_id == 1:
                 self.choked = False
                 await self.send_interested(writer)
-            elif msg_id == 2 or msg_id == 3:
-                continue
+            elif msg_id == 2:
+                self.peer_interested = True
+                self.torrent_session.choker.on_peer_interested(self)
+            elif msg_id == 3:
+                self.peer_interested = False
             elif msg_id == 4:
-                if len(message[1:]) != 4:
+                if len(message) != 5:
                     continue
-                have_piece_index = struct.unpack('>I', message[1:])[0]
-                self.bitfield[have_piece_index] = True
+                have_piece_index = struct.unpack_from('>I', message, 1)[0]
+                self._set_have(have_piece_index)
             elif msg_id == 5:
-                self._set_bitfield(bitstring.BitArray(message[1: length]))
+                self._set_bitfield(bytes(message[1:]))
+            elif msg_id == 6:
+                self._handle_request(message)
             elif msg_id == 7:
-                piece_index = struct.unpack('>I', message[1:5])[0]
-                if self.current_piece.index != piece_index:
-                    continue
-                self.outbound_requests -= 1
-                block_byte_offset = struct.unpack('>I', message[5:9])[0]
-
-                if self.last_request_size != len(message[9:]):
-                    continue
-                if self.last_byte_offset_request != block_byte_offset:
-                    continue
-                self.current_piece.put_data(message[9:])
+                piece_index, block_byte_offset = struct.unpack_from('>II', message, 1)
+                await self._handle_block(piece_index, block_byte_offset, message[9:])
+            elif msg_id == 8:
+                self._handle_cancel(message)
+            elif msg_id == EXTENDED and self.extension_protocol and len(message) >= 2:
+                self._handle_extended(message[1], bytes(message[2:]))
+            elif self.fast_extension:
+                self._handle_fast_message(msg_id, message)
 
-            if not self.choked:
+            if not self.choked or self._allowed_fast:
                 await self.request_block(writer)
-                if self.current_piece is None:
+                if not self.choked and self._idle():
                     break
 
-        writer.close()
-        await writer.wait_closed()
-        self._handle_piece_put_back()
+    def stats(self):
+        return {
+            'address': f'{self.ip}:{self.port}',
+            'download_rate': self.download_rate,
+            'upload_rate': self.upload_rate,
+            'rtt': self.rtt,
+            'pipeline_depth': self.pipeline_depth,
+            'outstanding_requests': len(self.outbound_requests),
+            'upload_queue': len(self._upload_queue),
+            'downloaded_bytes': self.downloaded_bytes,
+            'uploaded_bytes': self.uploaded_bytes,
+            'choked': self.choked,
+            'am_choking': self.am_choking,
+            'fast_extension': self.fast_extension,
+            'extension_protocol': self.extension_protocol,
+            'allowed_fast': len(self._allowed_fast)
+        }
+
+    def _idle(self):
+        # nothing left to download from the peer and it does not want anything from us either
+        if self.outbound_requests or self.peer_interested or self.torrent_session.more_work_expected():
+            return False
+        return time.monotonic() - self._connected_at > INTEREST_GRACE_PERIOD
 
     def valid_handshake(self, handshake):
         if len(handshake) != 68:
             return False
-        return handshake[28:48] == self.torrent_session.info_hash
+        # peers learned from other peers can turn out to be ourselves
+        return handshake[28:48] == self.torrent_session.info_hash and handshake[48:68] != self.torrent_session.handshake()[48:68]
+
+    def listen_address(self):
+        """
+        :return: (ip, port) other peers can connect to or None if the port is not known
+        """
+        return (self.ip, self._listen_port) if self.connected and self._listen_port else None
+
+    def pex_flags(self):
+        flags = 0 if self.inbound else PEX_FLAG_REACHABLE
+        if self._counted_as_seed:
+            flags |= PEX_FLAG_SEED
+        return flags
+
+    def supports_pex(self):
+        return 'ut_pex' in self.extension_ids and not self.torrent_session.private
+
+    def send_extended(self, extension_name, payload):
+        extension_id = self.extension_ids.get(extension_name)
+        if extension_id is None or self._writer is None:
+            return
+        self._writer.write(struct.pack('>IbB', 2 + len(payload), EXTENDED, extension_id) + payload)
+
+    def _send_extended_handshake(self):
+        extended_handshake = {
+            'm': {} if self.torrent_session.private else LOCAL_EXTENSION_IDS,
+            'v': CLIENT_VERSION,
+            'reqq': MAX_UPLOAD_QUEUE
+        }
+        listen_port = self.torrent_session.listen_port()
+        if listen_port is not None:
+            extended_handshake['p'] = listen_port
+        payload = encode(extended_handshake)
+        self._writer.write(struct.pack('>IbB', 2 + len(payload), EXTENDED, EXTENDED_HANDSHAKE) + payload)
+
+    def _handle_extended(self, extension_id, payload):
+        if extension_id == EXTENDED_HANDSHAKE:
+            self._handle_extended_handshake(payload)
+        elif extension_id == LOCAL_EXTENSION_IDS['ut_pex'] and not self.torrent_session.private:
+            now = time.monotonic()
+            if now - self.pex_received_at < PEX_INTERVAL:
+                return
+            self.pex_received_at = now
+            peers = parse_pex_message(payload)
+            if peers:
+                self.torrent_session.add_peers(peers)
+
+    def _handle_extended_handshake(self, payload):
+        try:
+            extended_handshake = decode(payload)
+        except BencodeError:
+            return
+        if not isinstance(extended_handshake, dict):
+            return
+        extension_ids = extended_handshake.get(b'm')
+        if isinstance(extension_ids, dict):
+            # an id of 0 switches an extension off
+            self.extension_ids = {
+                name.decode('utf-8', 'replace'): extension_id
+                for name, extension_id in extension_ids.items()
+                if isinstance(extension_id, int) and 0 < extension_id < 256
+            }
+        listen_port = extended_handshake.get(b'p')
+        if self.inbound and isinstance(listen_port, int) and 0 < listen_port < 65536:
+            self._listen_port = listen_port
+        if self.supports_pex():
+            self.torrent_session.peer_exchange.send_updates(only_peer=self)
 
     async def send_interested(self, writer):
         msg = struct.pack('>Ib', 1, 2)
         writer.write(msg)
         await writer.drain()
 
+    async def send_bitfield(self, writer):
+        """
+        with the fast extension one of bitfield, have all or have none has to be sent, without it
+        an empty bitfield is left out
+        """
+        bitfield = self.torrent_session.have_bitfield()
+        if not any(bitfield):
+            if self.fast_extension:
+                writer.write(struct.pack('>Ib', 1, HAVE_NONE))
+                await writer.drain()
+            return
+        if self.fast_extension and bitfield == _full_bitfield(self.torrent_session.amount_of_pieces):
+            writer.write(struct.pack('>Ib', 1, HAVE_ALL))
+        else:
+            writer.write(struct.pack('>Ib', 1 + len(bitfield), 5) + bitfield)
+        await writer.drain()
+
+    def _send_allowed_fast(self):
+        allowed = allowed_fast_set(self.ip, self.torrent_session.info_hash, self.torrent_session.amount_of_pieces)
+        self._allowed_fast_for_peer = set(allowed)
+        for piece_index in allowed:
+            self._writer.write(struct.pack('>IbI', 5, ALLOWED_FAST, piece_index))
+
+    def send_have(self, piece_index):
+        if self._writer is None:
+            return
+        self._writer.write(struct.pack('>IbI', 5, 4, piece_index))
+
+    def set_choking(self, choking):
+        """
+        called by the choker, the message is flushed with the next drain
+        """
+        if choking == self.am_choking or self._writer is None:
+            return
+        self.am_choking = choking
+        self._writer.write(struct.pack('>Ib', 1, 0 if choking else 1))
+        if choking:
+            # a choke drops every request the peer made, with the fast extension each one is
+            # rejected and the ones for allowed fast pieces are still served
+            kept_requests = deque()
+            for request in self._upload_queue:
+                if self.fast_extension and request[0] in self._allowed_fast_for_peer:
+                    kept_requests.append(request)
+                else:
+                    self._reject_request(request)
+            self._upload_queue = kept_requests
+
+    def _handle_request(self, message):
+        if len(message) != 13:
+            return
+        request = struct.unpack_from('>III', message, 1)
+        piece_index, byte_offset, length = request
+        choked_out = self.am_choking and not (self.fast_extension and piece_index in self._allowed_fast_for_peer)
+        if choked_out or len(self._upload_queue) >= MAX_UPLOAD_QUEUE \
+                or not self.torrent_session.can_serve(piece_index, byte_offset, length):
+            self._reject_request(request)
+            return
+        self._upload_queue.append(request)
+        self._upload_wakeup.set()
+
+    def _handle_cancel(self, message):
+        if len(message) != 13:
+            return
+        request = struct.unpack_from('>III', message, 1)
+        try:
+            self._upload_queue.remove(request)
+        except ValueError:
+            return
+        # a cancelled request is answered with a reject under the fast extension
+        self._reject_request(request)
+
+    def _reject_request(self, request):
+        # without the fast extension a request we do not serve is just dropped
+        if self.fast_extension and self._writer is not None:
+            self._writer.write(struct.pack('>IbIII', 13, REJECT_REQUEST, *request))
+
+    def _handle_fast_message(self, msg_id, message):
+        if msg_id == HAVE_ALL:
+            self._set_have_all()
+        elif msg_id == HAVE_NONE:
+            self._set_bitfield(b'')
+        elif msg_id == REJECT_REQUEST and len(message) == 13:
+            self._handle_reject(*struct.unpack_from('>III', message, 1))
+        elif msg_id == ALLOWED_FAST and len(message) == 5:
+            piece_index = struct.unpack_from('>I', message, 1)[0]
+            if piece_index < self.torrent_session.amount_of_pieces:
+                self._allowed_fast.add(piece_index)
+        # suggest piece is only a hint, the picker knows better what is needed
+
+    def _handle_reject(self, piece_index, byte_offset, length):
+        """
+        the block is handed back right away instead of waiting for a timeout
+        """
+        if self.outbound_requests.pop((piece_index, byte_offset), None) is None:
+            return
+        self.torrent_session.unregister_request(self, piece_index, byte_offset)
+        piece = self.torrent_session.piece_in_progress(piece_index)
+        if piece is not None:
+            piece.release_block(byte_offset)
+        if self.choked:
+            # an allowed fast piece the peer rejects is not asked for again while choked
+            self._allowed_fast.discard(piece_index)
+            self.active_pieces.pop(piece_index, None)
+
+    async def _serve_requests(self, writer):
+        """
+        sends requested blocks straight from the memory mapped files, the views are handed to the
+        transport without copying them into a message buffer first
+        """
+        file_saver = self.torrent_session.file_saver
+        upload_bucket = self.upload_bucket
+        while True:
+            await self._upload_wakeup.wait()
+            self._upload_wakeup.clear()
+            while self._upload_queue:
+                piece_index, byte_offset, length = self._upload_queue[0]
+                await upload_bucket.consume(length)
+                if not self._upload_queue or self._upload_queue[0] != (piece_index, byte_offset, length):
+                    # cancelled or choked while waiting for bandwidth
+                    continue
+                self._upload_queue.popleft()
+                writer.write(struct.pack('>IbII', 9 + length, 7, piece_index, byte_offset))
+                for block_view in file_saver.read_block(piece_index, byte_offset, length):
+                    writer.write(block_view)
+                self._count_upload(length)
+                await writer.drain()
+
+    def _count_upload(self, length):
+        self.uploaded_bytes += length
+        self.torrent_session.uploaded_bytes += length
+        self.torrent_session.uploaded_counter.inc(length)
+        self._upload_window_bytes += length
+        now = time.monotonic()
+        # a leecher we only upload to is not idle either
+        self.last_block_time = now
+        elapsed = now - self._upload_window_start
+        if elapsed >= RATE_WINDOW:
+            window_rate = self._upload_window_bytes / elapsed
+            self.upload_rate = window_rate if self.upload_rate == 0 else 0.8 * self.upload_rate + 0.2 * window_rate
+            self._upload_window_start = now
+            self._upload_window_bytes = 0
+
+    async def _handle_block(self, piece_index, byte_offset, data):
+        """
+        blocks are matched against the outstanding requests so replies may come back in any order
+        """
+        request = self.outbound_requests.pop((piece_index, byte_offset), None)
+        if request is None:
+            return
+        length, sent_at = request
+        if length != len(data):
+            return
+        self._update_rate(sent_at, length)
+        self.downloaded_bytes += length
+        self.torrent_session.downloaded_counter.inc(length)
+        self.last_block_time = time.monotonic()
+        self.torrent_session.on_block_received(self, piece_index, byte_offset)
+        # in endgame the piece may belong to another peer so it is looked up in the session
+        piece = self.torrent_session.piece_in_progress(piece_index)
+        if piece is None:
+            return
+        # only the peer delivering the last missing block reports the piece, duplicates are rejected
+        if piece.put_data(byte_offset, data, self.ip) and piece.complete():
+            await self.torrent_session.on_piece_complete(piece_index)
+
+    def _update_rate(self, sent_at, length):
+        now = time.monotonic()
+        sample = now - sent_at
+        # the latency of a block grows with the queue in front of it, so only the
+        # smallest one seen lately is close to the real round trip time
+        self.rtt = sample if self.rtt is None else min(sample, self.rtt * 1.05)
+        self.torrent_session.block_latency.observe(sample)
+        self._rate_window_bytes += length
+        elapsed = now - self._rate_window_start
+        if elapsed >= RATE_WINDOW:
+            window_rate = self._rate_window_bytes / elapsed
+            self.download_rate = window_rate if self.download_rate == 0 else 0.8 * self.download_rate + 0.2 * window_rate
+            self._rate_window_start = now
+            self._rate_window_bytes = 0
+            self._update_pipeline_depth()
+
+    def _update_pipeline_depth(self):
+        # keep about one bandwidth-delay product worth of blocks in flight
+        bdp_blocks = math.ceil(self.download_rate * self.rtt / BLOCK_SIZE)
+        self.pipeline_depth = max(MIN_PIPELINE_DEPTH, min(MAX_PIPELINE_DEPTH, bdp_blocks + MIN_PIPELINE_DEPTH))
+
     async def request_block(self, writer):
-        if self.outbound_requests > 1:
+        if self._fill_pipeline(writer):
+            await writer.drain()
+
+    def resume_requests(self):
+        """
+        called when the session can hand out work again (memory freed up), the requests are
+        small so they are written without waiting for a drain
+        """
+        if self._writer is not None and (not self.choked or self._allowed_fast):
+            self._fill_pipeline(self._writer)
+
+    def _resume_requests_later(self, delay):
+        # the bandwidth limit is enforced when requests are issued, the pipeline is refilled once tokens are back
+        if self._resume_scheduled:
             return
-        if not self.current_piece:
-            self.current_piece = self.torrent_session.fetch_work(self.bitfield)
-            if not self.current_piece:
-                return
+        self._resume_scheduled = True
 
-        if self.current_piece.complete():
-            await self.send_interested(writer)
-            await self.torrent_session.on_piece_complete(self.current_piece.index)
-            self.current_piece = self.torrent_session.fetch_work(self.bitfield)
-            if not self.current_piece:
-                return
+        def resume():
+            self._resume_scheduled = False
+            self.resume_requests()
+        asyncio.get_running_loop().call_later(delay, resume)
 
-        current_piece_index, byte_offset, length = self.current_piece.next_block()
+    def _fill_pipeline(self, writer):
+        """
+        fills the pipeline up to pipeline_depth outstanding requests
+        :return: True if any request was written
+        """
+        sent_requests = False
+        download_bucket = self.download_bucket
+        while len(self.outbound_requests) < self.pipeline_depth:
+            delay = download_bucket.delay_for(BLOCK_SIZE)
+            if delay > 0:
+                self._resume_requests_later(delay)
+                break
+            block = self._next_block()
+            if block is None:
+                break
+            piece_index, byte_offset, length = block
+            download_bucket.try_consume(length)
+            request_msg = struct.pack(
+                '>IbIII',
+                13,
+                6,
+                piece_index,
+                byte_offset,
+                length
+            )
+            writer.write(request_msg)
+            self.outbound_requests[(piece_index, byte_offset)] = (length, time.monotonic())
+            self.torrent_session.register_request(self, piece_index, byte_offset)
+            sent_requests = True
+        return sent_requests
 
-        request_msg = struct.pack(
+    def send_cancel(self, piece_index, byte_offset):
+        """
+        withdraws a request another peer already answered, the write is flushed with the next drain
+        """
+        request = self.outbound_requests.pop((piece_index, byte_offset), None)
+        if request is None or self._writer is None:
+            return
+        piece = self.torrent_session.piece_in_progress(piece_index)
+        if piece is not None:
+            piece.release_block(byte_offset)
+        cancel_msg = struct.pack(
             '>IbIII',
             13,
-            6,
-            current_piece_index,
+            8,
+            piece_index,
             byte_offset,
-            length
+            request[0]
         )
+        self._writer.write(cancel_msg)
 
-        self.last_request_size = length
-        self.last_byte_offset_request = byte_offset
+    def _next_block(self):
+        if self.choked:
+            return self._next_allowed_fast_block()
+        for piece in self.active_pieces.values():
+            block = piece.next_block()
+            if block is not None:
+                return block
+        piece = self.torrent_session.fetch_work(self.bitfield)
+        if piece is None:
+            return self.torrent_session.endgame_block(self)
+        self.active_pieces[piece.index] = piece
+        return piece.next_block()
 
-        writer.write(request_msg)
-        self.outbound_requests += 1
-        await writer.drain()
+    def _next_allowed_fast_block(self):
+        # while choked only the pieces the peer allowed can be requested
+        for piece_index in list(self._allowed_fast):
+            if not self.bitfield[piece_index]:
+                continue
+            piece = self.active_pieces.get(piece_index) or self.torrent_session.fetch_piece(piece_index)
+            if piece is None:
+                continue
+            self.active_pieces[piece_index] = piece
+            block = piece.next_block()
+            if block is not None:
+                return block
+        return None
+
+    def _set_have_all(self):
+        self._drop_availability()
+        self.bitfield.set(True)
+        self.torrent_session.piece_picker.add_seed()
+        self._counted_as_seed = True
 
-    def _set_bitfield(self, bitfield):
-        self.bitfield = bitfield if len(bitfield) > 0 else self.bitfield
-        self.bitfield = self.bitfield[: self.torrent_session.amount_of_pieces]
+    def _set_bitfield(self, bitfield_bytes):
+        """
+        :param bitfield_bytes: wire bitfield, missing bytes count as pieces the peer does not have
+        """
+        amount_of_pieces = self.torrent_session.amount_of_pieces
+        bitfield_bytes = bytearray(bitfield_bytes[: (amount_of_pieces + 7) // 8].ljust((amount_of_pieces + 7) // 8, b'\0'))
+        if amount_of_pieces % 8:
+            # spare bits at the end are meaningless
+            bitfield_bytes[-1] &= (0xff << (8 - amount_of_pieces % 8)) & 0xff
+        # a complete bitfield counts the peer as a seed like have all, the picker does nothing per piece
+        if bitfield_bytes == _full_bitfield(amount_of_pieces):
+            self._set_have_all()
+            return
+        self._drop_availability()
+        self.bitfield = bitstring.BitArray(bytes=bytes(bitfield_bytes), length=amount_of_pieces)
+        self.torrent_session.piece_picker.add_bitfield(self.bitfield.tobytes())
+
+    def _set_have(self, piece_index):
+        if piece_index >= self.torrent_session.amount_of_pieces or self.bitfield[piece_index]:
+            return
+        self.bitfield[piece_index] = True
+        self.torrent_session.piece_picker.add_have(piece_index)
+
+    def _drop_availability(self):
+        # a disconnected peer no longer counts towards the availability of its pieces
+        if self._counted_as_seed:
+            self.torrent_session.piece_picker.remove_seed()
+            self._counted_as_seed = False
+        else:
+            self.torrent_session.piece_picker.remove_bitfield(self.bitfield.tobytes())
+        self.bitfield = bitstring.BitArray(self.torrent_session.amount_of_pieces)
 
     def _handle_piece_put_back(self):
-        if self.current_piece and not self.current_piece.complete():
-            self.torrent_session.requeue_piece(self.current_piece.index)
-            self.current_piece = None
+        # a choke or a dropped connection discards every outstanding request,
+        # the blocks already received stay in their pieces for other peers to complete
+        for piece_index, byte_offset in self.outbound_requests:
+            self.torrent_session.unregister_request(self, piece_index, byte_offset)
+            piece = self.torrent_session.piece_in_progress(piece_index)
+            if piece is not None:
+                piece.release_block(byte_offset)
+        self.outbound_requests.clear()
+        self.active_pieces.clear()
+
+
+def _full_bitfield(amount_of_pieces):
+    # the bitfield of a peer with every piece, spare bits at the end stay 0
+    full_bytes, spare_bits = divmod(amount_of_pieces, 8)
+    return b'\xff' * full_bytes + (bytes([(0xff << (8 - spare_bits)) & 0xff]) if spare_bits else b'')
@@ -0,0 +1,118 @@
+import asyncio
+import socket
+import struct
+import time
+from bencoding import encode, decode, BencodeError
+from tracker import parse_compact_peers
+
+# a peer gets at most one update this often (BEP 11)
+PEX_INTERVAL = 60
+# seconds between two checks for peers that are due an update
+PEX_CHECK_INTERVAL = 15
+# added or dropped peers in a single message, more added ones in a received message are ignored
+MAX_PEX_PEERS = 50
+# added.f flags
+PEX_FLAG_SEED = 0x02
+PEX_FLAG_REACHABLE = 0x10
+
+
+class PeerExchange:
+    """
+    ut_pex (BEP 11): every connected peer that supports it first gets all peers we are connected to,
+    then once a minute the ones connected since and the ones that went away. Only peers whose
+    listening port is known are passed on.
+    """
+
+    def __init__(self, torrent_session):
+        self._torrent_session = torrent_session
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(PEX_CHECK_INTERVAL)
+            self.send_updates()
+
+    def send_updates(self, only_peer=None):
+        """
+        :param only_peer: send the first message to a peer that just finished the extension handshake
+        """
+        peers = self._torrent_session.connection_manager.active_peers()
+        connected = {}
+        for peer in peers:
+            address = peer.listen_address()
+            if address is not None:
+                connected[address] = peer.pex_flags()
+        now = time.monotonic()
+        for peer in [only_peer] if only_peer is not None else peers:
+            if not peer.supports_pex() or now - peer.pex_sent_at < PEX_INTERVAL:
+                continue
+            own_address = peer.listen_address()
+            added = [address for address in connected if address not in peer.pex_sent and address != own_address]
+            dropped = [address for address in peer.pex_sent if address not in connected]
+            added = added[:MAX_PEX_PEERS]
+            dropped = dropped[:MAX_PEX_PEERS]
+            if not added and not dropped:
+                continue
+            peer.pex_sent.update(added)
+            peer.pex_sent.difference_update(dropped)
+            peer.pex_sent_at = now
+            peer.send_extended('ut_pex', build_pex_message(added, [connected[address] for address in added], dropped))
+
+
+def build_pex_message(added, added_flags, dropped):
+    """
+    :param added: list of (ip, port) addresses, ipv4 and ipv6 ones are split up
+    :param added_flags: one flags byte for every added address
+    :return: bencoded ut_pex payload
+    """
+    added4, flags4, added6, flags6 = [], [], [], []
+    for address, flags in zip(added, added_flags):
+        compact_address = _compact_address(address)
+        if len(compact_address) == 6:
+            added4.append(compact_address)
+            flags4.append(flags)
+        else:
+            added6.append(compact_address)
+            flags6.append(flags)
+    dropped4 = [compact for compact in map(_compact_address, dropped) if len(compact) == 6]
+    dropped6 = [compact for compact in map(_compact_address, dropped) if len(compact) == 18]
+    return encode({
+        'added': b''.join(added4),
+        'added.f': bytes(flags4),
+        'added6': b''.join(added6),
+        'added6.f': bytes(flags6),
+        'dropped': b''.join(dropped4),
+        'dropped6': b''.join(dropped6),
+    })
+
+
+def parse_pex_message(payload):
+    """
+    :return: list of at most MAX_PEX_PEERS added peers ({ip: str, port: int}), dropped peers are left
+        to the connection manager
+    """
+    try:
+        message = decode(payload)
+    except BencodeError:
+        return []
+    if not isinstance(message, dict):
+        return []
+    peers = []
+    added = message.get(b'added')
+    if isinstance(added, bytes):
+        peers.extend(parse_compact_peers(added[: MAX_PEX_PEERS * 6]))
+    added6 = message.get(b'added6')
+    if isinstance(added6, bytes):
+        added6 = added6[: (MAX_PEX_PEERS - len(peers)) * 18]
+        for i in range(0, len(added6) - len(added6) % 18, 18):
+            peers.append({
+                'ip': socket.inet_ntop(socket.AF_INET6, added6[i: i + 16]),
+                'port': struct.unpack('>H', added6[i + 16: i + 18])[0]
+            })
+    return [peer for peer in peers if peer['port'] != 0]
+
+
+def _compact_address(address):
+    ip, port = address
+    if ':' in ip:
+        return socket.inet_pton(socket.AF_INET6, ip) + struct.pack('>H', port)
+    return socket.inet_aton(ip) + struct.pack('>H', port)
@@ -1,33 +1,134 @@
+BLOCK_SIZE = 2 ** 14
+
+
 class Piece:
+    """
+    A piece is downloaded block by block into a preallocated buffer. Every block keeps whether it was
+    received and how many requests for it are outstanding, so blocks can arrive in any order, come
+    from several peers and stay in place when the peer that sent them goes away. The ip that sent each
+    block is kept so a piece failing the hash check can be traced back to its senders.
+    The buffer is attached when the piece starts downloading and given back once it is on disk.
+    """
 
     def __init__(self, index, piece_length):
-        self.downloaded_blocks = bytearray()
+        self.downloaded_blocks = None
         self.index = index
         self.piece_length = piece_length
+        self.amount_of_blocks = (piece_length + BLOCK_SIZE - 1) // BLOCK_SIZE
+        # one byte per block: 1 once the block is in the buffer
+        self._received = bytearray(self.amount_of_blocks)
+        # one byte per block: outstanding requests, capped at 255
+        self._requested = bytearray(self.amount_of_blocks)
+        # ip of the peer every received block came from
+        self._sources = [None] * self.amount_of_blocks
+        self._received_count = 0
+        # every block before this one is received or requested, next_block starts searching here
+        self._search_start = 0
+
+    def attach_buffer(self, buffer):
+        self.downloaded_blocks = buffer
+
+    def detach_buffer(self):
+        buffer = self.downloaded_blocks
+        self.downloaded_blocks = None
+        return buffer
+
+    def block_length(self, block):
+        return min(self.piece_length - block * BLOCK_SIZE, BLOCK_SIZE)
 
     def next_block(self):
         """
-        :return: tuple: (piece-index, byte-offset, length)
+        marks the first block that is neither received nor requested as requested
+        :return: tuple: (piece-index, byte-offset, length) or None when there is no such block.
             length is PIECE_LENGTH - offset and is capped at 2^14
         """
-        length = self.piece_length - self._current_byte_offset()
-        if length > 2 ** 14:
-            length = 2 ** 14
+        for block in range(self._search_start, self.amount_of_blocks):
+            if not self._received[block] and not self._requested[block]:
+                self._requested[block] = 1
+                self._search_start = block + 1
+                return self.index, block * BLOCK_SIZE, self.block_length(block)
+        self._search_start = self.amount_of_blocks
+        return None
 
-        # assert self._current_byte_offset() + length <= self.PIECE_LENGTH
-        return self.index, self._current_byte_offset(), length
+    def has_unrequested_blocks(self):
+        for block in range(self._search_start, self.amount_of_blocks):
+            if not self._received[block] and not self._requested[block]:
+                return True
+        return False
 
-    def _current_byte_offset(self):
-        return len(self.downloaded_blocks)
+    def request_duplicate(self, byte_offset):
+        # endgame asks another peer for a block that is already requested
+        block = byte_offset // BLOCK_SIZE
+        self._requested[block] = min(self._requested[block] + 1, 255)
 
-    def put_data(self, data):
-        if self._current_byte_offset() + len(data) > self.piece_length:
+    def release_block(self, byte_offset):
+        """
+        the request for this block is gone (choke or disconnect), it can be handed out again
+        """
+        block = byte_offset // BLOCK_SIZE
+        if block >= self.amount_of_blocks or self._requested[block] == 0:
             return
-        # assert self._current_byte_offset() + len(data) <= self.PIECE_LENGTH
-        self.downloaded_blocks.extend(data)
+        self._requested[block] -= 1
+        if self._requested[block] == 0 and not self._received[block]:
+            self._search_start = min(self._search_start, block)
+
+    def requested_blocks(self):
+        """
+        :return: list of (byte-offset, length) of blocks that are requested but not received yet
+        """
+        return [
+            (block * BLOCK_SIZE, self.block_length(block))
+            for block in range(self.amount_of_blocks)
+            if self._requested[block] and not self._received[block]
+        ]
+
+    def reset(self):
+        # drops everything, used when the piece failed the hash check
+        self._received = bytearray(self.amount_of_blocks)
+        self._requested = bytearray(self.amount_of_blocks)
+        self._sources = [None] * self.amount_of_blocks
+        self._received_count = 0
+        self._search_start = 0
+
+    def put_data(self, byte_offset, data, source=None):
+        """
+        blocks may arrive in any order, each one is written at its own offset
+        :param source: ip of the peer that sent the block
+        :return: True if the block was accepted
+        """
+        if byte_offset % BLOCK_SIZE != 0 or byte_offset >= self.piece_length:
+            return False
+        block = byte_offset // BLOCK_SIZE
+        if len(data) != self.block_length(block) or self._received[block]:
+            return False
+        self.downloaded_blocks[byte_offset: byte_offset + len(data)] = data
+        self._received[block] = 1
+        self._sources[block] = source
+        self._received_count += 1
+        return True
+
+    def has_received_blocks(self):
+        return self._received_count > 0
+
+    def block_sources(self):
+        """
+        :return: list with the ip that sent every block, None for blocks not received
+        """
+        return list(self._sources)
+
+    def received_blocks(self):
+        """
+        :return: list of (byte-offset, memoryview of the block) sorted by offset
+        """
+        view = memoryview(self.downloaded_blocks)
+        return [
+            (block * BLOCK_SIZE, view[block * BLOCK_SIZE: block * BLOCK_SIZE + self.block_length(block)])
+            for block in range(self.amount_of_blocks)
+            if self._received[block]
+        ]
 
     def complete(self):
-        return len(self.downloaded_blocks) == self.piece_length
+        return self._received_count == self.amount_of_blocks
 
     def dump(self):
         return self.downloaded_blocks
@@ -0,0 +1,206 @@
+import random
+from array import array
+
+# set bit positions (msb first, like the wire bitfield) for every possible byte value
+_BYTE_BITS = [tuple(bit for bit in range(8) if byte & (0x80 >> bit)) for byte in range(256)]
+
+# piece (and file) priorities, skipped pieces are never picked and higher priorities go first
+PRIORITY_SKIP = 0
+PRIORITY_LOW = 1
+PRIORITY_NORMAL = 2
+PRIORITY_HIGH = 3
+PRIORITY_NAMES = {'skip': PRIORITY_SKIP, 'low': PRIORITY_LOW, 'normal': PRIORITY_NORMAL, 'high': PRIORITY_HIGH}
+
+
+def bitfield_indices(bitfield_bytes, amount_of_pieces):
+    """
+    yields the index of every set bit in a raw bitfield, skipping whole zero bytes
+    """
+    for byte_index, byte in enumerate(bitfield_bytes):
+        if not byte:
+            continue
+        base = byte_index * 8
+        for bit in _BYTE_BITS[byte]:
+            index = base + bit
+            if index >= amount_of_pieces:
+                return
+            yield index
+
+
+class PiecePicker:
+    """
+    Keeps how many connected peers have each piece and hands out the rarest piece a peer has,
+    from the highest priority that has one. Pickable pieces live in buckets by priority and
+    availability, moving a piece between buckets is a swap-remove so every update is O(1).
+    """
+
+    def __init__(self, amount_of_pieces, piece_priorities=None):
+        """
+        :param piece_priorities: bytearray with the priority of every piece, all normal if None
+        """
+        self.amount_of_pieces = amount_of_pieces
+        self._availability = array('I', bytes(4 * amount_of_pieces))
+        self._priority = piece_priorities if piece_priorities is not None \
+            else bytearray([PRIORITY_NORMAL]) * amount_of_pieces
+        # position of a piece inside its bucket, -1 when the piece is not pickable
+        self._position = array('i', [-1]) * amount_of_pieces
+        # priority -> availability -> pieces
+        self._buckets = [[[]] for _ in range(PRIORITY_HIGH + 1)]
+        self._pickable_count = 0
+        # peers that have every piece (have all), counted once instead of in every piece's availability
+        self._seeds = 0
+        # (first, last) piece index ranges that are picked in order before anything else, e.g. the
+        # pieces just ahead of a stream's read head
+        self._priority_ranges = []
+
+    def add(self, piece_index):
+        # makes a piece pickable, used for new and requeued pieces, skipped pieces are left out
+        if self._position[piece_index] != -1 or self._priority[piece_index] == PRIORITY_SKIP:
+            return
+        self._insert(piece_index, self._availability[piece_index])
+
+    def add_unavailable(self, piece_indices):
+        """
+        makes pieces pickable in bulk before any peer is known, every one of them has an availability of 0
+        """
+        position = self._position
+        priority = self._priority
+        if self.amount_of_pieces and priority.count(priority[0]) == self.amount_of_pieces \
+                and priority[0] != PRIORITY_SKIP:
+            # every piece has the same priority, they all go into one bucket
+            bucket = self._buckets[priority[0]][0]
+            start = len(bucket)
+            bucket.extend(piece_indices)
+            for bucket_position in range(start, len(bucket)):
+                position[bucket[bucket_position]] = bucket_position
+            self._pickable_count += len(bucket) - start
+            return
+        buckets = [availability_buckets[0] for availability_buckets in self._buckets]
+        for piece_index in piece_indices:
+            piece_priority = priority[piece_index]
+            if piece_priority == PRIORITY_SKIP:
+                continue
+            bucket = buckets[piece_priority]
+            position[piece_index] = len(bucket)
+            bucket.append(piece_index)
+            self._pickable_count += 1
+
+    def priority(self, piece_index):
+        return self._priority[piece_index]
+
+    def wanted(self, piece_index):
+        return self._priority[piece_index] != PRIORITY_SKIP
+
+    def set_priority(self, piece_index, priority):
+        """
+        a pickable piece moves to its new priority, one set to skip stops being pickable.
+        a piece that was skipped has to be added again once it is wanted
+        """
+        if self._position[piece_index] != -1:
+            self._take_out(piece_index, self._availability[piece_index])
+            self._priority[piece_index] = priority
+            self.add(piece_index)
+        else:
+            self._priority[piece_index] = priority
+
+    def take(self, piece_index):
+        """
+        stops a particular piece from being handed out, for a peer that may only request certain pieces
+        :return: True if the piece was pickable
+        """
+        if self._position[piece_index] == -1:
+            return False
+        self._take_out(piece_index, self._availability[piece_index])
+        return True
+
+    def remove(self, piece_index):
+        # the piece is in progress or done, stop handing it out
+        if self._position[piece_index] == -1:
+            return
+        self._take_out(piece_index, self._availability[piece_index])
+
+    def add_have(self, piece_index):
+        self._change_availability(piece_index, 1)
+
+    def add_seed(self):
+        self._seeds += 1
+
+    def remove_seed(self):
+        self._seeds = max(0, self._seeds - 1)
+
+    def add_bitfield(self, bitfield_bytes):
+        for piece_index in bitfield_indices(bitfield_bytes, self.amount_of_pieces):
+            self._change_availability(piece_index, 1)
+
+    def remove_bitfield(self, bitfield_bytes):
+        for piece_index in bitfield_indices(bitfield_bytes, self.amount_of_pieces):
+            self._change_availability(piece_index, -1)
+
+    def set_priority_ranges(self, priority_ranges):
+        """
+        :param priority_ranges: list of inclusive (first, last) piece index ranges, earlier ranges go first
+        """
+        self._priority_ranges = priority_ranges
+
+    def pickable_count(self):
+        return self._pickable_count
+
+    def availability(self, piece_index):
+        return self._availability[piece_index] + self._seeds
+
+    def pick(self, bitfield):
+        """
+        :param bitfield: the pieces the peer has, anything indexable by piece index
+        :return: index of the rarest pickable piece the peer has (ties broken at random) or None.
+            the piece stops being pickable until add() is called again.
+            pieces in a priority range come first, lowest index first, whatever their availability
+        """
+        for first, last in self._priority_ranges:
+            for piece_index in range(first, last + 1):
+                if self._position[piece_index] != -1 and bitfield[piece_index]:
+                    self._take_out(piece_index, self._availability[piece_index])
+                    return piece_index
+        for priority in range(PRIORITY_HIGH, PRIORITY_SKIP, -1):
+            availability_buckets = self._buckets[priority]
+            # the buckets leave out the seeds, with a seed connected even the pieces no one else has are available
+            for availability in range(0 if self._seeds else 1, len(availability_buckets)):
+                bucket = availability_buckets[availability]
+                bucket_size = len(bucket)
+                if bucket_size == 0:
+                    continue
+                start = random.randrange(bucket_size)
+                for i in range(bucket_size):
+                    piece_index = bucket[(start + i) % bucket_size]
+                    if bitfield[piece_index]:
+                        self._take_out(piece_index, availability)
+                        return piece_index
+        return None
+
+    def _change_availability(self, piece_index, delta):
+        old_availability = self._availability[piece_index]
+        new_availability = old_availability + delta
+        if new_availability < 0:
+            return
+        self._availability[piece_index] = new_availability
+        if self._position[piece_index] != -1:
+            self._take_out(piece_index, old_availability)
+            self._insert(piece_index, new_availability)
+
+    def _insert(self, piece_index, availability):
+        availability_buckets = self._buckets[self._priority[piece_index]]
+        while len(availability_buckets) <= availability:
+            availability_buckets.append([])
+        bucket = availability_buckets[availability]
+        self._position[piece_index] = len(bucket)
+        bucket.append(piece_index)
+        self._pickable_count += 1
+
+    def _take_out(self, piece_index, availability):
+        bucket = self._buckets[self._priority[piece_index]][availability]
+        position = self._position[piece_index]
+        last_piece_index = bucket.pop()
+        if last_piece_index != piece_index:
+            bucket[position] = last_piece_index
+            self._position[last_piece_index] = position
+        self._position[piece_index] = -1
+        self._pickable_count -= 1
@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    rate bytes per second with up to burst bytes saved up, a rate of None (or 0) means unlimited.
+    A request bigger than what is available still goes through once the bucket is full enough and
+    leaves it in debt, so blocks larger than the burst are never stuck.
+    Buckets nest: an amount is only taken when the bucket and all its parents have it, so a peer
+    bucket under a torrent bucket under the global bucket keeps all three limits.
+    """
+
+    def __init__(self, rate=None, burst=None, parent=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else (rate or 0)
+        self.parent = parent
+        self._tokens = self.burst
+        self._last_refill = time.monotonic()
+
+    def unlimited(self):
+        """
+        :return: True if neither this bucket nor any parent has a limit
+        """
+        return not self.rate and (self.parent is None or self.parent.unlimited())
+
+    def set_rate(self, rate, burst=None):
+        self._refill()
+        self.rate = rate
+        self.burst = burst if burst is not None else (rate or 0)
+        self._tokens = min(self._tokens, self.burst)
+
+    def _chain(self):
+        bucket = self
+        while bucket is not None:
+            if bucket.rate:
+                yield bucket
+            bucket = bucket.parent
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def _own_delay(self, amount):
+        self._refill()
+        return max(0.0, (min(amount, self.burst) - self._tokens) / self.rate)
+
+    def try_consume(self, amount):
+        limited_buckets = list(self._chain())
+        for bucket in limited_buckets:
+            if bucket._own_delay(amount) > 0:
+                return False
+        for bucket in limited_buckets:
+            bucket._tokens -= amount
+        return True
+
+    def delay_for(self, amount):
+        """
+        :return: seconds until try_consume(amount) can succeed, the slowest bucket in the chain decides
+        """
+        return max((bucket._own_delay(amount) for bucket in self._chain()), default=0)
+
+    async def consume(self, amount):
+        while not self.try_consume(amount):
+            await asyncio.sleep(self.delay_for(amount))
@@ -0,0 +1,150 @@
+import mmap
+import os
+import time
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from hashlib import sha1
+
+# pieces hashed by one task, enough that handing out tasks costs nothing next to the hashing
+PIECES_PER_TASK = 16
+# seconds between two progress reports
+PROGRESS_INTERVAL = 1
+
+
+class RecheckProgress:
+    def __init__(self, amount_of_pieces, total_bytes):
+        self.amount_of_pieces = amount_of_pieces
+        self.total_bytes = total_bytes
+        self.checked_pieces = 0
+        self.checked_bytes = 0
+        self.valid_pieces = 0
+        self.started = time.monotonic()
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def bytes_per_second(self):
+        elapsed = self.elapsed()
+        return self.checked_bytes / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        percent = self.checked_pieces / self.amount_of_pieces * 100 if self.amount_of_pieces else 100.0
+        return f'rechecked {self.checked_pieces}/{self.amount_of_pieces} pieces ({percent:.2f}%),' \
+               f' {self.valid_pieces} valid, {self.bytes_per_second() / 2 ** 20:.1f} MiB/s'
+
+
+def recheck(torrent_info, workers=None, on_progress=None):
+    """
+    Hashes every piece of the torrent straight from the memory mapped files on disk. The pieces are
+    split into tasks for a thread pool as wide as the machine, sha1 releases the GIL so the threads
+    hash in parallel and the page cache is the only copy of the data.
+    :param workers: hashing threads, one per core if None
+    :param on_progress: called with a RecheckProgress about once a second and after the last piece,
+        from the thread running recheck
+    :return: bitfield (msb first like the wire bitfield) of the pieces whose data on disk is valid
+    """
+    amount_of_pieces = torrent_info.amount_of_pieces
+    piece_length = torrent_info.piece_length
+    total_length = torrent_info.total_torrent_length
+    bitfield = bytearray((amount_of_pieces + 7) // 8)
+    progress = RecheckProgress(amount_of_pieces, total_length)
+    mapped_files = MappedFiles(torrent_info.files_info)
+    try:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+            tasks = {
+                executor.submit(
+                    _check_pieces,
+                    mapped_files,
+                    torrent_info.piece_hashes,
+                    piece_length,
+                    total_length,
+                    first_piece,
+                    min(first_piece + PIECES_PER_TASK, amount_of_pieces)
+                ): first_piece
+                for first_piece in range(0, amount_of_pieces, PIECES_PER_TASK)
+            }
+            last_report = time.monotonic()
+            for task in as_completed(tasks):
+                first_piece = tasks[task]
+                for piece_index, valid in enumerate(task.result(), first_piece):
+                    progress.checked_pieces += 1
+                    progress.checked_bytes += min(piece_length, total_length - piece_index * piece_length)
+                    if valid:
+                        progress.valid_pieces += 1
+                        bitfield[piece_index // 8] |= 0x80 >> (piece_index % 8)
+                if on_progress is not None and time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    on_progress(progress)
+    finally:
+        mapped_files.close()
+    if on_progress is not None:
+        on_progress(progress)
+    return bitfield
+
+
+def _check_pieces(mapped_files, piece_hashes, piece_length, total_length, first_piece, end_piece):
+    """
+    :return: list with True for every piece in [first_piece, end_piece) that matches its hash
+    """
+    results = []
+    for piece_index in range(first_piece, end_piece):
+        absolute_offset = piece_index * piece_length
+        digest = mapped_files.digest(absolute_offset, min(piece_length, total_length - absolute_offset))
+        results.append(digest is not None and digest == piece_hashes[piece_index])
+    return results
+
+
+class MappedFiles:
+    """
+    read only mappings of the files of a torrent, missing and empty files are left unmapped
+    """
+
+    def __init__(self, files_info):
+        self._files_info = files_info
+        self._file_offsets = []
+        self._maps = []
+        absolute_offset = 0
+        for file_info in files_info:
+            self._file_offsets.append(absolute_offset)
+            absolute_offset += file_info['length']
+            self._maps.append(self._map_file(file_info))
+
+    @staticmethod
+    def _map_file(file_info):
+        try:
+            with open(file_info['path'], 'rb') as file:
+                size = min(os.fstat(file.fileno()).st_size, file_info['length'])
+                if size == 0:
+                    return None
+                # the mapping keeps its own reference to the file, it stays valid once the file is closed
+                file_map = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+        except OSError:
+            return None
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            file_map.madvise(mmap.MADV_SEQUENTIAL)
+        return file_map
+
+    def digest(self, absolute_offset, length):
+        """
+        :return: sha1 digest of the byte range, None if part of it is not on disk
+        """
+        hasher = sha1()
+        file_index = bisect_right(self._file_offsets, absolute_offset) - 1
+        while length > 0 and file_index < len(self._maps):
+            file_offset = absolute_offset - self._file_offsets[file_index]
+            span_length = min(length, self._files_info[file_index]['length'] - file_offset)
+            if span_length > 0:
+                file_map = self._maps[file_index]
+                if file_map is None or file_offset + span_length > len(file_map):
+                    return None
+                with memoryview(file_map) as view:
+                    hasher.update(view[file_offset: file_offset + span_length])
+                absolute_offset += span_length
+                length -= span_length
+            file_index += 1
+        return hasher.digest() if length == 0 else None
+
+    def close(self):
+        for file_map in self._maps:
+            if file_map is not None:
+                file_map.close()
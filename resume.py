@@ -0,0 +1,115 @@
+import os
+import struct
+from piece import BLOCK_SIZE
+
+# resume file layout, all integers big endian:
+# 0       4-byte string   magic           b'TRSM'
+# 4       20-byte string  info_hash
+# 24      32-bit integer  amount of pieces
+# 28      N bytes         completed pieces bitfield, N = ceil(amount of pieces / 8)
+# 28 + N  32-bit integer  amount of partial pieces
+# then for every partial piece:
+#         32-bit integer  piece index
+#         32-bit integer  piece length
+#         M bytes         received blocks bitmap, M = ceil(blocks in piece / 8)
+#         ...             the received blocks, in offset order
+RESUME_MAGIC = b'TRSM'
+_HEADER = struct.Struct('>4s20sI')
+_PARTIAL_HEADER = struct.Struct('>II')
+
+
+def resume_file_path(info_hash):
+    return f'{bytes.hex(info_hash)}.resume'
+
+
+def _bitmap_length(bits):
+    return (bits + 7) // 8
+
+
+def snapshot_partial_pieces(pieces):
+    """
+    runs on the event loop, nothing is copied: the blocks stay in the piece buffers, which are pinned
+    (see BufferPool.pin) until the resume file is written
+    :param pieces: iterable of Piece with at least one received block
+    :return: list of (piece index, piece length, received blocks bitmap, [memoryview of every received block])
+    """
+    partial_pieces = []
+    for piece in pieces:
+        bitmap = bytearray(_bitmap_length(piece.amount_of_blocks))
+        block_views = []
+        for byte_offset, view in piece.received_blocks():
+            block = byte_offset // BLOCK_SIZE
+            bitmap[block // 8] |= 0x80 >> (block % 8)
+            block_views.append(view)
+        partial_pieces.append((piece.index, piece.piece_length, bytes(bitmap), block_views))
+    return partial_pieces
+
+
+def write_resume_file(path, info_hash, amount_of_pieces, completed_bitfield, partial_pieces):
+    """
+    streams the resume file to disk one partial piece at a time, the blocks are never joined in memory
+    :param completed_bitfield: bytes, msb first like the wire bitfield
+    :param partial_pieces: list from snapshot_partial_pieces
+    """
+    # written next to the old file and renamed over it so a crash never leaves a torn resume file
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as resume_file:
+        resume_file.write(_HEADER.pack(RESUME_MAGIC, info_hash, amount_of_pieces))
+        resume_file.write(completed_bitfield)
+        resume_file.write(struct.pack('>I', len(partial_pieces)))
+        for piece_index, piece_length, bitmap, block_views in partial_pieces:
+            resume_file.write(_PARTIAL_HEADER.pack(piece_index, piece_length))
+            resume_file.write(bitmap)
+            resume_file.writelines(block_views)
+        resume_file.flush()
+        os.fsync(resume_file.fileno())
+    os.replace(temp_path, path)
+
+
+def load_resume_file(path, info_hash, amount_of_pieces):
+    """
+    :return: (completed bitfield as bytes, list of (piece index, piece length, [(byte offset, block data)]))
+        or None when there is no usable resume file for this torrent
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as resume_file:
+        data = memoryview(resume_file.read())
+    try:
+        return _parse_resume_data(data, info_hash, amount_of_pieces)
+    except struct.error:
+        return None
+
+
+def _parse_resume_data(data, info_hash, amount_of_pieces):
+    magic, saved_info_hash, saved_amount_of_pieces = _HEADER.unpack_from(data, 0)
+    if magic != RESUME_MAGIC or saved_info_hash != info_hash or saved_amount_of_pieces != amount_of_pieces:
+        return None
+    offset = _HEADER.size
+    bitfield_length = _bitmap_length(amount_of_pieces)
+    completed_bitfield = bytes(data[offset: offset + bitfield_length])
+    if len(completed_bitfield) != bitfield_length:
+        return None
+    offset += bitfield_length
+    partial_count = struct.unpack_from('>I', data, offset)[0]
+    offset += 4
+    partial_pieces = []
+    for _ in range(partial_count):
+        piece_index, piece_length = _PARTIAL_HEADER.unpack_from(data, offset)
+        offset += _PARTIAL_HEADER.size
+        blocks_in_piece = (piece_length + BLOCK_SIZE - 1) // BLOCK_SIZE
+        bitmap = data[offset: offset + _bitmap_length(blocks_in_piece)]
+        offset += len(bitmap)
+        blocks = []
+        for block in range(blocks_in_piece):
+            if not bitmap[block // 8] & (0x80 >> (block % 8)):
+                continue
+            byte_offset = block * BLOCK_SIZE
+            block_length = min(BLOCK_SIZE, piece_length - byte_offset)
+            block_data = data[offset: offset + block_length]
+            if len(block_data) != block_length:
+                return None
+            blocks.append((byte_offset, block_data))
+            offset += block_length
+        partial_pieces.append((piece_index, piece_length, blocks))
+    return completed_bitfield, partial_pieces
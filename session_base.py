@@ -0,0 +1,88 @@
+from hashlib import sha1
+from peer import HANDSHAKE_RESERVED
+from smart_ban import block_digests
+
+# in endgame a block is requested from at most this many peers at once
+ENDGAME_MAX_DUPLICATES = 3
+
+
+def piece_digest(data):
+    # hashlib releases the GIL for large buffers so this runs in parallel on the hashing threads
+    return sha1(data).digest()
+
+
+class SessionBase:
+    """
+    What TorrentSession and WorkerSession (a torrent in a worker process) do the same way for their
+    peers: the handshake, the registry of outstanding block requests with duplicates for endgame,
+    and the hash check of a complete piece with smart ban.
+    Subclasses set _torrent_info, amount_of_pieces, smart_ban, _in_progress_pieces and _block_requests
+    and implement ban_peer and _run_hashing.
+    """
+
+    def piece_size(self, piece_index):
+        if piece_index == self.amount_of_pieces - 1:
+            return self._torrent_info.total_torrent_length - piece_index * self._torrent_info.piece_length
+        return self._torrent_info.piece_length
+
+    def handshake(self):
+        return chr(19).encode() \
+            + b'BitTorrent protocol' \
+            + HANDSHAKE_RESERVED \
+            + self._torrent_info.info_hash \
+            + self._torrent_info.my_peer_id
+
+    def register_request(self, peer, piece_index, byte_offset):
+        self._block_requests.setdefault((piece_index, byte_offset), set()).add(peer)
+
+    def unregister_request(self, peer, piece_index, byte_offset):
+        requesters = self._block_requests.get((piece_index, byte_offset))
+        if requesters is None:
+            return
+        requesters.discard(peer)
+        if not requesters:
+            del self._block_requests[(piece_index, byte_offset)]
+
+    def on_block_received(self, peer, piece_index, byte_offset):
+        """
+        the first copy of a block wins, every other peer that was asked for it gets a cancel
+        """
+        requesters = self._block_requests.pop((piece_index, byte_offset), ())
+        for other_peer in requesters:
+            if other_peer is not peer:
+                other_peer.send_cancel(piece_index, byte_offset)
+
+    def _duplicate_block(self, peer, piece_indices):
+        """
+        :return: tuple: (piece-index, byte-offset, length) of a block of one of the pieces in progress that
+            is requested from other peers but not from this one, or None
+        """
+        for piece_index in piece_indices:
+            piece = self._in_progress_pieces.get(piece_index)
+            if piece is None or not peer.bitfield[piece_index]:
+                continue
+            for byte_offset, length in piece.requested_blocks():
+                requesters = self._block_requests.get((piece_index, byte_offset), ())
+                if peer in requesters or len(requesters) >= ENDGAME_MAX_DUPLICATES:
+                    continue
+                piece.request_duplicate(byte_offset)
+                return piece_index, byte_offset, length
+        return None
+
+    async def _check_piece(self, piece, piece_hash):
+        """
+        compares the hash of a complete piece with the torrent. smart ban traces a failed piece back to
+        the peers that sent it and, once a piece that failed before passes, bans the ones whose blocks differ
+        :return: True if the piece is valid
+        """
+        failed = piece_hash != self._torrent_info.piece_hashes[piece.index]
+        if failed or self.smart_ban.has_suspects(piece.index):
+            # the blocks stay untouched until the piece is reset or handed on
+            blocks = await self._run_hashing(block_digests, piece)
+            if failed:
+                banned_ips = self.smart_ban.piece_failed(piece.index, blocks)
+            else:
+                banned_ips = self.smart_ban.piece_passed(piece.index, blocks)
+            for ip in banned_ips:
+                self.ban_peer(ip)
+        return not failed
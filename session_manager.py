@@ -0,0 +1,164 @@
+import asyncio
+import os
+from torrent import Torrent
+from torrent_session import TorrentSession, read_incoming_handshake, LISTEN_PORTS
+from connection_manager import TARGET_CONNECTIONS
+from buffer_pool import DEFAULT_MEMORY_BUDGET
+from global_limits import GlobalLimits
+from metrics import Metrics
+
+# seconds between two scans of the watched folder
+WATCH_INTERVAL = 5
+
+
+class SessionManager:
+    """
+    Runs many torrents in one event loop. Connections, bandwidth and the disk queue are GlobalLimits
+    shared by every session, the connection budget is split evenly and rebalanced whenever a torrent
+    is added or removed. With more torrents than connections the shares add up to more than the budget,
+    GlobalLimits refuses the connections over it. A single listening socket routes incoming peers by
+    info hash.
+    """
+
+    def __init__(self, limits=None, seed=False, memory_budget=DEFAULT_MEMORY_BUDGET, metrics=None, workers=0,
+                 sequential=False, recheck=False):
+        """
+        :param memory_budget: piece buffer budget of each torrent
+        :param workers: worker processes of each torrent for its outgoing connections
+        :param sequential: download every torrent in piece order, see TorrentSession
+        :param recheck: hash the data on disk of every torrent before it starts downloading
+        """
+        self.limits = limits or GlobalLimits()
+        self.metrics = metrics or Metrics()
+        self._loop_monitor_task = None
+        self.seed = seed
+        self.memory_budget = memory_budget
+        self.workers = workers
+        self.sequential = sequential
+        self.recheck = recheck
+        # info hash -> (TorrentSession, task running it)
+        self._sessions = {}
+        # torrent file path -> info hash, for torrents added from a watched folder
+        self._watched_files = {}
+        self._server = None
+        self.port = None
+        self._sessions_changed = asyncio.Event()
+
+    async def start(self):
+        self._loop_monitor_task = asyncio.ensure_future(self.metrics.monitor_event_loop())
+        for port in LISTEN_PORTS:
+            try:
+                self._server = await asyncio.start_server(self._accept_peer, port=port)
+            except OSError:
+                continue
+            self.port = port
+            return
+        print('could not listen for incoming connections, only outgoing ones are used')
+
+    async def stop(self):
+        for info_hash in list(self._sessions):
+            await self.remove_torrent(info_hash)
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        if self._loop_monitor_task is not None:
+            self._loop_monitor_task.cancel()
+
+    def sessions(self):
+        return [session for session, _ in self._sessions.values()]
+
+    def add_torrent(self, torrent_info: Torrent, file_priorities=None):
+        """
+        starts downloading a torrent, adding one that already runs does nothing
+        :param file_priorities: priority of every file of the torrent, see TorrentSession
+        :return: the TorrentSession of the torrent
+        """
+        if torrent_info.info_hash in self._sessions:
+            return self._sessions[torrent_info.info_hash][0]
+        session = TorrentSession(
+            torrent_info,
+            seed=self.seed,
+            memory_budget=self.memory_budget,
+            limits=self.limits,
+            listen=False,
+            metrics=self.metrics,
+            workers=self.workers,
+            sequential=self.sequential,
+            file_priorities=file_priorities,
+            recheck=self.recheck
+        )
+        if self.port is not None:
+            session.set_listen_port(self.port)
+        session_task = asyncio.ensure_future(session.start_session())
+        self._sessions[torrent_info.info_hash] = (session, session_task)
+        session_task.add_done_callback(lambda _: self._on_session_done(torrent_info.info_hash, session_task))
+        self._rebalance()
+        return session
+
+    async def remove_torrent(self, info_hash):
+        """
+        stops a torrent, its progress is kept in the resume file
+        """
+        if info_hash not in self._sessions:
+            return
+        session, session_task = self._sessions[info_hash]
+        session_task.cancel()
+        await asyncio.gather(session_task, return_exceptions=True)
+
+    def _on_session_done(self, info_hash, session_task):
+        if info_hash in self._sessions and self._sessions[info_hash][1] is session_task:
+            del self._sessions[info_hash]
+        if not session_task.cancelled() and session_task.exception() is not None:
+            print(f'torrent {bytes.hex(info_hash)} stopped: {session_task.exception()!r}')
+        self._rebalance()
+        self._sessions_changed.set()
+
+    def _rebalance(self):
+        if not self._sessions:
+            return
+        connections_per_torrent = min(TARGET_CONNECTIONS, -(-self.limits.max_connections // len(self._sessions)))
+        for session, _ in self._sessions.values():
+            session.connection_manager.target_connections = connections_per_torrent
+
+    async def wait_until_done(self):
+        while self._sessions:
+            self._sessions_changed.clear()
+            await self._sessions_changed.wait()
+
+    async def watch_folder(self, folder, metadata_cache=None):
+        """
+        keeps the running torrents in sync with the .torrent files in folder:
+        new files are added and torrents whose file was deleted are removed
+        :param metadata_cache: folder for the parsed metadata of the torrent files, see Torrent
+        """
+        while True:
+            torrent_files = {
+                os.path.join(folder, file_name)
+                for file_name in os.listdir(folder) if file_name.endswith('.torrent')
+            }
+            for torrent_file in torrent_files - self._watched_files.keys():
+                torrent_info = load_torrent(torrent_file, metadata_cache)
+                if torrent_info is not None:
+                    self.add_torrent(torrent_info)
+                    self._watched_files[torrent_file] = torrent_info.info_hash
+            for torrent_file in self._watched_files.keys() - torrent_files:
+                await self.remove_torrent(self._watched_files.pop(torrent_file))
+            await asyncio.sleep(WATCH_INTERVAL)
+
+    async def _accept_peer(self, reader, writer):
+        handshake = await read_incoming_handshake(reader, writer)
+        if handshake is None:
+            return
+        session_entry = self._sessions.get(bytes(handshake[28:48]))
+        if session_entry is None:
+            writer.close()
+            return
+        await session_entry[0].accept_connection(reader, writer, handshake)
+
+
+def load_torrent(torrent_file, metadata_cache=None):
+    # Torrent exits on a faulty file, one bad file must not take every other torrent down with it
+    try:
+        return Torrent(torrent_file, metadata_cache)
+    except SystemExit:
+        return None
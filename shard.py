@@ -0,0 +1,652 @@
+import asyncio
+import multiprocessing
+import signal
+import time
+from array import array
+from multiprocessing import shared_memory
+import bitstring
+from choker import Choker
+from pex import PeerExchange
+from smart_ban import SmartBan
+from connection_manager import ConnectionManager
+from file_saver import FileSaver
+from global_limits import GlobalLimits
+from metrics import Metrics
+from piece import Piece, BLOCK_SIZE
+from piece_picker import bitfield_indices
+from session_base import SessionBase, piece_digest
+
+# piece slots in shared memory per worker, a worker never holds more leased pieces than this
+SLOTS_PER_WORKER = 16
+# a worker asks for more pieces once fewer than this many of its leased pieces are not started yet
+LEASE_LOW_WATER = 4
+# seconds a worker waits before asking again after the coordinator had nothing for it
+LEASE_RETRY_INTERVAL = 1.0
+# seconds between two reports of the transfer counters and the batched haves of a worker
+REPORT_INTERVAL = 1.0
+# seconds a leased piece may wait for a peer of the worker to start it before it goes back to the coordinator
+LEASE_TIMEOUT = 30
+WORKER_STOP_TIMEOUT = 10
+
+
+class WorkerHandle:
+    def __init__(self, worker_id, process, connection, connections):
+        self.worker_id = worker_id
+        self.process = process
+        self.connection = connection
+        # connections of the process limits reserved for the worker, given back when it is dropped
+        self.connections = connections
+        # pieces leased to the worker and not reported back yet
+        self.leases = set()
+
+
+class ShardCoordinator:
+    """
+    Runs the outgoing connections of a torrent in worker processes, each with its own event loop, so
+    wire parsing, hashing and bitfield work spread over several cores. The session keeps the piece
+    picker: workers forward the availability their peers announce, lease pieces from it in batches and
+    download them into shared memory slots. A verified piece goes back as its index only, the session
+    writes it to disk straight from the slot. Messages are small tuples over a pipe per worker.
+    """
+
+    def __init__(self, torrent_session, torrent_info, workers):
+        self._session = torrent_session
+        self._torrent_info = torrent_info
+        self._worker_count = workers
+        self._slot_size = torrent_session.piece_size(0)
+        slots = SLOTS_PER_WORKER * workers
+        self._shared_memory = shared_memory.SharedMemory(create=True, size=slots * self._slot_size)
+        self._free_slots = list(range(slots))
+        # piece-index -> slot, for pieces leased to a worker or waiting to be written from their slot
+        self._slot_of_piece = {}
+        self._workers = []
+        self._next_worker = 0
+        self._hash_failures = torrent_session.metrics.counter('hash_failures_total', 'pieces that failed the hash check')
+
+    def start(self):
+        context = multiprocessing.get_context('spawn')
+        loop = asyncio.get_running_loop()
+        limits = self._session.limits
+        limits.worker_listeners.append(self._update_worker_rates)
+        limits.add_worker_processes(self._worker_count)
+        download_rate, upload_rate = self._worker_rates(self._worker_count)
+        target_connections = max(1, self._session.connection_manager.target_connections // self._worker_count)
+        for worker_id in range(self._worker_count):
+            # the connections of a worker count against the limits of this process, it gets what is left
+            connections = limits.acquire_connections(target_connections)
+            connection, worker_connection = context.Pipe()
+            process = context.Process(
+                target=run_worker,
+                args=(
+                    worker_connection,
+                    self._torrent_info,
+                    self._shared_memory.name,
+                    self._slot_size,
+                    self._session.have_bitfield(),
+                    download_rate,
+                    upload_rate,
+                    limits.peer_download_rate,
+                    limits.peer_upload_rate,
+                    connections,
+                    self._session.seed
+                ),
+                daemon=True
+            )
+            process.start()
+            worker_connection.close()
+            worker = WorkerHandle(worker_id, process, connection, connections)
+            self._workers.append(worker)
+            loop.add_reader(connection.fileno(), self._on_messages, worker)
+
+    async def stop(self):
+        for worker in list(self._workers):
+            self._send(worker, ('stop',))
+        for worker in list(self._workers):
+            await asyncio.to_thread(worker.process.join, WORKER_STOP_TIMEOUT)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            self._drop_worker(worker)
+        self._session.limits.worker_listeners.remove(self._update_worker_rates)
+        try:
+            self._shared_memory.close()
+        except BufferError:
+            # a piece still waiting for the disk holds a view of its slot, the mapping goes with the process
+            pass
+        self._shared_memory.unlink()
+
+    def worker_count(self):
+        return len(self._workers)
+
+    def add_peers(self, peers):
+        """
+        spreads new peers over the workers, each worker connects to its own share
+        """
+        if not self._workers:
+            self._session.connection_manager.add_peers(peers)
+            return
+        shares = [[] for _ in self._workers]
+        for peer in peers:
+            shares[self._next_worker % len(self._workers)].append(peer)
+            self._next_worker += 1
+        for worker, share in zip(self._workers, shares):
+            if share:
+                self._send(worker, ('peers', share))
+
+    def broadcast_ban(self, ip):
+        for worker in self._workers:
+            self._send(worker, ('ban', ip))
+
+    def release_slot(self, piece_index):
+        """
+        :return: True if the piece was downloaded by a worker, its slot can be leased again
+        """
+        slot = self._slot_of_piece.pop(piece_index, None)
+        if slot is None:
+            return False
+        self._free_slots.append(slot)
+        return True
+
+    def broadcast_have(self, piece_index):
+        for worker in self._workers:
+            self._send(worker, ('have', piece_index))
+
+    def _worker_rates(self, workers):
+        """
+        also cuts the torrent buckets of the session to the share of the coordinator
+        :return: tuple: (download rate, upload rate) of each worker, None for no limit
+        """
+        limits = self._session.limits
+        torrent_download_rate = _share(limits.torrent_download_rate, workers)
+        torrent_upload_rate = _share(limits.torrent_upload_rate, workers)
+        self._session.download_bucket.set_rate(torrent_download_rate)
+        self._session.upload_bucket.set_rate(torrent_upload_rate)
+        return (
+            _tighter(limits.download_bucket.rate, torrent_download_rate),
+            _tighter(limits.upload_bucket.rate, torrent_upload_rate)
+        )
+
+    def _update_worker_rates(self):
+        # a worker of any torrent started or stopped, the shares of the global rates changed
+        download_rate, upload_rate = self._worker_rates(len(self._workers))
+        for worker in list(self._workers):
+            self._send(worker, ('rates', download_rate, upload_rate))
+
+    def _slot_view(self, slot, piece_index):
+        start = slot * self._slot_size
+        return self._shared_memory.buf[start: start + self._session.piece_size(piece_index)]
+
+    def _send(self, worker, message):
+        try:
+            worker.connection.send(message)
+        except (BrokenPipeError, OSError):
+            self._drop_worker(worker)
+
+    def _on_messages(self, worker):
+        try:
+            while worker.connection.poll():
+                self._handle_message(worker, worker.connection.recv())
+        except (EOFError, OSError):
+            self._drop_worker(worker)
+
+    def _handle_message(self, worker, message):
+        kind = message[0]
+        piece_picker = self._session.piece_picker
+        if kind == 'need':
+            self._lease(worker, message[1], message[2])
+        elif kind == 'bitfield':
+            if message[2] > 0:
+                piece_picker.add_bitfield(message[1])
+            else:
+                piece_picker.remove_bitfield(message[1])
+        elif kind == 'seed':
+            if message[1] > 0:
+                piece_picker.add_seed()
+            else:
+                piece_picker.remove_seed()
+        elif kind == 'haves':
+            for piece_index in message[1]:
+                piece_picker.add_have(piece_index)
+        elif kind == 'done':
+            piece_index = message[1]
+            worker.leases.discard(piece_index)
+            slot_view = self._slot_view(self._slot_of_piece[piece_index], piece_index)
+            asyncio.ensure_future(self._session.add_verified_piece(piece_index, slot_view))
+        elif kind == 'failed':
+            self._hash_failures.inc()
+            print(f'{20*"#"} piece {message[1]} failed the hash check in worker {worker.worker_id} {20*"#"}')
+        elif kind == 'transfer':
+            self._session.count_worker_transfer(message[1], message[2])
+        elif kind == 'ban':
+            self._session.ban_peer(message[1])
+        elif kind == 'return':
+            for piece_index in message[1]:
+                worker.leases.discard(piece_index)
+                self.release_slot(piece_index)
+                self._session.return_leased_piece(piece_index)
+
+    def _lease(self, worker, count, availability):
+        """
+        hands out up to count of the rarest pieces the peers of the worker have, every piece with a free slot
+        """
+        piece_picker = self._session.piece_picker
+        bitfield = bitstring.Bits(bytes=availability)
+        leases = []
+        while len(leases) < count and self._free_slots:
+            piece_index = piece_picker.pick(bitfield)
+            if piece_index is None:
+                break
+            slot = self._free_slots.pop()
+            self._slot_of_piece[piece_index] = slot
+            self._session.lease_piece(piece_index)
+            worker.leases.add(piece_index)
+            leases.append((piece_index, slot))
+        self._send(worker, ('lease', leases, piece_picker.pickable_count() == 0))
+
+    def _drop_worker(self, worker):
+        if worker not in self._workers:
+            return
+        self._workers.remove(worker)
+        asyncio.get_running_loop().remove_reader(worker.connection.fileno())
+        worker.connection.close()
+        self._session.limits.release_connections(worker.connections)
+        self._session.limits.add_worker_processes(-1)
+        # whatever the worker did not finish is picked again
+        for piece_index in worker.leases:
+            self.release_slot(piece_index)
+            self._session.return_leased_piece(piece_index)
+        worker.leases.clear()
+
+
+def _share(torrent_rate, workers):
+    # the coordinator keeps a share of the torrent rate for the peers that connect to it
+    return torrent_rate / (workers + 1) if torrent_rate else None
+
+
+def _tighter(global_rate, torrent_rate):
+    # a worker only runs one torrent, the tighter of its share of the two limits applies
+    rates = [rate for rate in (global_rate, torrent_rate) if rate]
+    return min(rates) if rates else None
+
+
+def run_worker(connection, torrent_info, shared_memory_name, slot_size, have_bitfield,
+               download_rate, upload_rate, peer_download_rate, peer_upload_rate, target_connections, seed):
+    # ctrl-c reaches the whole process group, the coordinator stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker_session = WorkerSession(
+        connection, torrent_info, shared_memory_name, slot_size, have_bitfield,
+        download_rate, upload_rate, peer_download_rate, peer_upload_rate, target_connections, seed
+    )
+    asyncio.run(worker_session.run())
+
+
+class AvailabilityForwarder:
+    """
+    Takes the place of the piece picker inside a worker: counts which pieces the peers of the worker
+    have and forwards every change to the coordinator, whose picker sees the availability of all workers.
+    Bitfields go out right away, haves are batched. Pending haves are flushed before any removal, the
+    coordinator must never see a peer's pieces removed before they were added.
+    """
+
+    def __init__(self, amount_of_pieces, send):
+        self.amount_of_pieces = amount_of_pieces
+        self._send = send
+        self._counts = array('I', bytes(4 * amount_of_pieces))
+        # the pieces at least one peer of the worker has, sent along with every request for work
+        self.union_bitfield = bytearray((amount_of_pieces + 7) // 8)
+        self._pending_haves = []
+        # peers of the worker that sent have all
+        self._seeds = 0
+
+    def add_have(self, piece_index):
+        self._change(piece_index, 1)
+        self._pending_haves.append(piece_index)
+
+    def add_bitfield(self, bitfield_bytes):
+        if not self._change_all(bitfield_bytes, 1):
+            return
+        self._send(('bitfield', bitfield_bytes, 1))
+
+    def remove_bitfield(self, bitfield_bytes):
+        if not self._change_all(bitfield_bytes, -1):
+            return
+        self.flush()
+        self._send(('bitfield', bitfield_bytes, -1))
+
+    def add_seed(self):
+        self._seeds += 1
+        self.flush()
+        self._send(('seed', 1))
+
+    def remove_seed(self):
+        if self._seeds > 0:
+            self._seeds -= 1
+            self.flush()
+            self._send(('seed', -1))
+
+    def lease_bitfield(self):
+        """
+        :return: the pieces at least one peer of the worker has, everything while a seed is connected
+        """
+        if self._seeds:
+            return b'\xff' * len(self.union_bitfield)
+        return bytes(self.union_bitfield)
+
+    def flush(self):
+        if self._pending_haves:
+            self._send(('haves', self._pending_haves))
+            self._pending_haves = []
+
+    def _change_all(self, bitfield_bytes, delta):
+        changed = False
+        for piece_index in bitfield_indices(bitfield_bytes, self.amount_of_pieces):
+            self._change(piece_index, delta)
+            changed = True
+        return changed
+
+    def _change(self, piece_index, delta):
+        count = self._counts[piece_index] + delta
+        if count < 0:
+            return
+        self._counts[piece_index] = count
+        mask = 0x80 >> (piece_index % 8)
+        if count:
+            self.union_bitfield[piece_index // 8] |= mask
+        else:
+            self.union_bitfield[piece_index // 8] &= ~mask & 0xff
+
+
+class WorkerSession(SessionBase):
+    """
+    The part of a torrent that runs in a worker process, offers what Peer, ConnectionManager and Choker
+    expect from a TorrentSession. Pieces come from leases of the coordinator and are verified here,
+    uploads are served from the files the coordinator writes.
+    """
+
+    def __init__(self, connection, torrent_info, shared_memory_name, slot_size, have_bitfield,
+                 download_rate, upload_rate, peer_download_rate, peer_upload_rate, target_connections, seed):
+        self._connection = connection
+        self._torrent_info = torrent_info
+        self._shared_memory = shared_memory.SharedMemory(name=shared_memory_name)
+        self._slot_size = slot_size
+        self.seed = seed
+        self.info_hash = torrent_info.info_hash
+        self.amount_of_pieces = torrent_info.amount_of_pieces
+        self.limits = GlobalLimits(
+            max_connections=target_connections,
+            download_rate=download_rate,
+            upload_rate=upload_rate,
+            peer_download_rate=peer_download_rate,
+            peer_upload_rate=peer_upload_rate
+        )
+        self.download_bucket, self.upload_bucket = self.limits.torrent_buckets()
+        self.metrics = Metrics()
+        self.block_latency = self.metrics.histogram('block_latency_seconds', 'time from sending a request to receiving the block')
+        self.downloaded_counter = self.metrics.counter('downloaded_bytes_total', 'bytes of blocks received')
+        self.uploaded_counter = self.metrics.counter('uploaded_bytes_total', 'bytes of blocks sent')
+        self.uploaded_bytes = 0
+        self._reported_downloaded = 0
+        self._reported_uploaded = 0
+        self._have = bytearray(have_bitfield)
+        self._have_count = sum(1 for _ in bitfield_indices(self._have, self.amount_of_pieces))
+        # only used to read blocks for uploads, the coordinator does the writing
+        self.file_saver = FileSaver(
+            torrent_info.files_info,
+            torrent_info.piece_length,
+            self.amount_of_pieces,
+            # files are opened on the first upload from them, the coordinator creates the ones it downloads
+            skipped_files=range(len(torrent_info.files_info))
+        )
+        self.piece_picker = AvailabilityForwarder(self.amount_of_pieces, self._send)
+        # leased pieces no peer started yet, oldest first
+        self._leased = []
+        # piece-index -> when a leased piece that is not started yet arrived
+        self._leased_at = {}
+        # piece-index -> slot of every piece the worker holds
+        self._slots = {}
+        self._in_progress_pieces = {}
+        # (piece-index, byte-offset) -> peers with an outstanding request for the block
+        self._block_requests = {}
+        self._waiting_for_lease = False
+        self._last_lease_request = 0.0
+        self._last_lease_empty = False
+        # the coordinator has nothing left to lease, remaining pieces are in progress somewhere
+        self._no_more_work = False
+        self._hashing_tasks = set()
+        self._stopped = asyncio.Event()
+        self.connection_manager = ConnectionManager(
+            self,
+            target_connections=target_connections,
+            connect_slots=self.limits.connect_slots
+        )
+        self.choker = Choker(self)
+        self.smart_ban = SmartBan()
+        self.private = torrent_info.private
+        self.peer_exchange = PeerExchange(self)
+        self.add_peers = self.connection_manager.add_peers
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self._connection.fileno(), self._on_messages)
+        self.connection_manager.start()
+        choker_task = asyncio.ensure_future(self.choker.run())
+        report_task = asyncio.ensure_future(self._report_periodically())
+        pex_task = None if self.private else asyncio.ensure_future(self.peer_exchange.run())
+        try:
+            await self._stopped.wait()
+        finally:
+            choker_task.cancel()
+            report_task.cancel()
+            if pex_task is not None:
+                pex_task.cancel()
+            await self.connection_manager.stop()
+            loop.remove_reader(self._connection.fileno())
+            self.file_saver.finish()
+            for piece in list(self._in_progress_pieces.values()) + self._leased:
+                piece.detach_buffer()
+            self._shared_memory.close()
+            self._connection.close()
+
+    def _send(self, message):
+        try:
+            self._connection.send(message)
+        except (BrokenPipeError, OSError):
+            # the coordinator is gone, nothing this worker downloads can be saved
+            self._stopped.set()
+
+    def _on_messages(self):
+        try:
+            while self._connection.poll():
+                self._handle_message(self._connection.recv())
+        except (EOFError, OSError):
+            self._stopped.set()
+
+    def _handle_message(self, message):
+        kind = message[0]
+        if kind == 'lease':
+            self._on_lease(message[1], message[2])
+        elif kind == 'have':
+            self._on_have(message[1])
+        elif kind == 'peers':
+            self.connection_manager.add_peers(message[1])
+        elif kind == 'ban':
+            self.connection_manager.ban(message[1])
+        elif kind == 'rates':
+            self.limits.download_bucket.set_rate(message[1])
+            self.limits.upload_bucket.set_rate(message[2])
+        elif kind == 'stop':
+            self._stopped.set()
+
+    async def _report_periodically(self):
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            self.piece_picker.flush()
+            self._return_stranded_pieces()
+            downloaded = self.downloaded_counter.value
+            uploaded = self.uploaded_counter.value
+            if downloaded != self._reported_downloaded or uploaded != self._reported_uploaded:
+                self._send(('transfer', downloaded - self._reported_downloaded, uploaded - self._reported_uploaded))
+                self._reported_downloaded = downloaded
+                self._reported_uploaded = uploaded
+
+    def _return_stranded_pieces(self):
+        """
+        gives pieces back to the coordinator once none of the peers of this worker has them (they
+        disconnected), another worker may get them. leased pieces nobody started within LEASE_TIMEOUT go back
+        too. blocks already received for a started piece are dropped with it
+        """
+        now = time.monotonic()
+        peers = self.connection_manager.active_peers()
+
+        def stranded(piece):
+            return not any(peer.bitfield[piece.index] for peer in peers)
+        stale = [
+            piece for piece in self._leased
+            if now - self._leased_at[piece.index] > LEASE_TIMEOUT or stranded(piece)
+        ]
+        for piece in stale:
+            self._leased.remove(piece)
+            del self._leased_at[piece.index]
+        # a complete piece is being hashed, it is reported either way
+        started = [piece for piece in self._in_progress_pieces.values() if not piece.complete() and stranded(piece)]
+        for piece in started:
+            del self._in_progress_pieces[piece.index]
+            for byte_offset, _ in piece.requested_blocks():
+                self._block_requests.pop((piece.index, byte_offset), None)
+        if not stale and not started:
+            return
+        for piece in stale + started:
+            del self._slots[piece.index]
+            piece.detach_buffer()
+        self._send(('return', [piece.index for piece in stale + started]))
+        self._request_lease()
+
+    def _request_lease(self):
+        free_slots = SLOTS_PER_WORKER - len(self._slots)
+        if self._waiting_for_lease or len(self._leased) >= LEASE_LOW_WATER or free_slots <= 0:
+            return
+        if self._last_lease_empty and time.monotonic() - self._last_lease_request < LEASE_RETRY_INTERVAL:
+            return
+        # haves first so the coordinator can pick from pieces it only just learned about
+        self.piece_picker.flush()
+        self._waiting_for_lease = True
+        self._last_lease_request = time.monotonic()
+        self._send(('need', free_slots, self.piece_picker.lease_bitfield()))
+
+    def _on_lease(self, leases, no_more_work):
+        self._waiting_for_lease = False
+        self._last_lease_empty = not leases
+        self._no_more_work = no_more_work
+        for piece_index, slot in leases:
+            piece = Piece(piece_index, self.piece_size(piece_index))
+            start = slot * self._slot_size
+            piece.attach_buffer(self._shared_memory.buf[start: start + piece.piece_length])
+            self._slots[piece_index] = slot
+            self._leased.append(piece)
+            self._leased_at[piece_index] = time.monotonic()
+        if leases or no_more_work:
+            self._resume_peers()
+        else:
+            asyncio.get_running_loop().call_later(LEASE_RETRY_INTERVAL, self._resume_peers)
+
+    def _resume_peers(self):
+        for peer in self.connection_manager.active_peers():
+            peer.resume_requests()
+
+    def _on_have(self, piece_index):
+        mask = 0x80 >> (piece_index % 8)
+        if self._have[piece_index // 8] & mask:
+            return
+        self._have[piece_index // 8] |= mask
+        self._have_count += 1
+        for peer in self.connection_manager.active_peers():
+            peer.send_have(piece_index)
+
+    def complete(self):
+        return self._have_count == self.amount_of_pieces
+
+    def finished(self):
+        return self._stopped.is_set() or (self.complete() and not self.seed)
+
+    def listen_port(self):
+        # workers only make outgoing connections
+        return None
+
+    def have_bitfield(self):
+        return bytes(self._have)
+
+    def can_serve(self, piece_index, byte_offset, length):
+        if piece_index >= self.amount_of_pieces or not self._have[piece_index // 8] & (0x80 >> (piece_index % 8)):
+            return False
+        return 0 < length <= BLOCK_SIZE and byte_offset + length <= self.piece_size(piece_index)
+
+    def more_work_expected(self):
+        # peers stay connected while the coordinator may still lease work to this worker
+        return not self._no_more_work and not self.complete()
+
+    def fetch_work(self, bitfield):
+        for piece in self._in_progress_pieces.values():
+            if bitfield[piece.index] and piece.has_unrequested_blocks():
+                return piece
+        for piece in self._leased:
+            if bitfield[piece.index]:
+                self._leased.remove(piece)
+                del self._leased_at[piece.index]
+                self._in_progress_pieces[piece.index] = piece
+                self._request_lease()
+                return piece
+        self._request_lease()
+        return None
+
+    def fetch_piece(self, piece_index):
+        # only pieces leased to this worker can be worked on
+        piece = self._in_progress_pieces.get(piece_index)
+        if piece is not None:
+            return piece if piece.has_unrequested_blocks() else None
+        for piece in self._leased:
+            if piece.index == piece_index:
+                self._leased.remove(piece)
+                del self._leased_at[piece_index]
+                self._in_progress_pieces[piece_index] = piece
+                return piece
+        return None
+
+    def piece_in_progress(self, piece_index):
+        return self._in_progress_pieces.get(piece_index)
+
+    def endgame_block(self, peer):
+        """
+        endgame inside the worker once the coordinator has nothing left to lease, duplicates are only
+        requested from the peers of this worker. leased pieces a peer could start are handed out
+        by fetch_work before this runs
+        """
+        if not self._no_more_work:
+            return None
+        return self._duplicate_block(peer, list(self._in_progress_pieces))
+
+    async def on_piece_complete(self, piece_index):
+        for peer in self.connection_manager.active_peers():
+            peer.active_pieces.pop(piece_index, None)
+        hashing_task = asyncio.ensure_future(self._verify_piece(piece_index))
+        self._hashing_tasks.add(hashing_task)
+        hashing_task.add_done_callback(self._hashing_tasks.discard)
+
+    async def _verify_piece(self, piece_index):
+        piece = self._in_progress_pieces[piece_index]
+        piece_hash = await self._run_hashing(piece_digest, piece.dump())
+        if not await self._check_piece(piece, piece_hash):
+            piece.reset()
+            self._send(('failed', piece_index))
+            self._resume_peers()
+            return
+        del self._in_progress_pieces[piece_index]
+        del self._slots[piece_index]
+        piece.detach_buffer()
+        self._send(('done', piece_index))
+
+    async def _run_hashing(self, function, *args):
+        return await asyncio.to_thread(function, *args)
+
+    def ban_peer(self, ip):
+        # the coordinator bans the ip in every worker, this one included
+        self.connection_manager.ban(ip)
+        self._send(('ban', ip))
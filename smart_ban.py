@@ -0,0 +1,76 @@
+from collections import Counter
+from hashlib import sha1
+from piece import BLOCK_SIZE
+
+# a peer is banned once its share of failed pieces adds up to this, a piece it sent alone counts as 1
+MAX_HASH_FAILURE_SCORE = 2.0
+
+
+class SmartBan:
+    """
+    Finds the peers that send bad data. Every block of a piece remembers the ip it came from.
+    A piece that fails the hash check adds the share of its blocks each peer sent to that peer's score,
+    and the digest of every block is kept. Once the piece passes, the kept digests are compared to the
+    good blocks: a peer whose block differs sent bad data for sure and is banned right away, the peers
+    whose blocks were all fine get their share back. A score reaching MAX_HASH_FAILURE_SCORE bans too,
+    which catches a peer that keeps sending whole pieces on its own.
+    """
+
+    def __init__(self):
+        # ip -> sum of the shares of failed pieces
+        self.scores = {}
+        # piece-index -> block lists (see block_digests) of every failed attempt at the piece
+        self._failed_attempts = {}
+
+    def piece_failed(self, piece_index, blocks):
+        """
+        :param blocks: block_digests of the piece that failed
+        :return: list of ips to ban
+        """
+        self._failed_attempts.setdefault(piece_index, []).append(blocks)
+        to_ban = []
+        for ip, count in _blocks_per_source(blocks).items():
+            score = self.scores.get(ip, 0.0) + count / len(blocks)
+            self.scores[ip] = score
+            if score >= MAX_HASH_FAILURE_SCORE:
+                to_ban.append(ip)
+        return to_ban
+
+    def has_suspects(self, piece_index):
+        return piece_index in self._failed_attempts
+
+    def piece_passed(self, piece_index, blocks):
+        """
+        :param blocks: block_digests of the piece that passed, only needed when has_suspects
+        :return: list of ips to ban
+        """
+        good_digests = {byte_offset: digest for byte_offset, digest, _ in blocks}
+        to_ban = set()
+        for failed_blocks in self._failed_attempts.pop(piece_index, ()):
+            guilty = {ip for byte_offset, digest, ip in failed_blocks if good_digests.get(byte_offset) != digest}
+            to_ban.update(guilty)
+            for ip, count in _blocks_per_source(failed_blocks).items():
+                if ip not in guilty and ip in self.scores:
+                    self.scores[ip] = max(0.0, self.scores[ip] - count / len(failed_blocks))
+        to_ban.discard(None)
+        return list(to_ban)
+
+    def forget_piece(self, piece_index):
+        # the piece was verified some other way (a worker process), its failed attempts cannot be compared
+        self._failed_attempts.pop(piece_index, None)
+
+
+def block_digests(piece):
+    """
+    runs on a hashing thread
+    :return: list of (byte-offset, sha1 of the block, ip of the peer that sent it) of every received block
+    """
+    sources = piece.block_sources()
+    return [
+        (byte_offset, sha1(block).digest(), sources[byte_offset // BLOCK_SIZE])
+        for byte_offset, block in piece.received_blocks()
+    ]
+
+
+def _blocks_per_source(blocks):
+    return Counter(ip for _, _, ip in blocks if ip is not None)
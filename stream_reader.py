@@ -0,0 +1,81 @@
+import asyncio
+import os
+
+# bytes past the read position that are downloaded before any other piece
+DEFAULT_READ_AHEAD = 16 * 2 ** 20
+
+
+class StreamClosedError(Exception):
+    # the torrent stopped before the pieces a read was waiting for arrived
+    pass
+
+
+class FileStream:
+    """
+    Reads one file of a torrent while it is still downloading. A read waits until the pieces it covers
+    are verified and on disk, and moves the stream's read head: the pieces from the head up to read_ahead
+    bytes past it are picked before any other piece.
+    Iterating over the stream yields the file from the start in chunks of one piece length.
+    """
+
+    def __init__(self, torrent_session, path, torrent_offset, length, piece_length, read_ahead=DEFAULT_READ_AHEAD):
+        """
+        :param torrent_offset: absolute offset of the first byte of the file inside the torrent
+        """
+        self._session = torrent_session
+        self._torrent_offset = torrent_offset
+        self.path = path
+        self.length = length
+        self._piece_length = piece_length
+        self._read_ahead_pieces = max(1, -(-read_ahead // self._piece_length))
+        self._file = open(path, 'rb')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        offset = 0
+        while offset < self.length:
+            data = await self.read(offset, self._piece_length)
+            offset += len(data)
+            yield data
+
+    async def read(self, offset, length):
+        """
+        :return: bytes of the file from offset on, shorter than length only at the end of the file
+        """
+        length = min(length, self.length - offset)
+        if length <= 0:
+            return b''
+        absolute_offset = self._torrent_offset + offset
+        first_piece = absolute_offset // self._piece_length
+        last_piece = (absolute_offset + length - 1) // self._piece_length
+        self._session.set_stream_window(self, first_piece, last_piece + self._read_ahead_pieces)
+        for piece_index in range(first_piece, last_piece + 1):
+            await self._session.wait_for_piece(piece_index)
+        return await asyncio.to_thread(self._read_at, offset, length)
+
+    def _read_at(self, offset, length):
+        if not hasattr(os, 'pread'):
+            self._file.seek(offset)
+            return self._file.read(length)
+        chunks = []
+        fd = self._file.fileno()
+        while length > 0:
+            chunk = os.pread(fd, length, offset)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+            length -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        self._session.remove_stream_window(self)
+        self._file.close()
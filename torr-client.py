@@ -1,20 +1,116 @@
+import argparse
 import asyncio
-from sys import argv
 from torrent import Torrent
-from torrent_session import TorrentSession
+from session_manager import SessionManager
+from metrics import Metrics, MetricsServer
+from buffer_pool import DEFAULT_MEMORY_BUDGET
+from piece_picker import PRIORITY_NAMES, PRIORITY_NORMAL
+from global_limits import GlobalLimits, DEFAULT_MAX_CONNECTIONS, DEFAULT_DISK_QUEUE_DEPTH
 from datetime import datetime
 
 
-if __name__ == '__main__':
-    torrent_info = Torrent(argv[1])
-    torrent_info.print_torrent_info()
-    torrent_session = TorrentSession(torrent_info)
+def parse_args():
+    parser = argparse.ArgumentParser(description='BitTorrent client')
+    parser.add_argument('torrent_files', nargs='*', metavar='torrent_file', help='path/to/file.torrent')
+    parser.add_argument('--watch', metavar='FOLDER',
+                        help='run as a daemon: download every .torrent file put into FOLDER, deleting the file stops it')
+    parser.add_argument('--seed', action='store_true', help='keep uploading after the download is complete')
+    parser.add_argument('--memory-budget', type=int, default=DEFAULT_MEMORY_BUDGET // 2 ** 20,
+                        help='MiB of piece buffers kept in memory at most per torrent (default: %(default)s)')
+    parser.add_argument('--max-connections', type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help='peer connections for all torrents together (default: %(default)s)')
+    parser.add_argument('--download-limit', type=int, help='KiB/s for all torrents together')
+    parser.add_argument('--upload-limit', type=int, help='KiB/s for all torrents together')
+    parser.add_argument('--torrent-download-limit', type=int, help='KiB/s for each torrent')
+    parser.add_argument('--torrent-upload-limit', type=int, help='KiB/s for each torrent')
+    parser.add_argument('--peer-download-limit', type=int, help='KiB/s for each peer connection')
+    parser.add_argument('--peer-upload-limit', type=int, help='KiB/s for each peer connection')
+    parser.add_argument('--disk-queue', type=int, default=DEFAULT_DISK_QUEUE_DEPTH,
+                        help='pieces waiting to be written for all torrents together (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='worker processes for the peer connections of each torrent (default: %(default)s, all in one)')
+    parser.add_argument('--sequential', action='store_true',
+                        help='download the pieces in order so the files can be played while they download')
+    parser.add_argument('--file-priority', action='append', default=[], metavar='INDEX=PRIORITY',
+                        help='priority (skip, low, normal or high) of a file, by its index in the printed file list. '
+                             'applies to every torrent given, can be repeated')
+    parser.add_argument('--recheck', action='store_true',
+                        help='hash the data already on disk on all cores before downloading, instead of trusting the resume file')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve /metrics (Prometheus) and /metrics.json on localhost:PORT')
+    parser.add_argument('--metadata-cache', metavar='FOLDER',
+                        help='cache the parsed torrent files in FOLDER so unchanged ones load without decoding')
+    args = parser.parse_args()
+    if not args.torrent_files and not args.watch:
+        parser.error('give at least one torrent file or --watch')
+    args.file_priorities = {}
+    for file_priority in args.file_priority:
+        file_index, _, priority_name = file_priority.partition('=')
+        if not file_index.isdigit() or priority_name not in PRIORITY_NAMES:
+            parser.error(f'--file-priority takes INDEX=PRIORITY with one of {", ".join(PRIORITY_NAMES)}')
+        args.file_priorities[int(file_index)] = PRIORITY_NAMES[priority_name]
+    return args
+
+
+def file_priorities_for(torrent_info, priorities_by_index):
+    """
+    :return: list with a priority for every file of the torrent or None if none was given
+    """
+    if not priorities_by_index:
+        return None
+    return [priorities_by_index.get(file_index, PRIORITY_NORMAL) for file_index in range(len(torrent_info.files_info))]
+
+
+def kib_to_bytes(kib):
+    return kib * 1024 if kib else None
 
+
+async def run(args):
+    limits = GlobalLimits(
+        max_connections=args.max_connections,
+        download_rate=kib_to_bytes(args.download_limit),
+        upload_rate=kib_to_bytes(args.upload_limit),
+        disk_queue_depth=args.disk_queue,
+        torrent_download_rate=kib_to_bytes(args.torrent_download_limit),
+        torrent_upload_rate=kib_to_bytes(args.torrent_upload_limit),
+        peer_download_rate=kib_to_bytes(args.peer_download_limit),
+        peer_upload_rate=kib_to_bytes(args.peer_upload_limit)
+    )
+    metrics = Metrics()
+    session_manager = SessionManager(
+        limits,
+        seed=args.seed,
+        memory_budget=args.memory_budget * 2 ** 20,
+        metrics=metrics,
+        workers=args.workers,
+        sequential=args.sequential,
+        recheck=args.recheck
+    )
+    await session_manager.start()
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = MetricsServer(metrics, args.metrics_port)
+        await metrics_server.start()
+    try:
+        for torrent_file in args.torrent_files:
+            torrent_info = Torrent(torrent_file, args.metadata_cache)
+            torrent_info.print_torrent_info()
+            session_manager.add_torrent(torrent_info, file_priorities_for(torrent_info, args.file_priorities))
+        if args.watch:
+            await session_manager.watch_folder(args.watch, args.metadata_cache)
+        else:
+            await session_manager.wait_until_done()
+    finally:
+        if metrics_server is not None:
+            metrics_server.stop()
+        await session_manager.stop()
+
+
+if __name__ == '__main__':
     start_time = datetime.now()
-    asyncio.run(torrent_session.start_session())
+    asyncio.run(run(parse_args()))
     end_date_time = datetime.now() - start_time
     hours = end_date_time.seconds // (60 * 60)
     minutes = end_date_time.seconds // 60
     seconds = end_date_time.seconds % 60
     print(f'finished in {hours} hours, {minutes} minutes and {seconds} seconds')
-
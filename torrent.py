@@ -1,68 +1,144 @@
+import os
 from hashlib import sha1
 import time
-from bencode import bencode, bdecode
-import bencodepy
+from bencoding import Decoder, BencodeError
+from metadata_cache import load_metadata, store_metadata
+
+HASH_LENGTH = 20
+
+
+class PieceHashes:
+    """
+    The concatenated piece hashes kept as one bytes object, indexing returns a 20 byte view into it
+    instead of every hash being an object of its own
+    """
+
+    def __init__(self, concatenated_hashes):
+        self._hashes = bytes(concatenated_hashes)
+        self._view = memoryview(self._hashes)
+
+    def __len__(self):
+        return len(self._hashes) // HASH_LENGTH
+
+    def __getitem__(self, piece_index):
+        if not 0 <= piece_index < len(self):
+            raise IndexError('piece index out of range')
+        return self._view[piece_index * HASH_LENGTH: (piece_index + 1) * HASH_LENGTH]
+
+    def __getstate__(self):
+        # memoryviews cannot be pickled, worker processes get the bytes and make their own view
+        return self._hashes
+
+    def __setstate__(self, concatenated_hashes):
+        self.__init__(concatenated_hashes)
+
+    def __bytes__(self):
+        return self._hashes
 
 
 class Torrent:
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, cache_dir=None):
+        """
+        :param cache_dir: folder for the parsed metadata of torrent files, a torrent file that was not
+            changed since it was cached is loaded without decoding it again
+        """
         self.info_hash: bytes = b''
         self.tracker_urls = []
         self.piece_length: int = 0
         self.total_torrent_length: int
-        self.piece_hashes = []
+        self.piece_hashes = PieceHashes(b'')
         self.my_peer_id: bytes = b''
         self.amount_of_pieces = 0
         self.files_info = []  # list of dicts: {name: str, length: int)
-        self._load_torrent_info(file_path)
+        # private torrents (BEP 27) only get peers from their trackers
+        self.private = False
+        self._load_torrent_info(file_path, cache_dir)
     
     def _bad_torrent_file(self, reason: str):
         print("Faulty torrent file provided. Reason:")
         print('\033[91m\t' + reason + '\033[0m')
         exit(0)
 
-    def _load_torrent_info(self, file_path):
+    def _load_torrent_info(self, file_path, cache_dir):
         if not file_path.endswith('.torrent'):
             self._bad_torrent_file('file provided does not end in .torrent')
+        if cache_dir is not None and self._load_cached_metadata(cache_dir, file_path):
+            self._set_peer_id()
+            return
+        torrent_stat = os.stat(file_path)
         with open(file_path, 'rb') as torrent_file:
-            try:
-                decoded_data = bdecode(torrent_file.read())
-            except bencodepy.exceptions.BencodeDecodeError:
-                self._bad_torrent_file('Torrent file must be encoded using the bencoding format.')
-
-        if 'info' not in decoded_data:
+            encoded_data = torrent_file.read()
+        # the span of the info dict is kept so it is hashed exactly as it was encoded
+        decoder = Decoder(encoded_data, span_keys=(b'info',))
+        try:
+            decoded_data = decoder.decode()
+        except BencodeError:
+            self._bad_torrent_file('Torrent file must be encoded using the bencoding format.')
+
+        if not isinstance(decoded_data, dict) or not isinstance(decoded_data.get(b'info'), dict):
             self._bad_torrent_file('torrent file provided does not contain the info dictionary.')
-        if 'announce' not in decoded_data:
+        if b'announce' not in decoded_data:
             self._bad_torrent_file('torrent file does not contain any trackers')
 
-        self._load_piece_length(decoded_data['info'])
+        self._load_piece_length(decoded_data[b'info'])
         self._load_tracker_url(decoded_data)
-        self._load_files_info_dict(decoded_data['info'])
+        self._load_files_info_dict(decoded_data[b'info'])
         self._load_total_torrent_size()
-        self._load_piece_hashes(decoded_data['info'])
+        self._load_piece_hashes(decoded_data[b'info'])
         self._load_pieces_amount()
-        self._set_info_hash(decoded_data['info'])
+        self.private = decoded_data[b'info'].get(b'private') == 1
+        self._set_info_hash(encoded_data, decoder.spans[b'info'])
         self._set_peer_id()
+        if cache_dir is not None:
+            store_metadata(cache_dir, file_path, torrent_stat, self._metadata(), bytes(self.piece_hashes))
+
+    def _metadata(self):
+        # everything but the piece hashes and the peer id, stored as json in the metadata cache
+        return {
+            'info_hash': self.info_hash.hex(),
+            'tracker_urls': self.tracker_urls,
+            'piece_length': self.piece_length,
+            'files_info': self.files_info,
+            'private': self.private,
+        }
+
+    def _load_cached_metadata(self, cache_dir, file_path):
+        """
+        :return: True if the metadata came from the cache
+        """
+        cached = load_metadata(cache_dir, file_path)
+        if cached is None:
+            return False
+        metadata, concatenated_piece_hashes = cached
+        self.info_hash = bytes.fromhex(metadata['info_hash'])
+        self.tracker_urls = metadata['tracker_urls']
+        self.piece_length = metadata['piece_length']
+        self.files_info = metadata['files_info']
+        self.private = metadata.get('private', False)
+        self._load_total_torrent_size()
+        self.piece_hashes = PieceHashes(concatenated_piece_hashes)
+        self._load_pieces_amount()
+        return True
 
     def _load_piece_length(self, info_dict):
-        if 'piece length' not in info_dict:
+        if b'piece length' not in info_dict:
             self._bad_torrent_file('info dict does not contain piece length.')
-        self.piece_length = info_dict['piece length']
+        self.piece_length = info_dict[b'piece length']
 
     def _load_files_info_dict(self, info_dict):
-        if 'files' not in info_dict:
+        if b'files' not in info_dict:
             single_file_info = {
-                'length': info_dict['length'],
-                'path': info_dict['name'],
+                'length': info_dict[b'length'],
+                'path': _text(info_dict[b'name']),
             }
             self.files_info = [single_file_info]
             return
         files_info = []
         file_paths = self._parse_file_paths(info_dict)
         absolute_file_offset = 0
-        for file_path, file_info_dict in zip(file_paths, info_dict['files']):
-            file_length = file_info_dict['length']
+        for file_path, file_info_dict in zip(file_paths, info_dict[b'files']):
+            file_length = file_info_dict[b'length']
             file_info = {
                 'length': file_length,
                 'path': file_path,
@@ -78,15 +154,16 @@ class Torrent:
 
     def _load_tracker_url(self, decoded_torrent_file_data):
         self.tracker_urls = []
-        self.tracker_urls.append(decoded_torrent_file_data['announce'])
+        self.tracker_urls.append(_text(decoded_torrent_file_data[b'announce']))
         # many times a torrent file will contain a list of trackers
         # but this is optional
-        if 'announce-list' in decoded_torrent_file_data:
-            for url in decoded_torrent_file_data['announce-list']:
-                self.tracker_urls.append(url[0])
+        if b'announce-list' in decoded_torrent_file_data:
+            for url in decoded_torrent_file_data[b'announce-list']:
+                self.tracker_urls.append(_text(url[0]))
 
-    def _set_info_hash(self, info_dict):
-        self.info_hash = sha1(bencode(info_dict)).digest()
+    def _set_info_hash(self, encoded_data, info_span):
+        info_start, info_end = info_span
+        self.info_hash = sha1(memoryview(encoded_data)[info_start: info_end]).digest()
 
     def _load_pieces_amount(self):
         self.amount_of_pieces = len(self.piece_hashes)
@@ -96,22 +173,17 @@ class Torrent:
         self.my_peer_id = sha1(str(time.time()).encode('utf-8')).digest()
 
     def _load_piece_hashes(self, info_dict):
-        if 'pieces' not in info_dict:
+        if b'pieces' not in info_dict:
             self._bad_torrent_file('info dict does not contain the piece hashes.')
-        concatenated_piece_hashes = info_dict['pieces']
-        hash_len = 20
-        self.piece_hashes = [concatenated_piece_hashes[i: i + hash_len] for i in range(0, len(concatenated_piece_hashes), hash_len)]
-
-    def _parse_piece_hashes(self, concatenated_pieces_hashes):
-        return [concatenated_pieces_hashes[i: i + 20] for i in range(0, len(concatenated_pieces_hashes), 20)]
+        self.piece_hashes = PieceHashes(info_dict[b'pieces'])
 
     def _parse_file_paths(self, info_dict):
         file_paths = []
-        root_dir = info_dict['name']
-        for file in info_dict['files']:
+        root_dir = _text(info_dict[b'name'])
+        for file in info_dict[b'files']:
             file_path = root_dir
-            for path in file['path']:
-                file_path += '/' + path
+            for path in file[b'path']:
+                file_path += '/' + _text(path)
             file_paths.append(file_path)
         return file_paths
 
@@ -122,6 +194,11 @@ class Torrent:
         print('peer id: ', self.my_peer_id)
         print('amount of pieces: ', self.amount_of_pieces)
         print('total file(s) length: ', self.total_torrent_length)
-        for file in self.files_info:
-            print(file['path'], file['length'], 'B')
+        for file_index, file in enumerate(self.files_info):
+            print(file_index, file['path'], file['length'], 'B')
         print(100*'-', '\n')
+
+
+def _text(value):
+    # names and urls are utf-8 by convention, a broken one should not stop the download
+    return value.decode('utf-8', 'replace')
@@ -1,100 +1,737 @@
 import asyncio
 import os
-from peer import Peer
+import time
+from concurrent.futures import ThreadPoolExecutor
+from connection_manager import ConnectionManager
+from choker import Choker
+from pex import PeerExchange
+from smart_ban import SmartBan
+from recheck import recheck as recheck_torrent
+from buffer_pool import BufferPool, DEFAULT_MEMORY_BUDGET
+from global_limits import GlobalLimits
 from torrent import Torrent
 from file_saver import FileSaver
-from piece import Piece
-from hashlib import sha1
-from tracker import peer_gen
+from piece import Piece, BLOCK_SIZE
+from piece_picker import PiecePicker, bitfield_indices, PRIORITY_SKIP, PRIORITY_NORMAL
+from resume import resume_file_path, load_resume_file, snapshot_partial_pieces, write_resume_file
+from metrics import Metrics
+from shard import ShardCoordinator
+from session_base import SessionBase, piece_digest
+from stream_reader import FileStream, StreamClosedError, DEFAULT_READ_AHEAD
+from tracker import TrackerClient, DEFAULT_PORT
 
+HASHING_WORKERS = os.cpu_count() or 1
+# pieces waiting for or being hashed at once, a peer completing another piece waits for a slot
+MAX_PIECES_HASHING = 2 * HASHING_WORKERS
+# seconds between two saves of the resume file
+RESUME_SAVE_INTERVAL = 30
+# ports tried for accepting connections from other peers
+LISTEN_PORTS = range(DEFAULT_PORT, DEFAULT_PORT + 9)
+# states of a piece in the piece table
+PIECE_MISSING = 0
+PIECE_DOWNLOADING = 1
+PIECE_VERIFIED = 2
 
-class TorrentSession:
-    def __init__(self, torrent_info: Torrent):
+
+def timed_piece_digest(data):
+    """
+    :return: tuple: (digest, seconds spent hashing), timed on the hashing thread so waiting for it is left out
+    """
+    started = time.perf_counter()
+    digest = piece_digest(data)
+    return digest, time.perf_counter() - started
+
+
+async def read_incoming_handshake(reader, writer):
+    """
+    :return: the 68 byte handshake of a peer that connected to us or None
+    """
+    try:
+        return await asyncio.wait_for(reader.readexactly(68), timeout=10)
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+        writer.close()
+        return None
+
+
+class TorrentSession(SessionBase):
+    def __init__(
+            self,
+            torrent_info: Torrent,
+            seed=False,
+            memory_budget=DEFAULT_MEMORY_BUDGET,
+            limits=None,
+            listen=True,
+            metrics=None,
+            workers=0,
+            sequential=False,
+            file_priorities=None,
+            recheck=False
+    ):
+        """
+        :param seed: keep uploading to other peers after the download is complete
+        :param memory_budget: bytes of piece buffers (downloading, hashing and queued for disk) at most,
+            no new piece is started while it is used up
+        :param limits: GlobalLimits shared with other torrents in the same process
+        :param listen: accept incoming connections on a port of its own, off when a SessionManager
+            listens for every torrent
+        :param metrics: Metrics shared with other torrents in the same process
+        :param workers: processes the outgoing peer connections are spread over, 0 runs them all
+            on this event loop
+        :param sequential: download the pieces in order (with some read ahead) instead of rarest first
+        :param file_priorities: priority of every file in files_info (see piece_picker), all normal if None.
+            a piece gets the highest priority of the files it overlaps, skipped files are not downloaded
+        :param recheck: hash the data already on disk before downloading instead of trusting the resume file
+        """
         self._torrent_info = torrent_info
+        self.seed = seed
+        self.limits = limits or GlobalLimits()
+        # every peer bucket is nested under these, which are nested under the global ones
+        self.download_bucket, self.upload_bucket = self.limits.torrent_buckets()
+        self._listen = listen
+        self.metrics = metrics or Metrics()
+        # looked up once, they are updated on every block or piece
+        self.block_latency = self.metrics.histogram('block_latency_seconds', 'time from sending a request to receiving the block')
+        self.downloaded_counter = self.metrics.counter('downloaded_bytes_total', 'bytes of blocks received')
+        self.uploaded_counter = self.metrics.counter('uploaded_bytes_total', 'bytes of blocks sent')
+        self._pick_latency = self.metrics.histogram('piece_pick_seconds', 'time the piece picker takes to pick a piece')
+        self._hash_time = self.metrics.histogram('piece_hash_seconds', 'time spent hashing one piece')
+        self._hash_failures = self.metrics.counter('hash_failures_total', 'pieces that failed the hash check')
+        self._verified_counter = self.metrics.counter('pieces_verified_total', 'pieces that passed the hash check')
+        self._banned_counter = self.metrics.counter('banned_peers_total', 'peers banned for sending data that failed the hash check')
+        self.smart_ban = SmartBan()
+        self._pieces_hashing = 0
+        self.buffer_pool = BufferPool(torrent_info.piece_length, memory_budget)
+        self._memory_throttled = False
+        self._disk_slots_held = 0
         self.info_hash = self._torrent_info.info_hash
-        self.parts_folder_name = bytes.hex(self._torrent_info.info_hash)
+        self.resume_file_path = resume_file_path(self.info_hash)
         self._currently_downloading_peers = []
         self.amount_of_pieces = torrent_info.amount_of_pieces
-        self._unfinished_pieces = self._gen_pieces()
-        if os.path.exists(self.parts_folder_name):
-            self.serialize_saved_pieces()
-            self._completed_pieces = self.amount_of_pieces - len(self._unfinished_pieces)
-        else:
-            self._completed_pieces = 0
-            os.mkdir(self.parts_folder_name)
-        self._in_progress_pieces = set()
-        self.file_saver = FileSaver(self._torrent_info.files_info, self.amount_of_pieces, self.parts_folder_name)
+        # one byte per piece, a Piece object (and its buffer) only exists while the piece is downloading
+        self._piece_state = bytearray(self.amount_of_pieces)
+        # piece-index -> Piece for every piece that is downloading or waiting to be hashed
+        self._in_progress_pieces = {}
+        self._file_priorities = list(file_priorities) if file_priorities is not None \
+            else [PRIORITY_NORMAL] * len(torrent_info.files_info)
+        self.file_saver = FileSaver(
+            self._torrent_info.files_info,
+            self._torrent_info.piece_length,
+            self.amount_of_pieces,
+            on_piece_written=self._on_piece_written,
+            metrics=self.metrics,
+            skipped_files=self.skipped_files()
+        )
+        self.serialize_saved_pieces()
+        self._completed_pieces = self._piece_state.count(PIECE_VERIFIED)
+        # verified pieces still waiting for a disk slot, the download is only done once none are left
+        self._pieces_waiting_for_disk = 0
+        # (piece-index, byte-offset) -> peers with an outstanding request for the block
+        self._block_requests = {}
+        self._endgame = False
+        self._hash_executor = ThreadPoolExecutor(max_workers=HASHING_WORKERS)
+        self._hashing_slots = asyncio.Semaphore(MAX_PIECES_HASHING)
+        self._hashing_tasks = set()
+        # set once the session tears down, verifications finishing after that are dropped
+        self._stopping = False
+        # resume file write running on a thread, it outlives a cancelled save since it reads pinned buffers
+        self._resume_write = None
+        self.piece_picker = PiecePicker(self.amount_of_pieces, self._piece_priorities())
+        # pieces restored with some of their blocks are finished before new ones are started
+        self.piece_picker.add_unavailable(
+            [piece_index for piece_index, state in enumerate(self._piece_state) if state == PIECE_MISSING]
+        )
+        self._downloaded_bytes = 0
+        self.uploaded_bytes = 0
+        self._count_wanted_pieces_left()
+        self._completed_event = asyncio.Event()
+        # piece-index -> futures of streams waiting for the piece to be written
+        self._piece_waiters = {}
+        # stream (or the session itself in sequential mode) -> (first, last) pieces it wants next
+        self._stream_windows = {}
+        self._sequential = sequential
+        self._recheck = recheck
+        # lowest piece that is not verified yet, only followed in sequential mode
+        self._first_missing_piece = 0
+        if sequential:
+            self._move_sequential_window()
+        self.connection_manager = ConnectionManager(self, connect_slots=self.limits.connect_slots)
+        # with worker processes the session keeps the picker and the incoming connections only
+        self.shards = ShardCoordinator(self, torrent_info, workers) if workers > 0 else None
+        on_peers = self.shards.add_peers if self.shards is not None else self.connection_manager.add_peers
+        self.tracker_client = TrackerClient(self._torrent_info, on_peers, self._transfer_stats)
+        self.choker = Choker(self)
+        # private torrents (BEP 27) get their peers from the tracker only
+        self.private = torrent_info.private
+        self.peer_exchange = PeerExchange(self)
+        self.add_peers = on_peers
+        self._server = None
+        self._listen_port = None
+
+    def skipped_files(self):
+        return {file_index for file_index, priority in enumerate(self._file_priorities) if priority == PRIORITY_SKIP}
+
+    def _piece_priorities(self):
+        """
+        :return: bytearray with the priority of every piece, the highest of the files the piece overlaps
+        """
+        if len(set(self._file_priorities)) <= 1:
+            return bytearray([self._file_priorities[0] if self._file_priorities else PRIORITY_NORMAL]) \
+                * self.amount_of_pieces
+        piece_length = self._torrent_info.piece_length
+        piece_priorities = bytearray(self.amount_of_pieces)
+        file_start = 0
+        for file_info, priority in zip(self._torrent_info.files_info, self._file_priorities):
+            file_end = file_start + file_info['length']
+            if file_end > file_start:
+                first_piece = file_start // piece_length
+                last_piece = (file_end - 1) // piece_length
+                # only the first piece can be shared with an earlier file
+                shared_priority = piece_priorities[first_piece]
+                piece_priorities[first_piece: last_piece + 1] = bytes([priority]) * (last_piece - first_piece + 1)
+                piece_priorities[first_piece] = max(shared_priority, priority)
+            file_start = file_end
+        return piece_priorities
+
+    def _count_wanted_pieces_left(self):
+        # pieces (and their bytes) that are wanted and not verified yet, complete() once none are left
+        if PRIORITY_SKIP not in self._file_priorities:
+            self._wanted_pieces_left = self.amount_of_pieces - self._completed_pieces
+            completed_bytes = self._completed_pieces * self._torrent_info.piece_length
+            if self.amount_of_pieces and self._piece_state[-1] == PIECE_VERIFIED:
+                # the last piece is usually shorter
+                completed_bytes -= self._torrent_info.piece_length - self.piece_size(self.amount_of_pieces - 1)
+            self._bytes_left = self._torrent_info.total_torrent_length - completed_bytes
+            return
+        self._wanted_pieces_left = 0
+        self._bytes_left = 0
+        for piece_index in range(self.amount_of_pieces):
+            if self._piece_state[piece_index] != PIECE_VERIFIED and self.piece_picker.wanted(piece_index):
+                self._wanted_pieces_left += 1
+                self._bytes_left += self.piece_size(piece_index)
+
+    def set_file_priorities(self, file_priorities):
+        """
+        changes which files are downloaded and in which order, pieces that are already downloading are finished
+        """
+        self._file_priorities = list(file_priorities)
+        piece_picker = self.piece_picker
+        for piece_index, priority in enumerate(self._piece_priorities()):
+            if priority == piece_picker.priority(piece_index):
+                continue
+            piece_picker.set_priority(piece_index, priority)
+            if self._piece_state[piece_index] == PIECE_MISSING:
+                piece_picker.add(piece_index)
+        self._count_wanted_pieces_left()
+        if self._sequential:
+            self._first_missing_piece = 0
+            self._move_sequential_window()
+        if self.complete() and self._pieces_waiting_for_disk == 0:
+            self._completed_event.set()
+        for peer in self.connection_manager.active_peers():
+            peer.resume_requests()
 
     def serialize_saved_pieces(self):
-        for i in range(self.amount_of_pieces):
-            if os.path.exists(f'{self.parts_folder_name}/.{i}'):
-                self._unfinished_pieces.pop(i)
+        """
+        restores the completed pieces and the received blocks of partial pieces from the resume file
+        """
+        resume_state = load_resume_file(self.resume_file_path, self.info_hash, self.amount_of_pieces)
+        if resume_state is None:
+            return
+        completed_bitfield, partial_pieces = resume_state
+        self.file_saver.written_bitfield[:] = completed_bitfield
+        for i in bitfield_indices(completed_bitfield, self.amount_of_pieces):
+            self._piece_state[i] = PIECE_VERIFIED
+        for piece_index, piece_length, blocks in partial_pieces:
+            if self._piece_state[piece_index] != PIECE_MISSING or piece_length != self.piece_size(piece_index):
+                continue
+            piece = Piece(piece_index, piece_length)
+            piece.attach_buffer(self.buffer_pool.acquire(piece_length))
+            for byte_offset, data in blocks:
+                piece.put_data(byte_offset, data)
+            self._piece_state[piece_index] = PIECE_DOWNLOADING
+            self._in_progress_pieces[piece_index] = piece
 
-    def _gen_pieces(self):
-        pieces = {}
-        for i in range(self.amount_of_pieces - 1):
-            pieces[i] = Piece(i, self._torrent_info.piece_length)
+    async def recheck(self, workers=None, on_progress=print):
+        """
+        hashes every piece on disk (see recheck.py) and makes the result the set of completed pieces,
+        only valid before the download starts
+        :param on_progress: called with a RecheckProgress from the recheck thread
+        :return: amount of valid pieces
+        """
+        print(f'rechecking {self.amount_of_pieces} pieces of {bytes.hex(self.info_hash)}')
+        bitfield = await asyncio.to_thread(recheck_torrent, self._torrent_info, workers, on_progress)
+        piece_picker = self.piece_picker
+        for piece_index in range(self.amount_of_pieces):
+            valid = bool(bitfield[piece_index // 8] & (0x80 >> (piece_index % 8)))
+            state = self._piece_state[piece_index]
+            if valid and state != PIECE_VERIFIED:
+                if state == PIECE_DOWNLOADING:
+                    # blocks restored from the resume file, the piece on disk is complete already
+                    self.buffer_pool.release(self._in_progress_pieces.pop(piece_index).detach_buffer())
+                piece_picker.remove(piece_index)
+                self._piece_state[piece_index] = PIECE_VERIFIED
+            elif not valid and state == PIECE_VERIFIED:
+                self._piece_state[piece_index] = PIECE_MISSING
+                piece_picker.add(piece_index)
+        self.file_saver.written_bitfield[:] = bitfield
+        self._completed_pieces = self._piece_state.count(PIECE_VERIFIED)
+        self._count_wanted_pieces_left()
+        if self._sequential:
+            self._first_missing_piece = 0
+            self._move_sequential_window()
+        return self._completed_pieces
 
-        last_piece_size = self._torrent_info.total_torrent_length - (self.amount_of_pieces - 1) * self._torrent_info.piece_length
-        pieces[self.amount_of_pieces - 1] = Piece(self.amount_of_pieces - 1, last_piece_size)
-        return pieces
+    async def save_resume_state(self):
+        if self._resume_write is not None and not self._resume_write.done():
+            # the previous write uses the same temp file, it failing is reported where it was awaited
+            await asyncio.wait([self._resume_write])
+        # the bitfield is copied before syncing the files so it never covers data that is not on disk yet
+        completed_bitfield = bytes(self.file_saver.written_bitfield)
+        pieces = [piece for piece in self._in_progress_pieces.values() if piece.has_received_blocks()]
+        partial_pieces = snapshot_partial_pieces(pieces)
+        buffers = [piece.downloaded_blocks for piece in pieces]
+        self.buffer_pool.pin(buffers)
+        self._resume_write = asyncio.ensure_future(
+            asyncio.to_thread(self._persist_resume_state, completed_bitfield, partial_pieces)
+        )
+        self._resume_write.add_done_callback(lambda _: self.buffer_pool.unpin(buffers))
+        await asyncio.shield(self._resume_write)
+
+    def _persist_resume_state(self, completed_bitfield, partial_pieces):
+        self.file_saver.sync()
+        write_resume_file(
+            self.resume_file_path,
+            self.info_hash,
+            self.amount_of_pieces,
+            completed_bitfield,
+            partial_pieces
+        )
+
+    async def _save_resume_state_periodically(self):
+        while True:
+            await asyncio.sleep(RESUME_SAVE_INTERVAL)
+            await self.save_resume_state()
 
     async def start_session(self):
+        if self._recheck:
+            await self.recheck()
+        if self.complete() and not self.seed:
+            print('all pieces are already on disk')
+            self.file_saver.finish()
+            self._finish()
+            return
         file_saver_task = asyncio.ensure_future(self.file_saver.start())
-        peer_counter = 0
-        peer_tasks = []
-        peer_generator = peer_gen(self._torrent_info.tracker_urls, self._torrent_info)
-        for peers in peer_generator:
-            # each yield returns a response from a url parsed as a list of peers
-            if peer_counter >= 50:
-                # 50 peers is enough
-                break
-            peer_counter += len(peers)
-            peer_tasks.extend([Peer(peer['ip'], peer['port'], self).download() for peer in peers])
-
-        await asyncio.gather(*peer_tasks)
-        if not self.complete():
-            print('Connection Error. Retry')
-            exit(1)
+        resume_task = asyncio.ensure_future(self._save_resume_state_periodically())
+        self.metrics.add_collector(self.stats)
+        try:
+            await self._download(file_saver_task)
+        finally:
+            self._stopping = True
+            self.metrics.remove_collector(self.stats)
+            resume_task.cancel()
+            file_saver_task.cancel()
+            # a hash finishing later would take a disk slot nobody gives back
+            hashing_tasks = list(self._hashing_tasks)
+            for hashing_task in hashing_tasks:
+                hashing_task.cancel()
+            await asyncio.gather(*hashing_tasks, return_exceptions=True)
+            # pieces still queued for disk when the session stops must not keep slots other torrents share
+            while self._disk_slots_held > 0:
+                self._release_disk_slot()
+            # also kept with skipped files, un-skipping one later must not download everything again
+            if self._completed_pieces < self.amount_of_pieces:
+                await self.save_resume_state()
+            self._fail_piece_waiters()
+            self._hash_executor.shutdown(wait=False, cancel_futures=True)
+            # a removed torrent closes its files too, not only a finished one
+            self.file_saver.finish()
 
+    async def _download(self, file_saver_task):
+        if self.complete():
+            self._completed_event.set()
+        if self._listen:
+            await self._start_listening()
+        self.connection_manager.start()
+        if self.shards is not None:
+            self.shards.start()
+        self.tracker_client.start()
+        choker_task = asyncio.ensure_future(self.choker.run())
+        pex_task = None if self.private else asyncio.ensure_future(self.peer_exchange.run())
+        try:
+            await self._completed_event.wait()
+            await self.tracker_client.announce_event('completed')
+            if self.seed:
+                print('download complete, seeding until stopped')
+                await asyncio.Event().wait()
+        finally:
+            choker_task.cancel()
+            if pex_task is not None:
+                pex_task.cancel()
+            await self.tracker_client.stop()
+            await self.connection_manager.stop()
+            if self.shards is not None:
+                await self.shards.stop()
+            self._stop_listening()
+        self._hash_executor.shutdown()
+        # every verified piece is queued by now, the writer stops behind the last one
+        await self.file_saver.put_piece(None)
         await file_saver_task
-        self.file_saver.assemble_file()
+        self._finish()
+
+    async def _start_listening(self):
+        for port in LISTEN_PORTS:
+            try:
+                self._server = await asyncio.start_server(self._accept_peer, port=port)
+            except OSError:
+                continue
+            self.set_listen_port(port)
+            return
+        print('could not listen for incoming connections, only outgoing ones are used')
+
+    def set_listen_port(self, port):
+        """
+        the port incoming connections for this torrent arrive on, its own or the one of a SessionManager
+        """
+        self._listen_port = port
+        self.tracker_client.port = port
+
+    def listen_port(self):
+        """
+        :return: the port incoming connections are accepted on, None when nothing listens for this torrent
+        """
+        return self._listen_port
+
+    def _stop_listening(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            self._listen_port = None
+
+    async def _accept_peer(self, reader, writer):
+        handshake = await read_incoming_handshake(reader, writer)
+        if handshake is None or handshake[28:48] != self.info_hash:
+            writer.close()
+            return
+        await self.accept_connection(reader, writer, handshake)
+
+    async def accept_connection(self, reader, writer, handshake):
+        """
+        takes over a connection whose handshake was already read and matched to this torrent
+        """
+        if self.finished():
+            writer.close()
+            return
+        ip, port = writer.get_extra_info('peername')[:2]
+        await self.connection_manager.accept(ip, port, reader, writer, handshake)
+
+    def count_worker_transfer(self, downloaded, uploaded):
+        self.downloaded_counter.inc(downloaded)
+        self.uploaded_counter.inc(uploaded)
+        self.uploaded_bytes += uploaded
+
+    def _transfer_stats(self):
+        # (uploaded, downloaded, left) as reported to the trackers
+        return self.uploaded_bytes, self._downloaded_bytes, self._bytes_left
+
+    def _finish(self):
+        # the resume file only goes once every piece is verified, skipped files included
+        if self._completed_pieces == self.amount_of_pieces and os.path.exists(self.resume_file_path):
+            os.remove(self.resume_file_path)
+
+    def stats(self):
+        """
+        :return: dict with the current state of the torrent and its peers, collected into metric snapshots
+        """
+        peers = self.connection_manager.active_peers()
+        return {
+            'info_hash': bytes.hex(self.info_hash),
+            'completed_pieces': self._completed_pieces,
+            'amount_of_pieces': self.amount_of_pieces,
+            'downloaded_bytes': self._downloaded_bytes,
+            'uploaded_bytes': self.uploaded_bytes,
+            'bytes_left': self._bytes_left,
+            'wanted_pieces_left': self._wanted_pieces_left,
+            'skipped_files': len(self.skipped_files()),
+            'pieces_in_progress': len(self._in_progress_pieces),
+            'pieces_hashing': self._pieces_hashing,
+            'write_queue_depth': self.file_saver.queue_depth(),
+            'buffer_bytes_in_use': self.buffer_pool.in_use_bytes,
+            'memory_throttled': self._memory_throttled,
+            'endgame': self._endgame,
+            'connected_peers': len(peers),
+            'banned_peers': self.connection_manager.banned_count(),
+            'workers': self.shards.worker_count() if self.shards is not None else 0,
+            'peers': [peer.stats() for peer in peers]
+        }
 
     def complete(self):
-        return self._completed_pieces == self._torrent_info.amount_of_pieces
+        # every wanted piece is verified, skipped files are left out
+        return self._wanted_pieces_left == 0
+
+    def finished(self):
+        # nothing left to do for the peers: downloaded everything and not seeding
+        return self.complete() and not self.seed
+
+    def have_bitfield(self):
+        return bytes(self.file_saver.written_bitfield)
 
-    def handshake(self):
-        return chr(19).encode() \
-            + b'BitTorrent protocol' \
-            + bytes(8) \
-            + self._torrent_info.info_hash \
-            + self._torrent_info.my_peer_id
+    def has_piece(self, piece_index):
+        return bool(self.file_saver.written_bitfield[piece_index // 8] & (0x80 >> (piece_index % 8)))
+
+    def can_serve(self, piece_index, byte_offset, length):
+        if piece_index >= self.amount_of_pieces or not self.has_piece(piece_index):
+            return False
+        return 0 < length <= BLOCK_SIZE and byte_offset + length <= self.piece_size(piece_index)
+
+    def _on_piece_written(self, piece):
+        was_throttled = self._memory_throttled
+        self._release_disk_slot()
+        buffer = piece.detach_buffer()
+        if self.shards is None or not self.shards.release_slot(piece.index):
+            self.buffer_pool.release(buffer)
+        # pieces are only announced once they can be read back from disk
+        for peer in self.connection_manager.active_peers():
+            peer.send_have(piece.index)
+            if was_throttled:
+                peer.resume_requests()
+        if self.shards is not None:
+            self.shards.broadcast_have(piece.index)
+        for waiter in (self._piece_waiters or {}).pop(piece.index, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def open_stream(self, file_index, read_ahead=DEFAULT_READ_AHEAD):
+        """
+        :param file_index: index into the files_info of the torrent, a skipped file is downloaded after all
+        :return: FileStream reading the file as its pieces arrive
+        """
+        if self._file_priorities[file_index] == PRIORITY_SKIP:
+            file_priorities = list(self._file_priorities)
+            file_priorities[file_index] = PRIORITY_NORMAL
+            self.set_file_priorities(file_priorities)
+        self.file_saver.open_file(file_index)
+        files_info = self._torrent_info.files_info
+        torrent_offset = sum(file_info['length'] for file_info in files_info[:file_index])
+        file_info = files_info[file_index]
+        return FileStream(
+            self,
+            file_info['path'],
+            torrent_offset,
+            file_info['length'],
+            self._torrent_info.piece_length,
+            read_ahead
+        )
+
+    async def wait_for_piece(self, piece_index):
+        """
+        returns once the piece is written to disk, raises StreamClosedError if the session stops first
+        """
+        if self.has_piece(piece_index):
+            return
+        if self._piece_waiters is None:
+            raise StreamClosedError('the torrent was stopped')
+        waiter = asyncio.get_running_loop().create_future()
+        self._piece_waiters.setdefault(piece_index, []).append(waiter)
+        await waiter
+
+    def _fail_piece_waiters(self):
+        for waiters in self._piece_waiters.values():
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(StreamClosedError('the torrent was stopped'))
+        # None from here on, later reads of missing pieces fail right away
+        self._piece_waiters = None
+
+    def set_stream_window(self, stream, first_piece, last_piece):
+        self._stream_windows[stream] = (first_piece, min(last_piece, self.amount_of_pieces - 1))
+        self._update_priority_ranges()
+
+    def remove_stream_window(self, stream):
+        if self._stream_windows.pop(stream, None) is not None:
+            self._update_priority_ranges()
+
+    def _update_priority_ranges(self):
+        self.piece_picker.set_priority_ranges(list(self._stream_windows.values()))
+
+    def _move_sequential_window(self):
+        while self._first_missing_piece < self.amount_of_pieces and (
+                self._piece_state[self._first_missing_piece] == PIECE_VERIFIED
+                or not self.piece_picker.wanted(self._first_missing_piece)):
+            self._first_missing_piece += 1
+        if self._first_missing_piece == self.amount_of_pieces:
+            self.remove_stream_window(self)
+            return
+        read_ahead_pieces = max(1, DEFAULT_READ_AHEAD // self._torrent_info.piece_length)
+        self.set_stream_window(self, self._first_missing_piece, self._first_missing_piece + read_ahead_pieces)
+
+    def _release_disk_slot(self):
+        self._disk_slots_held -= 1
+        self.limits.disk_slots.release()
 
     def fetch_work(self, bitfield):
-        for index, piece in self._unfinished_pieces.items():
-            if index not in self._in_progress_pieces and bitfield[index]:
-                self._in_progress_pieces.add(index)
+        """
+        pieces other peers already started are shared before a new piece is picked,
+        so partial pieces get finished instead of piling up
+        """
+        for index, piece in self._in_progress_pieces.items():
+            if bitfield[index] and piece.has_unrequested_blocks():
                 return piece
-        return None
+        if self.memory_throttled():
+            return None
+        pick_started = time.perf_counter()
+        index = self.piece_picker.pick(bitfield)
+        self._pick_latency.observe(time.perf_counter() - pick_started)
+        if index is None:
+            return None
+        return self._start_piece(index)
+
+    def fetch_piece(self, piece_index):
+        """
+        work on one particular piece, for a peer that only lets us request certain pieces
+        :return: the piece if it has blocks left to request (started if it was not yet) or None
+        """
+        piece = self._in_progress_pieces.get(piece_index)
+        if piece is not None:
+            return piece if piece.has_unrequested_blocks() else None
+        if self.memory_throttled() or not self.piece_picker.take(piece_index):
+            return None
+        return self._start_piece(piece_index)
+
+    def _start_piece(self, piece_index):
+        piece = Piece(piece_index, self.piece_size(piece_index))
+        piece.attach_buffer(self.buffer_pool.acquire(piece.piece_length))
+        self._piece_state[piece_index] = PIECE_DOWNLOADING
+        self._in_progress_pieces[piece_index] = piece
+        return piece
 
-    def requeue_piece(self, piece_index):
-        print(f'{20*"#"} putting {piece_index} back in the queue {20*"#"}')
-        self._in_progress_pieces.remove(piece_index)
+    def lease_piece(self, piece_index):
+        # a worker process downloads the piece, a priority change must not make it pickable again meanwhile
+        self._piece_state[piece_index] = PIECE_DOWNLOADING
+
+    def return_leased_piece(self, piece_index):
+        # the worker gave the piece back unfinished, it is picked again
+        if self._piece_state[piece_index] == PIECE_DOWNLOADING:
+            self._piece_state[piece_index] = PIECE_MISSING
+            self.piece_picker.add(piece_index)
+
+    def memory_throttled(self):
+        """
+        True while the memory budget has no room for another piece, peers keep working on
+        the pieces they have but do not start new ones
+        """
+        self._memory_throttled = not self.buffer_pool.can_allocate(self._torrent_info.piece_length)
+        return self._memory_throttled
+
+    def more_work_expected(self):
+        # peers without requests are not idle while pieces wait for room in the memory budget
+        return self.memory_throttled()
+
+    def piece_in_progress(self, piece_index):
+        return self._in_progress_pieces.get(piece_index)
+
+    def endgame_block(self, peer):
+        """
+        endgame starts once every remaining block is requested, from then on idle peers get blocks
+        that are still missing even if another peer was already asked for them.
+        before that only the pieces at the read heads of streams get such duplicate requests,
+        so one slow peer does not hold up a reader
+        :return: tuple: (piece-index, byte-offset, length) or None
+        """
+        if self.complete():
+            return None
+        if self.piece_picker.pickable_count() > 0:
+            return self._duplicate_block(peer, [first_piece for first_piece, _ in self._stream_windows.values()])
+        if not self._endgame:
+            self._endgame = True
+            print(f'{20*"#"} entering endgame with {len(self._in_progress_pieces)} pieces left {20*"#"}')
+        return self._duplicate_block(peer, list(self._in_progress_pieces))
 
     async def on_piece_complete(self, piece_index):
-        piece_hash = sha1(self._unfinished_pieces[piece_index].downloaded_blocks).digest()
-        if piece_hash != self._torrent_info.piece_hashes[piece_index]:
-            self.requeue_piece(piece_index)
+        """
+        queues the piece for verification on the hashing threads and returns as soon as
+        there is room for it, the result is handled by _verify_piece
+        """
+        if self._stopping:
+            return
+        for peer in self.connection_manager.active_peers():
+            peer.active_pieces.pop(piece_index, None)
+        await self._hashing_slots.acquire()
+        hashing_task = asyncio.ensure_future(self._verify_piece(piece_index))
+        self._hashing_tasks.add(hashing_task)
+        hashing_task.add_done_callback(self._hashing_tasks.discard)
+
+    async def _verify_piece(self, piece_index):
+        piece = self._in_progress_pieces[piece_index]
+        self._pieces_hashing += 1
+        try:
+            piece_hash, hash_seconds = await self._run_hashing(timed_piece_digest, piece.dump())
+        finally:
+            self._pieces_hashing -= 1
+            self._hashing_slots.release()
+        self._hash_time.observe(hash_seconds)
+        if not await self._check_piece(piece, piece_hash):
+            # the piece stays in progress and is downloaded again from scratch
+            self._hash_failures.inc()
+            print(f'{20*"#"} piece {piece_index} failed the hash check {20*"#"}')
+            piece.reset()
             return
+        if self._stopping:
+            # kept in progress so the resume file saves its blocks, nothing is written any more
+            return
+        del self._in_progress_pieces[piece_index]
+        await self._piece_verified(piece)
+
+    async def _run_hashing(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._hash_executor, function, *args)
+
+    def ban_peer(self, ip):
+        """
+        disconnects and blacklists an ip that sent bad data, worker processes get the ban too
+        """
+        if self.connection_manager.is_banned(ip):
+            return
+        print(f'{20*"#"} banned {ip} for sending data that failed the hash check {20*"#"}')
+        self._banned_counter.inc()
+        self.connection_manager.ban(ip)
+        if self.shards is not None:
+            self.shards.broadcast_ban(ip)
 
+    async def add_verified_piece(self, piece_index, buffer):
+        """
+        takes over a piece a worker process downloaded and verified, buffer is its shared memory slot
+        """
+        if self._piece_state[piece_index] == PIECE_VERIFIED:
+            # the slot of the duplicate goes back or it is lost for leasing
+            self.shards.release_slot(piece_index)
+            return
+        piece = Piece(piece_index, self.piece_size(piece_index))
+        piece.attach_buffer(buffer)
+        self.smart_ban.forget_piece(piece_index)
+        await self._piece_verified(piece)
+
+    async def _piece_verified(self, piece):
+        if self._stopping:
+            return
+        self._piece_state[piece.index] = PIECE_VERIFIED
         self._completed_pieces += 1
-        print(f'completed piece index {piece_index} --- ({self._completed_pieces}/{self.amount_of_pieces})' +
+        self._verified_counter.inc()
+        self._downloaded_bytes += piece.piece_length
+        if self.piece_picker.wanted(piece.index):
+            self._wanted_pieces_left -= 1
+            self._bytes_left -= piece.piece_length
+        if self._sequential and piece.index == self._first_missing_piece:
+            self._move_sequential_window()
+        print(f'completed piece index {piece.index} --- ({self._completed_pieces}/{self.amount_of_pieces})' +
               f' ({round((self._completed_pieces / self.amount_of_pieces) * 100, 2):.2f}%)')
 
-        self._in_progress_pieces.remove(piece_index)
-        await self.file_saver.put_piece(self._unfinished_pieces[piece_index])
-        del self._unfinished_pieces[piece_index]
+        # the disk queue is shared between torrents, the slot is given back once the piece is written
+        self._pieces_waiting_for_disk += 1
+        await self.limits.disk_slots.acquire()
+        self._disk_slots_held += 1
+        await self.file_saver.put_piece(piece)
+        self._pieces_waiting_for_disk -= 1
 
-        if self._completed_pieces == self.amount_of_pieces:
-            await self.file_saver.put_piece(None)
+        # verified pieces may still be waiting for a disk slot, the download is only done behind the last one
+        if self.complete() and self._pieces_waiting_for_disk == 0:
+            self._completed_event.set()
 
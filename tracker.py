@@ -1,61 +1,195 @@
+import asyncio
 import urllib.parse
 import requests
 import socket
-from bencode import bdecode
+import bencodepy
 import struct
 import random
 
+DEFAULT_PORT = 6881
+# used when a tracker does not answer or does not send an interval, in seconds
+RETRY_INTERVAL = 60
+MIN_ANNOUNCE_INTERVAL = 30
+ANNOUNCE_TIMEOUT = 10
+UDP_RESPONSE_TIMEOUT = 5
+# event values of the udp announce request
+UDP_EVENTS = {'': 0, 'completed': 1, 'started': 2, 'stopped': 3}
 
-def peer_gen(urls, torrent_info):
-    for url in urls:
+
+class TrackerError(Exception):
+    pass
+
+
+class TrackerClient:
+    """
+    Announces to every tracker of the torrent concurrently and hands the peers of each response
+    to on_peers as soon as it arrives. Each tracker is then re-announced after the interval it asked for.
+    """
+
+    def __init__(self, torrent_info, on_peers, transfer_stats, port=DEFAULT_PORT):
+        """
+        :param on_peers: called with a list of peers ({ip: str, port: int}) for every response
+        :param transfer_stats: callable returning (uploaded, downloaded, left) in bytes
+        """
+        self._torrent_info = torrent_info
+        self._on_peers = on_peers
+        self._transfer_stats = transfer_stats
+        self.port = port
+        # the same tracker is often listed in both announce and announce-list
+        self._urls = list(dict.fromkeys(torrent_info.tracker_urls))
+        self._announce_tasks = []
+
+    def start(self):
+        self._announce_tasks = [asyncio.ensure_future(self._announce_loop(url)) for url in self._urls]
+
+    async def stop(self):
+        for announce_task in self._announce_tasks:
+            announce_task.cancel()
+        self._announce_tasks = []
+        await self.announce_event('stopped')
+
+    async def announce_event(self, event):
+        """
+        one time announce of 'completed' or 'stopped' to every tracker, failures are ignored
+        """
+        await asyncio.gather(*[self._try_announce(url, event) for url in self._urls])
+
+    async def _try_announce(self, url, event):
+        try:
+            return await self.announce(url, event)
+        except (TrackerError, OSError, asyncio.TimeoutError, requests.RequestException, bencodepy.BencodeDecodeError):
+            return None
+
+    async def _announce_loop(self, url):
+        event = 'started'
+        while True:
+            response = await self._try_announce(url, event)
+            if response is None:
+                interval = RETRY_INTERVAL
+            else:
+                interval, peers = response
+                event = ''
+                if peers:
+                    self._on_peers(peers)
+            await asyncio.sleep(max(interval, MIN_ANNOUNCE_INTERVAL))
+
+    async def announce(self, url, event=''):
+        """
+        :return: (interval, peers)
+        """
+        uploaded, downloaded, left = self._transfer_stats()
+        announce_info = {
+            'info_hash': self._torrent_info.info_hash,
+            'peer_id': self._torrent_info.my_peer_id,
+            'port': self.port,
+            'uploaded': uploaded,
+            'downloaded': downloaded,
+            'left': left,
+            'event': event,
+        }
         if url.startswith('http'):
-            yield http_tracker(url, torrent_info)
+            return await asyncio.wait_for(http_tracker(url, announce_info), timeout=ANNOUNCE_TIMEOUT)
         elif url.startswith('udp'):
-            yield udp_tracker(url, torrent_info)
+            return await asyncio.wait_for(udp_tracker(url, announce_info), timeout=ANNOUNCE_TIMEOUT)
+        raise TrackerError(f'unsupported tracker url {url}')
 
 
-def http_tracker(announce_url, torrent_info):
-    port = 6881
+async def http_tracker(announce_url, announce_info):
     params = {
-        'info_hash': torrent_info.info_hash,
-        'peer_id': torrent_info.my_peer_id,
-        'port': port,
-        'uploaded': 0,
-        'downloaded': 0,
-        'left': torrent_info.total_torrent_length
+        'info_hash': announce_info['info_hash'],
+        'peer_id': announce_info['peer_id'],
+        'port': announce_info['port'],
+        'uploaded': announce_info['uploaded'],
+        'downloaded': announce_info['downloaded'],
+        'left': announce_info['left'],
+        'compact': 1,
     }
-    url = announce_url + '?' + urllib.parse.urlencode(params)
-    encoded_response = requests.get(url, timeout=1.0)
+    if announce_info['event']:
+        params['event'] = announce_info['event']
+    separator = '&' if '?' in announce_url else '?'
+    url = announce_url + separator + urllib.parse.urlencode(params)
+    # requests is blocking so it runs on a worker thread, every tracker gets its own
+    encoded_response = await asyncio.to_thread(requests.get, url, timeout=ANNOUNCE_TIMEOUT)
     if encoded_response.status_code != 200:
-        return []
-    decoded_response = bdecode(encoded_response.content)
-    return decoded_response['peers']
+        raise TrackerError(f'tracker responded with status {encoded_response.status_code}')
+    decoded_response = bencodepy.decode(encoded_response.content)
+    if b'failure reason' in decoded_response:
+        raise TrackerError(decoded_response[b'failure reason'].decode('utf-8', 'replace'))
+    interval = decoded_response.get(b'interval', RETRY_INTERVAL)
+    return interval, parse_http_peers(decoded_response.get(b'peers', b''))
+
+
+def parse_http_peers(peers):
+    # BEP 23 compact responses pack every peer into 6 bytes, the original format is a list of dicts
+    if isinstance(peers, bytes):
+        return parse_compact_peers(peers)
+    return [
+        {'ip': peer[b'ip'].decode('utf-8', 'replace'), 'port': peer[b'port']}
+        for peer in peers if b'ip' in peer and b'port' in peer
+    ]
+
+
+def parse_compact_peers(compact_peers):
+    peers = []
+    for i in range(0, len(compact_peers) - len(compact_peers) % 6, 6):
+        peer_port = struct.unpack('>H', compact_peers[i + 4: i + 6])[0]
+        peers.append(
+            {'ip': socket.inet_ntoa(compact_peers[i: i + 4]), 'port': peer_port}
+        )
+    return peers
+
+
+class UdpTrackerProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self._transport = None
+        self._response = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        if not self._response.done():
+            self._response.set_result(data)
+
+    def error_received(self, exc):
+        if not self._response.done():
+            self._response.set_exception(exc)
+
+    def connection_lost(self, exc):
+        # exc is None when the socket was closed by udp_tracker itself
+        if exc is not None and not self._response.done():
+            self._response.set_exception(exc)
 
+    async def request(self, message, transaction_id):
+        """
+        sends message and waits for the response carrying the same transaction id
+        """
+        self._transport.sendto(message)
+        while True:
+            response = await asyncio.wait_for(self._response, timeout=UDP_RESPONSE_TIMEOUT)
+            self._response = asyncio.get_running_loop().create_future()
+            if len(response) >= 8 and response[4:8] == transaction_id:
+                action = struct.unpack('>I', response[:4])[0]
+                if action == 3:
+                    raise TrackerError(response[8:].decode('utf-8', 'replace'))
+                return response
 
-def udp_tracker(announce_url, torrent_info):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.settimeout(1.0)
-    connect_message = build_udp_connect_request()
+
+async def udp_tracker(announce_url, announce_info):
     parsed_url = urllib.parse.urlparse(announce_url)
+    transport, protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+        UdpTrackerProtocol,
+        remote_addr=(parsed_url.hostname, parsed_url.port)
+    )
     try:
-        sock.sendto(connect_message, (parsed_url.hostname, parsed_url.port))
-        response = sock.recv(16)
+        connect_message = build_udp_connect_request()
+        response = await protocol.request(connect_message, connect_message[12:16])
         connection_id = parse_udp_connect_response(response)
-        announce_request = build_udp_announce_request(
-            connection_id,
-            torrent_info.my_peer_id,
-            torrent_info.info_hash,
-            torrent_info.total_torrent_length
-        )
-        sock.sendto(announce_request, (parsed_url.hostname, parsed_url.port))
-        response = sock.recv(4096)
+        announce_request = build_udp_announce_request(connection_id, announce_info)
+        response = await protocol.request(announce_request, announce_request[12:16])
         return parse_udp_announce_response(response)
-    except ConnectionError:
-        return []
-    except TimeoutError:
-        return []
-    except socket.gaierror:
-        return []
+    finally:
+        transport.close()
 
 
 def build_udp_connect_request():
@@ -76,10 +210,12 @@ def parse_udp_connect_response(message):
     # 4       32-bit integer  transaction_id
     # 8      64-bit integer  connection_id
     # 16
-    return message[8:]
+    if len(message) < 16:
+        raise TrackerError('udp connect response is too short')
+    return message[8:16]
 
 
-def build_udp_announce_request(connection_id, peer_id, info_hash, total_length):
+def build_udp_announce_request(connection_id, announce_info):
     # Offset  Size    Name    Value
     # 0       64-bit integer  connection_id
     # 8       32-bit integer  action          1 // announce
@@ -97,19 +233,18 @@ def build_udp_announce_request(connection_id, peer_id, info_hash, total_length):
     # 98
     action = struct.pack('>I', 1)
     transaction_id = bytes(random.getrandbits(8) for _ in range(4))
-    to_download = total_length
-    downloaded = struct.pack('>Q', to_download)
-    left = struct.pack('>Q', total_length - to_download)
-    uploaded = struct.pack('>Q', 0)
-    event = struct.pack('>I', 0)
+    downloaded = struct.pack('>Q', announce_info['downloaded'])
+    left = struct.pack('>Q', announce_info['left'])
+    uploaded = struct.pack('>Q', announce_info['uploaded'])
+    event = struct.pack('>I', UDP_EVENTS[announce_info['event']])
     ip = struct.pack('>I', 0)
     key = bytes(random.getrandbits(8) for _ in range(4))
     want = struct.pack('>i', -1)
-    port = struct.pack('>H', 6881)
+    port = struct.pack('>H', announce_info['port'])
 
     return (
-            connection_id + action + transaction_id + info_hash +
-            peer_id + downloaded + left + uploaded + event +
+            connection_id + action + transaction_id + announce_info['info_hash'] +
+            announce_info['peer_id'] + downloaded + left + uploaded + event +
             ip + key + want + port
     )
 
@@ -124,15 +259,7 @@ def parse_udp_announce_response(response):
     # 20 + 6 * n  32-bit integer  IP address
     # 24 + 6 * n  16-bit integer  TCP port
     # 20 + 6 * N
-    ips = response[20:]
-    peers = []
-    for i in range(0, len(ips), 6):
-        peer_ip, peer_port = struct.unpack('>IH', ips[i: i+6])
-        # peers.append(
-        #     {'ip': str(ipaddress.IPv4Address(peer_ip)), 'port': peer_port}
-        # )
-        peers.append(
-            {'ip': socket.inet_ntoa(ips[i: i+4]), 'port': peer_port}
-        )
-    return peers
-
+    if len(response) < 20:
+        raise TrackerError('udp announce response is too short')
+    interval = struct.unpack('>I', response[8:12])[0]
+    return interval, parse_compact_peers(response[20:])